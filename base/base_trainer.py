@@ -1,12 +1,17 @@
 import os
 import math
 import json, copy
+import shutil
 import timeit
 import logging
+import random
+import numpy as np
 import torch
 import torch.optim as optim
 import time
 from utils.util import ensure_dir
+from utils.checkpoint_writer import CheckpointWriter
+from logger import Logger
 from collections import defaultdict
 from model import *
 try:
@@ -15,6 +20,7 @@ except ModuleNotFoundError:
     pass
 #from ..model import PairingGraph
 from torch.nn.parallel import DistributedDataParallel
+import torch.distributed as dist
 
 class BaseTrainer:
     """
@@ -123,6 +129,8 @@ class BaseTrainer:
             #self.swa_c_iters = config['trainer']['swa_c_iters'] if 'swa_c_iters' in config['trainer'] else config['trainer']['weight_averaging_c_iters']
             self.swa_avg_every = config['trainer']['swa_avg_every'] if 'swa_avg_every' in config['trainer'] else 0
             assert(self.val_step>=self.swa_avg_every) #otherwise we'll start evaluating more than the (swa)model is updated
+            #the SWA model's batch norm statistics are recomputed from this many random training pages before each validation (all with null)
+            self.swa_bn_samples = config['trainer']['swa_bn_samples'] if 'swa_bn_samples' in config['trainer'] else 100
 
 
 
@@ -279,12 +287,37 @@ class BaseTrainer:
         #assert self.monitor_mode == 'min' or self.monitor_mode == 'max'
         self.monitor_best = math.inf if self.monitor_mode == 'min' else -math.inf
         self.retry_count = config['trainer']['retry_count'] if 'retry_count' in config['trainer'] else 1
+        #on an out of memory error, retry the sample with smaller limits (see _reduce_memory) and skip it if that fails
+        self.oom_adaptive = config['trainer']['oom_adaptive'] if 'oom_adaptive' in config['trainer'] else True
+        self.oom_max_level = config['trainer']['oom_max_level'] if 'oom_max_level' in config['trainer'] else 3
+        if self.oom_adaptive and dist.is_available() and dist.is_initialized():
+            #a rank retrying or skipping a page by itself leaves the other ranks waiting in the gradient all-reduce
+            self.logger.warning('oom_adaptive is turned off for multi-process training')
+            self.oom_adaptive = False
+        if self.oom_adaptive and type(self)._reduce_memory is BaseTrainer._reduce_memory:
+            self.oom_adaptive = False #nothing to reduce for this trainer, keep the plain retries
+        #with DDP, log how long each rank waits on the slowest one per iteration (one all-gather per log_step)
+        straggler_report = config['trainer']['straggler_report'] if 'straggler_report' in config['trainer'] else True
+        self.work_times = [] if straggler_report and dist.is_available() and dist.is_initialized() else None
+        self.last_work_time = None #set by the trainer to the iteration's time before the backward pass
+        self.straggler_log = None
+        #for resuming at the same place in the data (see data_loader/resumable_sampler.py)
+        self.samples_consumed = 0 #of this epoch, counted by the trainer since the loader prefetches
+        self.resumed_data_state = None
+        self.resumed_rng_state = None
+        self.checkpoint_writer = CheckpointWriter(config['trainer']['async_checkpoint'] if 'async_checkpoint' in config['trainer'] else True)
+        self.save_stall = 0 #seconds training waited on checkpoint saving since the last log
         self.start_iteration = 1
         self.iteration=self.start_iteration
         self.checkpoint_dir = os.path.join(config['trainer']['save_dir'], self.name)
         ensure_dir(self.checkpoint_dir)
         json.dump(config, open(os.path.join(self.checkpoint_dir, 'config.json'), 'w'),
                   indent=4, sort_keys=False)
+        #entries are appended to this, checkpoints only store how far in they were. It's only opened by train()
+        #so other scripts that load and save checkpoints (do_update_bn.py) leave it alone
+        self.log_path = os.path.join(self.checkpoint_dir, 'log.jsonl')
+        self.log_offset = 0
+        self.resume_log_path = None
         self.iteration=999999999999999
         self.side_process=False
         self.reset_iteration = config['trainer']['reset_resume_iteration'] if 'reset_resume_iteration' in config['trainer'] else False
@@ -303,7 +336,10 @@ class BaseTrainer:
         """
         Full training logic
         """
+        if not self.side_process:
+            self._open_log()
         sumLog=defaultdict(lambda:0.0)
+        sumCount=defaultdict(lambda:0) #steps each value was logged in (some are only logged on log steps)
         sumTime=0
         #for metric in self.metrics:
         #    sumLog['avg_'+metric.__name__]=0
@@ -325,7 +361,11 @@ class BaseTrainer:
                     print(err)
                     torch.cuda.empty_cache() #this is primarily to catch rare CUDA out of memory errors
                     lastErr = err
+                    if self.oom_adaptive and is_out_of_memory(err):
+                        break #retried with less memory use below
 
+            if result is None and self.oom_adaptive and is_out_of_memory(lastErr):
+                result = self._oom_retry(self.iteration)
             if result is None:
                 result = self._train_iteration(self.iteration)
                 #if self.retry_count>1:
@@ -334,6 +374,12 @@ class BaseTrainer:
 
             elapsed_time = timeit.default_timer() - t
             sumLog['sec_per_iter'] += elapsed_time
+            sumCount['sec_per_iter'] += 1
+            if self.work_times is not None:
+                #time before the gradient all-reduce, which waits on the slowest rank
+                self.work_times.append(self.last_work_time if self.last_work_time is not None else elapsed_time)
+                if self.iteration%self.log_step==0:
+                    self.straggler_log = self._straggler_report() #all ranks take part
             #print('iter: '+str(elapsed_time))
 
             #Stochastic Weight Averaging    https://github.com/timgaripov/swa/blob/master/train.py
@@ -346,6 +392,8 @@ class BaseTrainer:
                 self.swa_model.update_parameters(self.model)
 
             if self.side_process:
+                if self.iteration%self.val_step==0 and self.valid_data_loader is not None:
+                    self._validate() #sharded validation, the master gets the combined results
                 continue #when multithreading, current log, and validation, is only collected on master
 
 
@@ -353,8 +401,10 @@ class BaseTrainer:
                 if key == 'metrics':
                     for i, metric in enumerate(self.metrics):
                         sumLog['avg_'+metric.__name__] += result['metrics'][i]
+                        sumCount['avg_'+metric.__name__] += 1
                 else:
                     sumLog['avg_'+key] += value
+                    sumCount['avg_'+key] += 1
             
             #log prep
             if (    self.iteration%self.log_step==0 or 
@@ -363,13 +413,19 @@ class BaseTrainer:
                     (self.save_step_minor is not None and self.iteration % self.save_step_minor==0)
                 ):
                 log = {'iteration': self.iteration}
+                if self.save_stall>0:
+                    log['sec_checkpoint_stall'] = self.save_stall
+                    self.save_stall = 0
+                if self.straggler_log is not None:
+                    log.update(self.straggler_log)
+                    self.straggler_log = None
 
                 for key, value in result.items():
                     if key == 'metrics':
                         for i, metric in enumerate(self.metrics):
                             log[metric.__name__] = result['metrics'][i]
                     else:
-                        log[key] = value
+                        log[key] = to_number(value)
 
             #LOG
             if self.iteration%self.log_step==0:
@@ -377,38 +433,19 @@ class BaseTrainer:
                 print('                   ', end='\r')
                 if self.iteration-self.start_iteration>=self.log_step: #skip avg if started in odd spot
                     for key in sumLog:
-                        sumLog[key] /= self.log_step
+                        sumLog[key] = to_number(sumLog[key])/max(sumCount[key],1)
                     #self._minor_log(sumLog)
                     log = {**log, **sumLog}
                 self._minor_log(log)
                 for key in sumLog:
                     sumLog[key] =0.0
+                    sumCount[key] =0
                 if self.iteration%self.val_step!=0: #we'll do it later if we have a validation pass
                     self.train_logger.add_entry(log)
 
             #VALIDATION
             if self.iteration%self.val_step==0:
-                if self.swa and self.iteration>=self.swa_start:
-                    temp_model = self.model.cpu()
-                    self.model = self.swa_model
-                    self.bn_update()
-                    val_result = self._valid_epoch()
-                    self.model = temp_model.cuda()
-                    for key, value in val_result.items():
-                        if 'metrics' in key:
-                            for i, metric in enumerate(self.metrics):
-                                log['swa_val_' + metric.__name__] = val_result[key][i]
-                        else:
-                            log['swa_'+key] = value
-                else:
-                    val_result = self._valid_epoch()
-                    for key, value in val_result.items():
-                        if 'metrics' in key:
-                            for i, metric in enumerate(self.metrics):
-                                log['val_' + metric.__name__] = val_result[key][i]
-                        else:
-                            log[key] = value
-                            #sumLog['avg_'+key] += value
+                log.update(self._validate())
 
                 if self.train_logger is not None:
                     if self.iteration%self.log_step!=0:
@@ -438,6 +475,7 @@ class BaseTrainer:
                 #    print()#clear inplace text
                 #self.logger.info('Minor checkpoint saved for iteration '+str(self.iteration))
 
+        self.checkpoint_writer.wait()
             
 
     def _train_iteration(self, iteration):
@@ -450,6 +488,192 @@ class BaseTrainer:
 
     def save(self):
         self._save_checkpoint(self.iteration, None)
+        self.checkpoint_writer.wait()
+
+    def _validate(self):
+        """
+        Runs the validation (on the SWA model if it's in use) and returns the log entries
+        """
+        log = {}
+        if self.swa and self.iteration>=self.swa_start:
+            bn_time = self.update_swa_batch_norm(self.swa_bn_samples)
+            model = self.model
+            self.model = self._swa_inner_model() #the training model stays where it is
+            try:
+                val_result = self._valid_epoch()
+            finally:
+                self.model = model
+            log['sec_swa_bn_update'] = bn_time
+            for key, value in val_result.items():
+                if 'metrics' in key:
+                    for i, metric in enumerate(self.metrics):
+                        log['swa_val_' + metric.__name__] = val_result[key][i]
+                else:
+                    log['swa_'+key] = value
+        else:
+            model = self.model
+            if isinstance(self.model, DistributedDataParallel):
+                self.model = self.model.module #the ranks validate different pages, so no DDP syncing in the forward
+            try:
+                val_result = self._valid_epoch()
+            finally:
+                self.model = model
+            for key, value in val_result.items():
+                if 'metrics' in key:
+                    for i, metric in enumerate(self.metrics):
+                        log['val_' + metric.__name__] = val_result[key][i]
+                else:
+                    log[key] = value
+                    #sumLog['avg_'+key] += value
+        return log
+
+    def _swa_inner_model(self):
+        """
+        The model the SWA model averages, without DDP. Forwarding the DDP wrapper broadcasts buffers from rank 0
+        each time, which the ranks can't do when they run different numbers of pages
+        """
+        model = self.swa_model.module
+        if isinstance(model, DistributedDataParallel):
+            model = model.module
+        return model
+
+    def _open_log(self):
+        """
+        Opens log.jsonl for the training process, cutting off anything logged after the resumed checkpoint
+        """
+        if self.train_logger is None or self.train_logger.path is not None:
+            return
+        if self.resume_log_path is not None and not os.path.exists(self.log_path) and os.path.exists(self.resume_log_path):
+            #resuming into a new directory
+            shutil.copyfile(self.resume_log_path, self.log_path)
+        self.train_logger.open(self.log_path, self.log_offset)
+
+    def _data_state(self):
+        sampler = getattr(getattr(self,'data_loader',None),'sampler',None)
+        if hasattr(sampler,'state_dict'):
+            return sampler.state_dict(self.samples_consumed)
+        return None
+
+    def _restore_data_state(self):
+        """
+        Puts the training sampler back where the checkpoint was (call before making the data loader's iterator)
+        """
+        sampler = getattr(getattr(self,'data_loader',None),'sampler',None)
+        if self.resumed_data_state is not None and hasattr(sampler,'load_state_dict'):
+            sampler.load_state_dict(self.resumed_data_state)
+            self.samples_consumed = self.resumed_data_state['position']
+            self.logger.info('Resuming data at epoch {}, sample {}'.format(self.resumed_data_state['epoch'], self.samples_consumed))
+        self.resumed_data_state = None
+
+    def _restore_rng_state(self):
+        """
+        Sets the random number generators back to the checkpoint's (call once setting up is done)
+        """
+        if self.resumed_rng_state is not None:
+            rng_state = self.resumed_rng_state
+            random.setstate(rng_state['python'])
+            np.random.set_state(rng_state['numpy'])
+            torch.set_rng_state(rng_state['torch'])
+            if rng_state['cuda'] is not None and torch.cuda.is_available() and len(rng_state['cuda'])==torch.cuda.device_count():
+                torch.cuda.set_rng_state_all(rng_state['cuda'])
+        self.resumed_rng_state = None
+
+    def _valid_sharded(self):
+        #data_loader.shard_sampler.ShardSampler
+        return getattr(getattr(self.valid_data_loader,'sampler',None),'sharded',False) and dist.is_available() and dist.is_initialized()
+
+    def _merge_valid_shards(self, val_metrics, val_count):
+        """
+        With sharded validation, combines every rank's summed metrics and counts (so the averages are over the whole set)
+        """
+        if not self._valid_sharded():
+            return val_metrics, val_count
+        counts = {name:val_count[name] for name in val_metrics}
+        all_shards = [None]*dist.get_world_size()
+        dist.all_gather_object(all_shards, (val_metrics, counts))
+        merged_metrics = {}
+        merged_count = defaultdict(lambda: 1)
+        for shard_metrics, shard_counts in all_shards:
+            for name,value in shard_metrics.items():
+                if name in merged_metrics:
+                    merged_metrics[name] += value
+                    merged_count[name] += shard_counts[name]
+                else:
+                    merged_metrics[name] = value
+                    merged_count[name] = shard_counts[name]
+        return merged_metrics, merged_count
+
+    def _straggler_report(self):
+        """
+        Gathers every rank's per-iteration work times and returns, for each rank, the mean seconds per
+        iteration it waited on the slowest rank
+        """
+        world_size = dist.get_world_size()
+        all_times = [None]*world_size
+        dist.all_gather_object(all_times, self.work_times)
+        self.work_times = []
+        num = min(len(times) for times in all_times)
+        if num==0:
+            return None
+        slowest = [max(times[i] for times in all_times) for i in range(num)]
+        report = {}
+        for rank,times in enumerate(all_times):
+            report['ddp_wait_sec_rank{}'.format(rank)] = sum(slowest[i]-times[i] for i in range(num))/num
+        return report
+
+    def _oom_retry(self, iteration):
+        """
+        Retries an iteration that ran out of memory with less and less memory use.
+        Returns None if the sample should be skipped.
+        """
+        result = None
+        level = 0
+        try:
+            while result is None:
+                level += 1
+                if level>self.oom_max_level or not self._reduce_memory(level):
+                    break
+                try:
+                    result = self._train_iteration(iteration)
+                except RuntimeError as err:
+                    if not is_out_of_memory(err):
+                        raise
+                    torch.cuda.empty_cache()
+        finally:
+            self._restore_memory()
+        self._record_oom(iteration, level, result is None)
+        if result is None:
+            self.optimizer.zero_grad() #drop any partial gradient
+            result = {}
+        result['oom_retries'] = level
+        return result
+
+    def _reduce_memory(self, level):
+        """
+        Sets up the retry of the failed sample to use less memory (more so with each level).
+        Returns False if nothing more can be reduced
+        """
+        return False
+
+    def _restore_memory(self):
+        """
+        Undoes _reduce_memory
+        """
+        pass
+
+    def _record_oom(self, iteration, level, skipped):
+        if skipped:
+            self.logger.warning('Out of memory on iteration {}, skipped it after {} retries'.format(iteration, level-1))
+        else:
+            self.logger.warning('Out of memory on iteration {}, succeeded with reduction level {}'.format(iteration, level))
+        with open(os.path.join(self.checkpoint_dir, 'oom_events.jsonl'), 'a') as f:
+            f.write(json.dumps({'iteration': iteration, 'level': level, 'skipped': skipped, **self._oom_info()}, default=str)+'\n')
+
+    def _oom_info(self):
+        """
+        Extra information for the OOM record (e.g. what sample it was)
+        """
+        return {}
 
     def _save_checkpoint(self, iteration, log, save_best=False, minor=False):
         """
@@ -463,53 +687,60 @@ class BaseTrainer:
         state = {
             'arch': arch,
             'iteration': iteration,
-            'logger': self.train_logger,
             'optimizer': self.optimizer.state_dict(),
             'monitor_best': self.monitor_best,
             'config': self.config
         }
-        if 'save_mode' not in self.config or self.config['save_mode']=='state_dict':
-            state_dict = self.model.state_dict()
-            for k,v in state_dict.items():
-                state_dict[k]=v.cpu()
-            state['state_dict']= state_dict
+        by_state_dict = 'save_mode' not in self.config or self.config['save_mode']=='state_dict'
+        if by_state_dict:
+            #the writer copies these to the CPU
+            state['state_dict']= self.model.state_dict()
             if self.swa and self.swa_model is not None:
-                swa_state_dict = self.swa_model.state_dict()
-                for k,v in swa_state_dict.items():
-                    swa_state_dict[k]=v.cpu()
-                state['swa_state_dict']= swa_state_dict
+                state['swa_state_dict']= self.swa_model.state_dict()
         else:
             state['model'] = self.model.cpu()
             if self.swa:
                 state['swa_model'] = self.swa_model.cpu()
         if self.useLearningSchedule:
             state['lr_schedule'] = self.lr_schedule.state_dict()
+        if self.train_logger is not None and self.train_logger.path is not None:
+            state['log_offset'] = self.train_logger.offset
+        elif self.train_logger is not None and len(self.train_logger.entries)>0:
+            state['logger'] = self.train_logger #from an older checkpoint, not moved to log.jsonl until training
+        else:
+            state['log_offset'] = self.log_offset #not training, the log is left as it was
+        data_state = self._data_state()
+        if data_state is not None:
+            state['data_state'] = data_state
+        state['rng_state'] = {
+                'python': random.getstate(),
+                'numpy': np.random.get_state(),
+                'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+                }
         #if self.swa:
         #    state['swa_n']=self.swa_n
-        torch.cuda.empty_cache() #weird gpu memory issue when calling torch.save()
         if not minor:
             filename = os.path.join(self.checkpoint_dir, 'checkpoint-iteration{}.pth'
                                     .format(iteration))
         else:
             filename = os.path.join(self.checkpoint_dir, 'checkpoint-latest.pth')
-                            
+        filename_late = os.path.join(self.checkpoint_dir, 'checkpoint-latest.pth')
+        links = [filename_late] if not minor else [] #checkpoint-latest always has the latest
+        rename_to = os.path.join(self.checkpoint_dir, 'model_best.pth') if save_best else None
+
         #print(self.module.state_dict().keys())
-        torch.save(state, filename)
-        if not minor:
-            #remove minor as this is the latest
-            filename_late = os.path.join(self.checkpoint_dir, 'checkpoint-latest.pth')
-            try:
-                os.remove(filename_late)
-            except FileNotFoundError:
-                pass
-            #os.link(filename,filename_late) #this way checkpoint-latest always does have the latest
-            torch.save(state, filename_late) #something is wrong with thel inkgin
+        #written in the background (unless async_checkpoint is false), a whole model object is written right away
+        stall = self.checkpoint_writer.save(state, filename, links, rename_to, snapshot_state=by_state_dict)
+        if not by_state_dict:
+            self.checkpoint_writer.wait()
+        torch.cuda.empty_cache() #weird gpu memory issue when calling torch.save()
+        self.save_stall += stall
 
         if save_best:
-            os.rename(filename, os.path.join(self.checkpoint_dir, 'model_best.pth'))
-            self.logger.info("Saved current best: {} ...".format('model_best.pth'))
+            self.logger.info("Saving current best: {} ... (training held {:.2f}s)".format('model_best.pth',stall))
         else:
-            self.logger.info("Saved checkpoint: {} ...".format(filename))
+            self.logger.info("Saving checkpoint: {} ... (training held {:.2f}s)".format(filename,stall))
 
 
         ######DEBUG
@@ -580,16 +811,107 @@ class BaseTrainer:
             print('Did not load optimizer')
         if self.useLearningSchedule:
             self.lr_schedule.load_state_dict(checkpoint['lr_schedule'])
-        self.train_logger = checkpoint['logger']
+        if not self.reset_iteration:
+            #restored once the data loader is set up (_restore_data_state, _restore_rng_state)
+            self.resumed_data_state = checkpoint['data_state'] if 'data_state' in checkpoint else None
+            self.resumed_rng_state = checkpoint['rng_state'] if 'rng_state' in checkpoint else None
+        if self.train_logger is None:
+            self.train_logger = Logger()
+        if 'log_offset' in checkpoint:
+            self.log_offset = checkpoint['log_offset']
+            self.resume_log_path = os.path.join(os.path.dirname(resume_path), 'log.jsonl')
+        elif 'logger' in checkpoint and checkpoint['logger'] is not None:
+            #older checkpoint with the whole log pickled in it, it's written to the JSONL log when training starts
+            self.train_logger.entries = checkpoint['logger'].entries
         self.logger.info("Checkpoint '{}' (iteration {}) loaded".format(resume_path, self.start_iteration))
 
-    def update_swa_batch_norm(self):
-        #update_bn(self.data_loader,self.swa_model)
-        tmp=self.model.cpu()
-        self.model=self.swa_model.train()
-        for instance in self.data_loader:
-            self.run(instance)
-        self.model=tmp
+    def update_swa_batch_norm(self, num_samples=None):
+        """
+        Recomputes the SWA model's batch norm statistics as the plain average over num_samples random training
+        pages (all of them if None), like torch.optim.swa_utils.update_bn. Returns the seconds it took
+        """
+        tic = timeit.default_timer()
+        bns = [module for module in self.swa_model.modules() if isinstance(module, torch.nn.modules.batchnorm._BatchNorm) and module.track_running_stats]
+        if len(bns)==0:
+            return 0
+        momenta = {}
+        for bn in bns:
+            bn.reset_running_stats()
+            momenta[bn] = bn.momentum
+            bn.momentum = None #cumulative average
+        was_training = self.swa_model.training
+        self.swa_model.train()
+        model = self.model
+        self.model = self._swa_inner_model() #no DDP syncs, the ranks' statistics are merged after
+        try:
+            with torch.no_grad():
+                for instance in self._bn_update_loader(num_samples):
+                    self._bn_forward(instance)
+            if dist.is_available() and dist.is_initialized():
+                self._merge_bn_stats(bns)
+        finally:
+            self.model = model
+            self.swa_model.train(was_training)
+            for bn in bns:
+                bn.momentum = momenta[bn]
+        toc = timeit.default_timer()
+        self.logger.info('Updated SWA batch norm in {:.1f} sec'.format(toc-tic))
+        return toc-tic
+
+    def _bn_update_loader(self, num_samples):
+        """
+        A loader over a random subset of the training set, made fresh so the training loader's place isn't changed.
+        The subset is the same on all ranks, each runs its share of it
+        """
+        dataset = self.data_loader.dataset
+        indices = list(range(len(dataset)))
+        random.Random(self.iteration).shuffle(indices)
+        if num_samples is not None:
+            indices = indices[:num_samples]
+        if dist.is_available() and dist.is_initialized():
+            #pad so every rank runs the same number of pages
+            world_size = dist.get_world_size()
+            share = math.ceil(len(indices)/world_size)
+            indices = (indices*world_size)[:share*world_size]
+            indices = indices[dist.get_rank()::world_size]
+        return torch.utils.data.DataLoader(dataset,
+                batch_size=self.data_loader.batch_size,
+                sampler=indices,
+                num_workers=self.data_loader.num_workers,
+                collate_fn=self.data_loader.collate_fn)
+
+    def _bn_forward(self, instance):
+        """
+        Runs self.model on an instance for its batch norm statistics, losses aren't needed
+        """
+        self.run(instance)
+
+    def _merge_bn_stats(self, bns):
+        #average the ranks' statistics, weighted by how many batches each ran, in one all-reduce
+        stats = []
+        for bn in bns:
+            count = bn.num_batches_tracked.to(bn.running_mean.device, torch.float)
+            stats += [bn.running_mean*count, bn.running_var*count, count.view(1)]
+        stats = torch.cat(stats)
+        dist.all_reduce(stats)
+        start = 0
+        for bn in bns:
+            size = bn.running_mean.numel()
+            mean = stats[start:start+size]
+            var = stats[start+size:start+2*size]
+            count = stats[start+2*size]
+            start += 2*size+1
+            if count>0:
+                bn.running_mean.copy_(mean/count)
+                bn.running_var.copy_(var/count)
+            bn.num_batches_tracked.fill_(int(count))
+
+#results may be device tensors, summed without syncing and only read when logged
+def to_number(value):
+    return value.item() if torch.is_tensor(value) else value
+
+def is_out_of_memory(err):
+    return err is not None and 'out of memory' in str(err)
 
 def moving_average(net1, net2, alpha=1):
     for param1, param2 in zip(net1.parameters(), net2.parameters()):
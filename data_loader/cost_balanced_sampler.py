@@ -0,0 +1,107 @@
+import json
+import math
+import os
+import random
+import torch
+import torch.distributed as dist
+
+#A DistributedSampler replacement that gives the ranks pages of similar cost at each step, so fast ranks wait
+#less on slow ones at the gradient all-reduce.
+#The cost of a page is its measured training time (record(), from the trainer) or, if it hasn't been measured,
+#an estimate from the dataset's page_cost() (the annotation size, about proportional to the number of boxes)
+#scaled by the median measured seconds per unit. The measurements are shared between ranks at the start
+#of each epoch and saved to cost_path, so later runs start with them.
+#Each epoch the pages are shuffled (the same on all ranks), then, in windows of window_steps steps, sorted
+#by cost and dealt so each step's group of world_size pages has neighbouring costs. The group order is shuffled.
+
+class CostBalancedSampler(torch.utils.data.Sampler):
+    def __init__(self,dataset,num_replicas,rank,cost_path=None,window_steps=16,seed=0):
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.cost_path = cost_path
+        self.window_steps = window_steps
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = math.ceil(len(dataset)/num_replicas)
+        self.total_size = self.num_samples*num_replicas
+
+        self.names = [image['imageName'] for image in dataset.images]
+        self.name_to_index = {name:i for i,name in enumerate(self.names)}
+        self.estimates = [dataset.page_cost(i) for i in range(len(dataset))]
+        self.measured = {} #imageName: seconds (running average)
+        self.epoch_measured = {} #what the current epoch's order was made from
+        self.new_measured = {} #measured on this rank since the last epoch start
+        if cost_path is not None and os.path.exists(cost_path):
+            with open(cost_path) as f:
+                self.measured = json.load(f)
+
+    def set_epoch(self,epoch):
+        self.epoch = epoch
+
+    #called by the trainer with the time a page took
+    def record(self,name,seconds):
+        if name in self.new_measured:
+            self.new_measured[name] = 0.5*(self.new_measured[name]+seconds)
+        else:
+            self.new_measured[name] = seconds
+
+    def _share_measured(self):
+        if dist.is_available() and dist.is_initialized():
+            all_measured = [None]*self.num_replicas
+            dist.all_gather_object(all_measured,self.new_measured)
+        else:
+            all_measured = [self.new_measured]
+        for measured in all_measured:
+            for name,seconds in measured.items():
+                if name in self.measured:
+                    self.measured[name] = 0.5*(self.measured[name]+seconds)
+                else:
+                    self.measured[name] = seconds
+        self.new_measured = {}
+        if self.cost_path is not None and self.rank==0 and len(self.measured)>0:
+            tmp_path = self.cost_path+'.tmp'
+            with open(tmp_path,'w') as f:
+                json.dump(self.measured,f)
+            os.replace(tmp_path,self.cost_path)
+
+    def costs(self):
+        ratios = sorted(self.measured[name]/self.estimates[self.name_to_index[name]]
+                for name in self.measured if name in self.name_to_index and self.estimates[self.name_to_index[name]]>0)
+        per_unit = ratios[len(ratios)//2] if len(ratios)>0 else 1
+        return [self.measured[name] if name in self.measured else self.estimates[i]*per_unit for i,name in enumerate(self.names)]
+
+    def __iter__(self):
+        self._share_measured() #every rank calls this at the same point, when the loader is restarted
+        self.epoch_measured = dict(self.measured)
+        costs = self.costs()
+
+        rng = random.Random(self.seed+self.epoch)
+        self.epoch += 1 #the trainer restarts the loader itself, so a new order each time
+        indices = list(range(len(self.dataset)))
+        rng.shuffle(indices)
+        indices += indices[:self.total_size-len(indices)] #pad to divide evenly
+
+        window = self.window_steps*self.num_replicas
+        my_indices=[]
+        for start in range(0,self.total_size,window):
+            window_indices = sorted(indices[start:start+window],key=lambda i:costs[i])
+            groups = [window_indices[g:g+self.num_replicas] for g in range(0,len(window_indices),self.num_replicas)]
+            rng.shuffle(groups)
+            for group in groups:
+                if rng.random()<0.5:
+                    group = group[::-1] #so rank 0 doesn't always get the cheapest
+                my_indices.append(group[self.rank])
+        assert len(my_indices)==self.num_samples
+        return iter(my_indices)
+
+    def __len__(self):
+        return self.num_samples
+
+    #enough to make the current epoch's order again (with set_epoch), see ResumableSampler
+    def state_dict(self):
+        return {'measured': self.epoch_measured}
+
+    def load_state_dict(self,state):
+        self.measured = dict(state['measured'])
+        self.new_measured = {}
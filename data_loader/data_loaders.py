@@ -1,12 +1,17 @@
 import torch
 import torch.utils.data
 import numpy as np
+import os
 from datasets import forms_box_detect
 from datasets.forms_box_detect import FormsBoxDetect
 from datasets import forms_graph_pair
 from datasets import funsd_graph_pair
 from datasets import funsd_box_detect
 from base import BaseDataLoader
+from data_loader.cost_balanced_sampler import CostBalancedSampler
+from data_loader.shard_sampler import ShardSampler
+from data_loader.resumable_sampler import ResumableSampler
+from datasets.graph_pair import GraphPairDataset
 
 
 
@@ -40,11 +45,11 @@ def getDataLoader(config,split,rank=None,world_size=None):
         if data_set_name=='FormsBoxDetect':
             return withCollate(FormsBoxDetect,forms_box_detect.collate,batch_size,valid_batch_size,shuffle,shuffleValid,numDataWorkers,split,data_dir,config)
         elif data_set_name=='FormsGraphPair':
-            return withCollate(forms_graph_pair.FormsGraphPair,forms_graph_pair.collate,batch_size,valid_batch_size,shuffle,shuffleValid,numDataWorkers,split,data_dir,config)
+            return withCollate(forms_graph_pair.FormsGraphPair,forms_graph_pair.collate,batch_size,valid_batch_size,shuffle,shuffleValid,numDataWorkers,split,data_dir,config,rank,world_size)
         elif data_set_name=='FUNSDBoxDetect':
             return withCollate(funsd_box_detect.FUNSDBoxDetect,funsd_box_detect.collate,batch_size,valid_batch_size,shuffle,shuffleValid,numDataWorkers,split,data_dir,config)
         elif data_set_name=='FUNSDGraphPair':
-            return withCollate(funsd_graph_pair.FUNSDGraphPair,funsd_graph_pair.collate,batch_size,valid_batch_size,shuffle,shuffleValid,numDataWorkers,split,data_dir,config)
+            return withCollate(funsd_graph_pair.FUNSDGraphPair,funsd_graph_pair.collate,batch_size,valid_batch_size,shuffle,shuffleValid,numDataWorkers,split,data_dir,config,rank,world_size)
         else:
             print('Error, no dataloader has no set for {}'.format(data_set_name))
             exit()
@@ -67,23 +72,46 @@ def basic(setObj,batch_size,valid_batch_size,shuffle,shuffleValid,numDataWorkers
         validData = setObj(dirPath=data_dir, split=['train','valid'], config=config['validation'])
         validLoader = torch.utils.data.DataLoader(validData, batch_size=valid_batch_size, shuffle=shuffleValid, num_workers=numDataWorkers)
         return trainLoader, validLoader
+#Wraps the training sampler so the place in the data (and the augmentation seeds) are saved in checkpoints
+def resumableSampler(trainData,shuffle,sampler,config,rank):
+    resumable = config['data_loader']['resumable'] if 'resumable' in config['data_loader'] else True
+    if resumable and isinstance(trainData,GraphPairDataset):
+        seed = config['data_loader']['seed'] if 'seed' in config['data_loader'] else (0 if rank is not None else None) #the ranks need the same seed
+        return ResumableSampler(trainData,shuffle=shuffle,base=sampler,seed=seed), False
+    return sampler, shuffle
+
 def withCollate(setObj,collateFunc,batch_size,valid_batch_size,shuffle,shuffleValid,numDataWorkers,split,data_dir,config,rank=None,world_size=None):
     if split=='train':
         trainData = setObj(dirPath=data_dir, split='train', config=config['data_loader'])
-        if rank is not None:
+        if rank is not None and 'balance_ranks' in config['data_loader'] and config['data_loader']['balance_ranks']:
+            #give the ranks pages of similar cost each step
+            cost_path = config['data_loader']['page_cost_path'] if 'page_cost_path' in config['data_loader'] else os.path.join(config['trainer']['save_dir'],config['name'],'page_costs.json')
+            train_sampler = CostBalancedSampler(
+                    trainData,
+                    num_replicas=world_size,
+                    rank=rank,
+                    cost_path=cost_path)
+        elif rank is not None:
             train_sampler = torch.utils.data.distributed.DistributedSampler(
                     trainData,
                     num_replicas=world_size,
                     rank=rank )
         else:
             train_sampler = None
+        train_sampler, shuffle = resumableSampler(trainData,shuffle,train_sampler,config,rank)
 
         trainLoader = torch.utils.data.DataLoader(trainData, batch_size=batch_size, shuffle=shuffle, num_workers=numDataWorkers, collate_fn=collateFunc, sampler=train_sampler)
-        if rank is None or rank==0:
+        shard_validation = config['validation']['shard_validation'] if 'shard_validation' in config['validation'] else True
+        if rank is not None and shard_validation:
+            #each rank validates its share, the trainer combines the results
+            validData = setObj(dirPath=data_dir, split='valid', config=config['validation'])
+            valid_sampler = ShardSampler(validData,num_replicas=world_size,rank=rank)
+            validLoader = torch.utils.data.DataLoader(validData, batch_size=valid_batch_size, shuffle=False, num_workers=numDataWorkers, collate_fn=collateFunc, sampler=valid_sampler)
+        elif rank is None or rank==0:
             validData = setObj(dirPath=data_dir, split='valid', config=config['validation'])
             validLoader = torch.utils.data.DataLoader(validData, batch_size=valid_batch_size, shuffle=shuffleValid, num_workers=numDataWorkers, collate_fn=collateFunc)
         else:
-            validLoads = None #For now, just have the master do the validation loop
+            validLoader = None #just have the master do the validation loop
         return trainLoader, validLoader
     elif split=='test':
         testData = setObj(dirPath=data_dir, split='test', config=config['validation'])
@@ -91,7 +119,8 @@ def withCollate(setObj,collateFunc,batch_size,valid_batch_size,shuffle,shuffleVa
         return testLoader, None
     elif split=='merge' or split=='merged' or split=='train-valid' or split=='train+valid':
         trainData = setObj(dirPath=data_dir, split=['train','valid'], config=config['data_loader'])
-        trainLoader = torch.utils.data.DataLoader(trainData, batch_size=batch_size, shuffle=shuffle, num_workers=numDataWorkers, collate_fn=collateFunc)
+        train_sampler, shuffle = resumableSampler(trainData,shuffle,None,config,rank)
+        trainLoader = torch.utils.data.DataLoader(trainData, batch_size=batch_size, shuffle=shuffle, num_workers=numDataWorkers, collate_fn=collateFunc, sampler=train_sampler)
         validData = setObj(dirPath=data_dir, split=['train','valid'], config=config['validation'])
         validLoader = torch.utils.data.DataLoader(validData, batch_size=valid_batch_size, shuffle=shuffleValid, num_workers=numDataWorkers, collate_fn=collateFunc)
         return trainLoader, validLoader
@@ -0,0 +1,74 @@
+import random
+import torch
+
+#Training sampler whose place can be saved in a checkpoint and restored, so a resumed run sees the same pages
+#in the same order with the same augmentation as if it hadn't stopped.
+#The epoch's order comes from base (a DistributedSampler/CostBalancedSampler, given the epoch with set_epoch)
+#or, without one, a permutation seeded by seed and the epoch; either way it can be made again from the saved
+#state, so each rank remakes its own order on resume. It yields (index, sample seed) and the dataset seeds
+#its random number generators with the sample seed (GraphPairDataset.__getitem__), so the crop and
+#augmentation of a page don't depend on which worker loads it.
+#The loader prefetches, so the trainer tells state_dict() how many samples of the epoch it has actually used.
+
+MAX_SEED = 2**32
+
+class ResumableSampler(torch.utils.data.Sampler):
+    def __init__(self,dataset,shuffle=True,base=None,seed=None):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.base = base
+        self.seed = seed if seed is not None else random.randrange(MAX_SEED) #saved in the checkpoint
+        self.epoch = -1 #incremented when an epoch starts
+        self.resume_position = None
+
+    def _epoch_order(self):
+        if self.base is not None:
+            if hasattr(self.base,'set_epoch'):
+                self.base.set_epoch(self.epoch)
+            return list(iter(self.base))
+        elif self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed+self.epoch)
+            return torch.randperm(len(self.dataset),generator=generator).tolist()
+        else:
+            return list(range(len(self.dataset)))
+
+    def __iter__(self):
+        if self.resume_position is not None:
+            start = self.resume_position
+            self.resume_position = None
+        else:
+            self.epoch += 1
+            start = 0
+        order = self._epoch_order()
+        for position in range(start,len(order)):
+            index = order[position]
+            #ints hash the same in every process
+            yield index, hash((self.seed,self.epoch,position,index))%MAX_SEED
+
+    def __len__(self):
+        return len(self.base) if self.base is not None else len(self.dataset)
+
+    #passed on to a CostBalancedSampler
+    def record(self,name,seconds):
+        if hasattr(self.base,'record'):
+            self.base.record(name,seconds)
+
+    #consumed: how many samples of the current epoch the trainer has used
+    def state_dict(self,consumed):
+        return {
+                'seed': self.seed,
+                'epoch': self.epoch,
+                'position': consumed,
+                'base': self.base.state_dict() if hasattr(self.base,'state_dict') else None,
+                }
+
+    def load_state_dict(self,state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        if self.epoch>=0 and state['position']<len(self):
+            self.resume_position = state['position']
+        else:
+            self.resume_position = None #the epoch was finished, start the next
+        if state['base'] is not None and hasattr(self.base,'load_state_dict'):
+            self.base.load_state_dict(state['base'])
@@ -0,0 +1,16 @@
+import torch
+
+#Every num_replicas-th index starting at rank, in order, without DistributedSampler's padding so no page is
+#counted twice. Used to split validation across the ranks (BaseTrainer._merge_valid_shards combines the results).
+class ShardSampler(torch.utils.data.Sampler):
+    def __init__(self,dataset,num_replicas,rank):
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.sharded = True #tells the trainer to combine the ranks' results
+
+    def __iter__(self):
+        return iter(range(self.rank,len(self.dataset),self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank,len(self.dataset),self.num_replicas))
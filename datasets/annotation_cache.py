@@ -0,0 +1,104 @@
+import numpy as np
+import json
+import os
+import pickle
+import hashlib
+
+#On-disk cache of parsed annotations for GraphPairDataset subclasses.
+#parseAnn is run once per annotation file at scale 1 and the results (bbs, ids, groups, transcriptions,
+#metadata, word boxes and each id's response (pair) list) are saved. The key is a hash of the annotation
+#file's contents and the dataset's parsing parameters, so an edited annotation or a changed parsing option
+#makes a new entry. The bbs arrays are memory-mapped by the workers; each getitem only copies and scales them.
+
+CACHE_VERSION=1
+
+def _atomic_write(path,write_fn):
+    tmp_path = '{}.tmp{}'.format(path,os.getpid())
+    with open(tmp_path,'wb') as f:
+        write_fn(f)
+    os.replace(tmp_path,path) #multiple workers may build the same entry
+
+class AnnotationCache:
+    def __init__(self,cache_dir,dataset):
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir,exist_ok=True)
+        self.dataset = dataset
+        params = {name:getattr(dataset,name,None) for name in dataset.ann_cache_params}
+        self.params_str = '{} {} {}'.format(CACHE_VERSION,type(dataset).__name__,json.dumps(params,sort_keys=True,default=str))
+        self.keys={} #annotationPath: (mtime,size,key)
+        self.entries={} #key: loaded entry
+
+    def _key(self,annotationPath):
+        stat = os.stat(annotationPath)
+        if annotationPath in self.keys:
+            mtime,size,key = self.keys[annotationPath]
+            if mtime==stat.st_mtime and size==stat.st_size:
+                return key, None
+        with open(annotationPath,'rb') as f:
+            content = f.read()
+        h = hashlib.sha1(content)
+        h.update(self.params_str.encode('utf-8'))
+        key = h.hexdigest()
+        self.keys[annotationPath] = (stat.st_mtime,stat.st_size,key)
+        return key, content
+
+    def _build(self,key,content,annotationPath):
+        if content is None:
+            with open(annotationPath) as annFile:
+                content = annFile.read()
+        annotations = json.loads(content)
+        bbs,ids,numClasses,trans,groups,metadata,form_metadata = self.dataset.parseAnn(annotations,1.0)
+        responses = {id:self.dataset.getResponseBBIdList(id,annotations) for id in ids}
+        form_metadata = dict(form_metadata)
+        word_boxes = form_metadata.pop('word_boxes',None)
+
+        base = os.path.join(self.cache_dir,key)
+        _atomic_write(base+'_bbs.npy', lambda f: np.save(f,np.ascontiguousarray(bbs,dtype=np.float32)))
+        if word_boxes is not None:
+            _atomic_write(base+'_words.npy', lambda f: np.save(f,np.asarray(word_boxes,dtype=np.float64)))
+        info = {
+                'ids':ids,
+                'numClasses':numClasses,
+                'trans':trans,
+                'groups':groups,
+                'metadata':metadata,
+                'form_metadata':form_metadata,
+                'has_words':word_boxes is not None,
+                'responses':responses,
+                }
+        #written last, it marks the entry as complete
+        _atomic_write(base+'.pkl', lambda f: pickle.dump(info,f,protocol=pickle.HIGHEST_PROTOCOL))
+
+    def _load(self,key):
+        base = os.path.join(self.cache_dir,key)
+        with open(base+'.pkl','rb') as f:
+            entry = pickle.load(f)
+        entry['bbs'] = np.load(base+'_bbs.npy',mmap_mode='r')
+        if entry['has_words']:
+            entry['word_boxes'] = np.load(base+'_words.npy',mmap_mode='r')
+        return entry
+
+    #Returns what parseAnn(annotations,s) does, and the response id list of each id
+    def get(self,annotationPath,s):
+        key, content = self._key(annotationPath)
+        if key not in self.entries:
+            if not os.path.exists(os.path.join(self.cache_dir,key+'.pkl')):
+                self._build(key,content,annotationPath)
+            self.entries[key] = self._load(key)
+        entry = self.entries[key]
+
+        bbs = np.array(entry['bbs']) #copy out of the mmap
+        bbs[:,:,:16]*=s #corners and cross-points, the rest is class
+        form_metadata = dict(entry['form_metadata'])
+        if entry['has_words']:
+            form_metadata['word_boxes'] = np.array(entry['word_boxes'])*s
+        #the getitem and crop may alter these
+        ids = list(entry['ids'])
+        trans = entry['trans'].copy()
+        groups = [list(group) for group in entry['groups']]
+        metadata = dict(entry['metadata'])
+        for name in form_metadata:
+            if type(form_metadata[name]) is list:
+                form_metadata[name] = list(form_metadata[name])
+        return bbs,ids,entry['numClasses'],trans,groups,metadata,form_metadata, entry['responses']
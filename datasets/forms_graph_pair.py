@@ -166,6 +166,8 @@ class FormsGraphPair(GraphPairDataset):
         if self.use_paired_class:
             self.classMap['paired']=15+len(self.useClasses) + (0 if self.no_blanks else 1)
 
+        self.ann_cache_params += ['swapCircle','no_blanks','use_paired_class','no_print_fields','no_graphics','only_opposite_pairs','group_only_same','no_groups','onlyFormStuff','useClasses']
+
 
 
 
@@ -31,6 +31,7 @@ class FUNSDGraphPair(GraphPairDataset):
         self.only_types=None
 
         self.split_to_lines = config['split_to_lines']
+        self.ann_cache_params += ['split_to_lines']
 
         if images is not None:
             self.images=images
@@ -11,6 +11,8 @@ from utils import augmentation
 from collections import defaultdict, OrderedDict
 from utils.forms_annotations import fixAnnotations, convertBBs, getBBWithPoints, getStartEndGT
 import timeit
+from .annotation_cache import AnnotationCache
+from .image_store import ImageStore
 
 import utils.img_f as img_f
 
@@ -33,6 +35,10 @@ class GraphPairDataset(torch.utils.data.Dataset):
             self.transform = CropBoxTransform(config['crop_params'],self.rotate)
         else:
             self.transform = None
+        #leave the rotation/crop warp and brightness pixel work to the trainer (utils/gpu_augmentation.py)
+        self.gpu_augmentation = config['gpu_augmentation'] if 'gpu_augmentation' in config else False
+        if self.gpu_augmentation and self.transform is not None:
+            self.transform.defer_warp = True
         self.rescale_range = config['rescale_range']
         if type(self.rescale_range) is float:
             self.rescale_range = [self.rescale_range,self.rescale_range]
@@ -46,6 +52,23 @@ class GraphPairDataset(torch.utils.data.Dataset):
             self.cache_resized = False
         self.aug_params = config['additional_aug_params'] if 'additional_aug_params' in config else {}
 
+        #cache the parsed annotations on disk (True for a directory in the dataset dir, or a path)
+        self.ann_cache_dir = config['annotation_cache'] if 'annotation_cache' in config else None
+        if self.ann_cache_dir is True:
+            self.ann_cache_dir = os.path.join(dirPath,'annotation_cache')
+        elif not self.ann_cache_dir:
+            self.ann_cache_dir = None
+        self.ann_cache = None #made when first used, so each worker has its own
+        #attributes that change what parseAnn produces, subclasses add theirs
+        self.ann_cache_params = ['rotate']
+
+        #read decoded pages from a memory-mapped store made by pack_images.py, instead of decoding the PNGs
+        if 'image_store' in config and config['image_store'] is not None:
+            self.image_store = ImageStore(config['image_store'])
+            assert self.image_store.color==self.color, 'image_store was packed with color={}'.format(self.image_store.color)
+        else:
+            self.image_store = None
+
 
         self.pixel_count_thresh = config['pixel_count_thresh'] if 'pixel_count_thresh' in config else 10000000
         self.max_dim_thresh = config['max_dim_thresh'] if 'max_dim_thresh' in config else 2700
@@ -58,20 +81,35 @@ class GraphPairDataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.images)
 
+    #rough relative cost of training on a page, for balancing DDP ranks (the annotation size grows with the number of boxes)
+    def page_cost(self,index):
+        return os.path.getsize(self.images[index]['annotationPath'])
+
     def __getitem__(self,index):
+        if type(index) is tuple:
+            #(index, seed) from data_loader.resumable_sampler.ResumableSampler, so the page's crop and augmentation are reproducible
+            index, seed = index
+            random.seed(seed)
+            np.random.seed(seed)
+            torch.manual_seed(seed)
         return self.getitem(index)
     def getitem(self,index,scaleP=None,cropPoint=None):
         imagePath = self.images[index]['imagePath']
         imageName = self.images[index]['imageName']
         annotationPath = self.images[index]['annotationPath']
         rescaled = self.images[index]['rescaled']
-        with open(annotationPath) as annFile:
-            annotations = json.loads(annFile.read())
+        annotations = None #not read when the annotation cache has the parse (and responses)
+        if self.ann_cache_dir is None:
+            with open(annotationPath) as annFile:
+                annotations = json.loads(annFile.read())
     
         #Read image
-        np_img = img_f.imread(imagePath, 1 if self.color else 0)#*255.0
-        if np_img.max()<200:
-            np_img*=255
+        if self.image_store is not None and imagePath in self.image_store:
+            np_img = self.image_store.get(imagePath) #read-only uint8 view, already scaled to 255
+        else:
+            np_img = img_f.imread(imagePath, 1 if self.color else 0)#*255.0
+            if np_img.max()<200:
+                np_img*=255
         if np_img is None or np_img.shape[0]==0:
             print("ERROR, could not open "+imagePath)
             return self.__getitem__((index+1)%self.__len__())
@@ -106,10 +144,17 @@ class GraphPairDataset(torch.utils.data.Dataset):
         if self.color and np_img.shape[2]==1:
             np_img = np.repeat(np_img,3,axis=2)
 
-        bbs,ids,numClasses,trans, groups, metadata, form_metadata = self.parseAnn(annotations,s)
+        if self.ann_cache_dir is not None:
+            if self.ann_cache is None:
+                self.ann_cache = AnnotationCache(self.ann_cache_dir,self)
+            bbs,ids,numClasses,trans, groups, metadata, form_metadata, responses = self.ann_cache.get(annotationPath,s)
+        else:
+            bbs,ids,numClasses,trans, groups, metadata, form_metadata = self.parseAnn(annotations,s)
+            responses = None
 
 
 
+        gpu_aug = None
         if self.transform is not None:
             if 'word_boxes' in form_metadata:
                 word_bbs = form_metadata['word_boxes']
@@ -149,32 +194,21 @@ class GraphPairDataset(torch.utils.data.Dataset):
                 bbs = out['bb_gt']
                 ids= out['bb_auxs'] 
 
-            if np_img.shape[2]==3:
-                np_img = augmentation.apply_random_color_rotation(np_img)
-                np_img = augmentation.apply_tensmeyer_brightness(np_img,**self.aug_params)
+            #the augmentation functions make their own RandomState, seed it from np.random so a seeded page is reproducible
+            aug_params = {'random_seed':np.random.randint(2**31), **self.aug_params}
+            if out['warp'] is not None:
+                #np_img is still the whole page. The color rotation is left out, as it adds a whole number to the hue, which doesn't change it
+                gpu_aug = out['warp']
+                gpu_aug['brightness'] = augmentation.sample_tensmeyer_brightness(**aug_params)
+            elif np_img.shape[2]==3:
+                np_img = augmentation.apply_random_color_rotation(np_img,random_seed=np.random.randint(2**31))
+                np_img = augmentation.apply_tensmeyer_brightness(np_img,**aug_params)
             else:
-                np_img = augmentation.apply_tensmeyer_brightness(np_img,**self.aug_params)
+                np_img = augmentation.apply_tensmeyer_brightness(np_img,**aug_params)
 
 
 
-        newGroups = []
-        for group in groups:
-            newGroup=[ids.index(bbId) for bbId in group if bbId in ids]
-            if len(newGroup)>0:
-                newGroups.append(newGroup)
-        groups=newGroups
-        pairs=set()
-        numNeighbors=[0]*len(ids)
-        for index1,id in enumerate(ids): #updated
-            responseBBIdList = self.getResponseBBIdList(id,annotations)
-            for bbId in responseBBIdList:
-                try:
-                    index2 = ids.index(bbId)
-                    #adjMatrix[min(index1,index2),max(index1,index2)]=1
-                    pairs.add((min(index1,index2),max(index1,index2)))
-                    numNeighbors[index1]+=1
-                except ValueError:
-                    pass
+        groups,pairs,numNeighbors = self.getGTPairs(ids,groups,annotations,responses)
         img = np_img.transpose([2,0,1])[None,...] #from [row,col,color] to [batch,color,row,col]
         img = img.astype(np.float32)
         img = torch.from_numpy(img)
@@ -188,28 +222,10 @@ class GraphPairDataset(torch.utils.data.Dataset):
         else:
             numNeighbors=None
 
-        groups_adj = set()
-        if groups is not None:
-            for n0,n1 in pairs:
-                g0=-1
-                g1=-1
-                for i,ns in enumerate(groups):
-                    if n0 in ns:
-                        g0=i
-                        if g1!=-1:
-                            break
-                    if n1 in ns:
-                        g1=i
-                        if g0!=-1:
-                            break
-                if g0!=g1:
-                    groups_adj.add((min(g0,g1),max(g0,g1)))
-            for group in groups:
-                for i in group:
-                    assert(i<bbs.shape[1])
-            targetIndexToGroup={}
-            for groupId,bbIds in enumerate(groups):
-                targetIndexToGroup.update({bbId:groupId for bbId in bbIds})
+        groups_adj,targetIndexToGroup = self.getGroupsAdj(groups,pairs,len(ids))
+        for group in groups:
+            for i in group:
+                assert(i<bbs.shape[1])
         
         transcription = [trans[id] for id in ids]
 
@@ -227,6 +243,52 @@ class GraphPairDataset(torch.utils.data.Dataset):
                 "gt_groups": groups,
                 "targetIndexToGroup":targetIndexToGroup,
                 "gt_groups_adj": groups_adj,
+                "gpu_aug": gpu_aug,
                 }
 
+    def getGTPairs(self,ids,groups,annotations,responses=None):
+        "Maps the groups' ids to indexes into ids and finds the GT pairs (as index tuples, low first) and each box's neighbor count"
+        idToIndex={}
+        for index,bbId in enumerate(ids):
+            if bbId not in idToIndex: #first, as ids.index()
+                idToIndex[bbId]=index
+        newGroups = []
+        for group in groups:
+            newGroup=[idToIndex[bbId] for bbId in group if bbId in idToIndex]
+            if len(newGroup)>0:
+                newGroups.append(newGroup)
+        groups=newGroups
+        pairs=set()
+        numNeighbors=[0]*len(ids)
+        for index1,id in enumerate(ids): #updated
+            if responses is not None:
+                responseBBIdList = responses[id]
+            else:
+                responseBBIdList = self.getResponseBBIdList(id,annotations)
+            for bbId in responseBBIdList:
+                if bbId in idToIndex:
+                    index2 = idToIndex[bbId]
+                    #adjMatrix[min(index1,index2),max(index1,index2)]=1
+                    pairs.add((min(index1,index2),max(index1,index2)))
+                    numNeighbors[index1]+=1
+        return groups,pairs,numNeighbors
+
+    def getGroupsAdj(self,groups,pairs,num_bbs):
+        "Group pairs that have a GT pair between them, and the group of each box index"
+        groups_adj = set()
+        groupOfIndex=[-1]*num_bbs #first group each box is in (groups don't overlap)
+        for groupId,bbIds in enumerate(groups):
+            for bbId in bbIds:
+                if groupOfIndex[bbId]==-1:
+                    groupOfIndex[bbId]=groupId
+        for n0,n1 in pairs:
+            g0=groupOfIndex[n0]
+            g1=groupOfIndex[n1]
+            if g0!=g1:
+                groups_adj.add((min(g0,g1),max(g0,g1)))
+        targetIndexToGroup={}
+        for groupId,bbIds in enumerate(groups):
+            targetIndexToGroup.update({bbId:groupId for bbId in bbIds})
+        return groups_adj,targetIndexToGroup
+
 
@@ -0,0 +1,58 @@
+import numpy as np
+import json
+import os
+import utils.img_f as img_f
+
+#A single file of decoded uint8 page images with a JSON index ({key: [offset,shape]}), made with pack_images.py
+#Workers memory-map the file and get a read-only view of a page, so no PNG decoding is done while training.
+
+def read_page(path,color):
+    #the same as GraphPairDataset's read, but as uint8
+    np_img = img_f.imread(path, 1 if color else 0)
+    if np_img is None or np_img.shape[0]==0:
+        return None
+    if np_img.max()<200:
+        np_img=np_img*255
+    if np_img.dtype!=np.uint8:
+        np_img = np.clip(np.round(np_img),0,255).astype(np.uint8)
+    return np_img
+
+def pack_images(paths,out_path,color):
+    index={}
+    offset=0
+    with open(out_path,'wb') as out:
+        for i,path in enumerate(paths):
+            if path in index:
+                continue
+            np_img = read_page(path,color)
+            if np_img is None:
+                print('WARNING, could not read {}'.format(path))
+                continue
+            np_img = np.ascontiguousarray(np_img)
+            out.write(np_img.tobytes())
+            index[path] = [offset,list(np_img.shape)]
+            offset+=np_img.nbytes
+            if i%100==0:
+                print('packed {}/{}'.format(i,len(paths)),end='\r')
+    with open(out_path+'.json','w') as f:
+        json.dump({'color':color,'size':offset,'images':index},f)
+    print('packed {} images ({} bytes) to {}'.format(len(index),offset,out_path))
+
+class ImageStore:
+    def __init__(self,store_path):
+        self.store_path=store_path
+        with open(store_path+'.json') as f:
+            info = json.load(f)
+        self.color = info['color']
+        self.index = info['images']
+        self.data = None #memory-mapped when first read, so each worker maps its own
+
+    def __contains__(self,key):
+        return key in self.index
+
+    def get(self,key):
+        if self.data is None:
+            self.data = np.memmap(self.store_path,dtype=np.uint8,mode='r')
+        offset,shape = self.index[key]
+        size = int(np.prod(shape))
+        return self.data[offset:offset+size].reshape(shape)
@@ -0,0 +1,93 @@
+from data_loader import getDataLoader
+import json
+import sys
+
+#Checks GraphPairDataset.getGTPairs and getGroupsAdj against the original ids.index()/group scan code,
+#on every page of each split (adj, num_neighbors, gt_groups, gt_groups_adj and targetIndexToGroup),
+#with and without the annotation cache.
+#   python -m datasets.testgraph_pair_adj config.json [annotation cache dir]
+
+def gt_pairs_old(data,ids,groups,annotations,responses):
+    newGroups = []
+    for group in groups:
+        newGroup=[ids.index(bbId) for bbId in group if bbId in ids]
+        if len(newGroup)>0:
+            newGroups.append(newGroup)
+    groups=newGroups
+    pairs=set()
+    numNeighbors=[0]*len(ids)
+    for index1,id in enumerate(ids):
+        if responses is not None:
+            responseBBIdList = responses[id]
+        else:
+            responseBBIdList = data.getResponseBBIdList(id,annotations)
+        for bbId in responseBBIdList:
+            try:
+                index2 = ids.index(bbId)
+                pairs.add((min(index1,index2),max(index1,index2)))
+                numNeighbors[index1]+=1
+            except ValueError:
+                pass
+    return groups,pairs,numNeighbors
+
+def groups_adj_old(groups,pairs):
+    groups_adj = set()
+    for n0,n1 in pairs:
+        g0=-1
+        g1=-1
+        for i,ns in enumerate(groups):
+            if n0 in ns:
+                g0=i
+                if g1!=-1:
+                    break
+            if n1 in ns:
+                g1=i
+                if g0!=-1:
+                    break
+        if g0!=g1:
+            groups_adj.add((min(g0,g1),max(g0,g1)))
+    targetIndexToGroup={}
+    for groupId,bbIds in enumerate(groups):
+        targetIndexToGroup.update({bbId:groupId for bbId in bbIds})
+    return groups_adj,targetIndexToGroup
+
+def check(data,name):
+    get_gt_pairs = data.getGTPairs
+    get_groups_adj = data.getGroupsAdj
+    page = [None]
+    def checked_gt_pairs(ids,groups,annotations,responses=None):
+        new = get_gt_pairs(ids,groups,annotations,responses)
+        old = gt_pairs_old(data,ids,groups,annotations,responses)
+        for what,n,o in zip(['gt_groups','adj','num_neighbors'],new,old):
+            assert n==o, '{} page {}: {} differs from the original code'.format(name,page[0],what)
+        return new
+    def checked_groups_adj(groups,pairs,num_bbs):
+        new = get_groups_adj(groups,pairs,num_bbs)
+        old = groups_adj_old(groups,pairs)
+        for what,n,o in zip(['gt_groups_adj','targetIndexToGroup'],new,old):
+            assert n==o, '{} page {}: {} differs from the original code'.format(name,page[0],what)
+        return new
+    data.getGTPairs = checked_gt_pairs
+    data.getGroupsAdj = checked_groups_adj
+    for index in range(len(data)):
+        page[0] = index
+        data[index]
+    print('{}: {} pages ok'.format(name,len(data)))
+
+def check_splits(config,name):
+    train_loader, valid_loader = getDataLoader(config,'train')
+    check(train_loader.dataset,name+'train')
+    check(valid_loader.dataset,name+'valid')
+    test_loader, _ = getDataLoader(config,'test')
+    check(test_loader.dataset,name+'test')
+
+if __name__ == "__main__":
+    config = json.load(open(sys.argv[1]))
+    cache_dir = sys.argv[2] if len(sys.argv)>2 else True
+    for section in ['data_loader','validation']:
+        config[section]['annotation_cache'] = False
+    check_splits(config,'')
+    for section in ['data_loader','validation']:
+        config[section]['annotation_cache'] = cache_dir
+    check_splits(config,'annotation cache, ')
+    check_splits(config,'annotation cache (filled), ') #second pass reads what the first wrote
@@ -0,0 +1,41 @@
+from data_loader import getDataLoader
+import json
+import sys
+import numpy as np
+import torch
+
+#Checks that a seeded page, (index, seed) as given by data_loader.resumable_sampler.ResumableSampler,
+#comes out the same each time it's loaded (crop, scale, brightness and color augmentation).
+#   python -m datasets.testgraph_pair_repro config.json [pages per split]
+
+def same(a,b):
+    if torch.is_tensor(a):
+        return torch.is_tensor(b) and a.shape==b.shape and torch.equal(a,b)
+    elif isinstance(a,np.ndarray):
+        return isinstance(b,np.ndarray) and a.shape==b.shape and np.array_equal(a,b)
+    elif isinstance(a,dict):
+        return isinstance(b,dict) and a.keys()==b.keys() and all(same(a[k],b[k]) for k in a)
+    elif isinstance(a,(list,tuple)):
+        return isinstance(b,(list,tuple)) and len(a)==len(b) and all(same(x,y) for x,y in zip(a,b))
+    else:
+        return a==b
+
+def check(data,name,num_pages):
+    for index in range(min(num_pages,len(data))):
+        seed = 1000+index
+        first = data[(index,seed)]
+        second = data[(index,seed)]
+        for key in first:
+            assert same(first[key],second[key]), '{} page {}: {} differs between loads with the same seed'.format(name,index,key)
+        if data.transform is not None:
+            other = data[(index,seed+1)]
+            if same(first['img'],other['img']):
+                print('{} page {}: a different seed gave the same image'.format(name,index))
+    print('{}: {} pages ok'.format(name,min(num_pages,len(data))))
+
+if __name__ == "__main__":
+    config = json.load(open(sys.argv[1]))
+    num_pages = int(sys.argv[2]) if len(sys.argv)>2 else 20
+    train_loader, valid_loader = getDataLoader(config,'train')
+    check(train_loader.dataset,'train',num_pages)
+    check(valid_loader.dataset,'valid',num_pages)
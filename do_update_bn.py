@@ -32,10 +32,10 @@ def set_procname(newname):
         libc.prctl(15, byref(buff), 0, 0, 0) #Refer to "#define" of "/usr/include/linux/prctl.h" for the misterious value 16 & arg[3..5] are zero as the man page says.
 
 @slack_sender(webhook_url=webhook_url, channel="herding-neural-networks")
-def notify_main(config, resume):
-    main(config, resume)
+def notify_main(config, resume, num_samples=None):
+    main(config, resume, num_samples)
 
-def main(config, resume):
+def main(config, resume, num_samples=None):
     supercomputer = config['super_computer'] if 'super_computer' in config else False
     #np.random.seed(1234) I don't have a way of restarting the DataLoader at the same place, so this makes it totaly random
     train_logger = Logger()
@@ -79,7 +79,8 @@ def main(config, resume):
     if config['trainer']['class']=='HWRWithSynthTrainer':
         trainer.gen = gen_model
 
-    trainer.update_swa_batch_norm()
+    seconds = trainer.update_swa_batch_norm(num_samples)
+    print('Updated batch norm statistics in {:.1f} sec'.format(seconds))
     trainer.save()
 
 
@@ -95,6 +96,8 @@ if __name__ == '__main__':
                         help='path to checkpoint that may or may not exist (default: None)')
     parser.add_argument('-g', '--gpu', default=None, type=int,
                         help='gpu to use (overrides config) (default: None)')
+    parser.add_argument('-n', '--num_samples', default=None, type=int,
+                        help='number of random training pages to compute the statistics from (default: all)')
     parser.add_argument('-S', '--supercomputer', default=False, action='store_const', const=True,
                         help='This is on the supercomputer')
     #parser.add_argument('-m', '--merged', default=False, action='store_const', const=True,
@@ -145,11 +148,11 @@ if __name__ == '__main__':
     if config['cuda']:
         with torch.cuda.device(config['gpu']):
             if not supercomputer and webhook_url is not None:
-                notify_main(config, args.resume)
+                notify_main(config, args.resume, args.num_samples)
             else:
-                main(config, args.resume)
+                main(config, args.resume, args.num_samples)
     else:
         if not supercomputer and webhook_url is not None:
-            notify_main(config, args.resume)
+            notify_main(config, args.resume, args.num_samples)
         else:
-            main(config, args.resume)
+            main(config, args.resume, args.num_samples)
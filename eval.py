@@ -9,9 +9,12 @@ from logger import Logger
 from trainer import *
 from data_loader import getDataLoader
 from evaluators import *
+from model.cpu_inference import convert_for_cpu, CPU_MODES
+from model.inference_rewriter import rewrite_for_inference
 import math
 from collections import defaultdict
 import pickle
+import timeit
 #import requests
 import warnings
 import numpy as np
@@ -45,7 +48,7 @@ def save_style(location,volume,styles,authors,ids=None,doIds=False, spaced=None,
 
 
 
-def main(resume,saveDir,numberOfImages,index,gpu=None, shuffle=False, setBatch=None, config=None, thresh=None, addToConfig=None, test=False, toEval=None,verbosity=2, do_train=False, use_train_model=False):
+def main(resume,saveDir,numberOfImages,index,gpu=None, shuffle=False, setBatch=None, config=None, thresh=None, addToConfig=None, test=False, toEval=None,verbosity=2, do_train=False, use_train_model=False, cpu_inference=None, rewrite=False):
     np.random.seed(1234)
     torch.manual_seed(1234)
     if resume is not None:
@@ -165,6 +168,13 @@ def main(resume,saveDir,numberOfImages,index,gpu=None, shuffle=False, setBatch=N
             model = eval(config['arch'])(config['model'])
             if 'style' in config['model'] and 'lookup' in config['model']['style']:
                 model.style_extractor.add_authors(data_loader.dataset.authors) ##HERE
+            if 'inference_rewritten' in checkpoint and checkpoint['inference_rewritten']:
+                rewrite_for_inference(model,verify=False) #match the saved structure (folded BN)
+            if 'cpu_inference' in checkpoint:
+                #saved by make_cpu_model.py, the model needs converted before loading
+                assert gpu is None, 'converted CPU models can only run on the CPU'
+                convert_for_cpu(model,checkpoint['cpu_inference'])
+                print('Loaded {} CPU inference model'.format(checkpoint['cpu_inference']))
             model.load_state_dict(checkpoint['state_dict'])
         elif 'swa_model' in checkpoint:
             model = checkpoint['swa_model']
@@ -173,6 +183,16 @@ def main(resume,saveDir,numberOfImages,index,gpu=None, shuffle=False, setBatch=N
     else:
         model = eval(config['arch'])(config['model'])
 
+    if rewrite:
+        assert not use_train_model
+        example = valid_data_loader.dataset[0]['img'] #a real page to compare the detector's output on
+        rewrite_for_inference(model,channels_last=gpu is not None,example=example)
+
+    if cpu_inference is not None:
+        assert gpu is None, 'cpu_inference is for CPU only'
+        convert_for_cpu(model,cpu_inference)
+        print('Converted model for {} CPU inference'.format(cpu_inference))
+
     if use_train_model:
         model.train()
     else:
@@ -301,6 +321,7 @@ def main(resume,saveDir,numberOfImages,index,gpu=None, shuffle=False, setBatch=N
                     saveStyleValLoc = 'val_'+saveStyleLoc
 
             validName='valid' if not test else 'test'
+            valid_times=[] #seconds per (valid) batch, to compare throughput
 
             startBatch = config['startBatch'] if 'startBatch' in config else 0
             numberOfBatches = numberOfImages//batchSize
@@ -324,7 +345,12 @@ def main(resume,saveDir,numberOfImages,index,gpu=None, shuffle=False, setBatch=N
                         #output = output.cpu().data.numpy()
                         #target = target.data.numpy()
                         #metricsO = _eval_metrics_ind(metrics,output, target)
-                        metricsO,aux = saveFunc(config,valid_iter.next(),trainer,metrics,validDir,batch*vBatchSize,toEval=toEval)
+                        instance = valid_iter.next()
+                        tic=timeit.default_timer()
+                        metricsO,aux = saveFunc(config,instance,trainer,metrics,validDir,batch*vBatchSize,toEval=toEval)
+                        valid_times.append(timeit.default_timer()-tic)
+                        if hasattr(trainer,'profiler'):
+                            trainer.profiler.step(instance['imgName'])
                         if type(metricsO) == dict:
                             for typ,typeLists in metricsO.items():
                                 if type(typeLists) == dict:
@@ -373,7 +399,10 @@ def main(resume,saveDir,numberOfImages,index,gpu=None, shuffle=False, setBatch=N
                             #output = output.cpu().data.numpy()
                             #target = target.data.numpy()
                             #metricsO = _eval_metrics_ind(metrics,output, target)
-                            _,aux=saveFunc(config,train_iter.next(),trainer,metrics,trainDir,batch*batchSize,toEval=toEval)
+                            instance = train_iter.next()
+                            _,aux=saveFunc(config,instance,trainer,metrics,trainDir,batch*batchSize,toEval=toEval)
+                            if hasattr(trainer,'profiler'):
+                                trainer.profiler.step(instance['imgName'])
                             if 'save_nns' in config:
                                 nns+=aux[-1]
                             if 'save_spaced' in config:
@@ -401,7 +430,11 @@ def main(resume,saveDir,numberOfImages,index,gpu=None, shuffle=False, setBatch=N
                     if verbosity>0:
                         print('{} batch index: {}\{} (not save)   '.format(validName,vi,len(valid_data_loader)),end='\r')
                     instance = valid_iter.next()
+                    tic=timeit.default_timer()
                     metricsO,aux = saveFunc(config,instance,trainer,metrics,toEval=toEval)
+                    valid_times.append(timeit.default_timer()-tic)
+                    if hasattr(trainer,'profiler'):
+                        trainer.profiler.step(instance['imgName'])
                     if type(metricsO) == dict:
                         for typ,typeLists in metricsO.items():
                             if type(typeLists) == dict:
@@ -446,6 +479,13 @@ def main(resume,saveDir,numberOfImages,index,gpu=None, shuffle=False, setBatch=N
                 rel_BROS_TP=None
                 group_TP = None
                 print('{} metrics'.format(validName))
+                if len(valid_times)>0:
+                    print('throughput: {:.3f} sec per batch ({:.3f} batches per sec) over {} batches'.format(np.mean(valid_times),len(valid_times)/sum(valid_times),len(valid_times)))
+                if hasattr(trainer,'profiler') and trainer.profiler.enabled:
+                    print(trainer.profiler.summary_str())
+                    if trainer.profiler.memory is not None:
+                        trainer.profiler.memory.write_report(trainer.memory_report_path)
+                        print('memory report written to {}'.format(trainer.memory_report_path))
                 for i in range(len(metrics)):
                     print(metrics[i].__name__ + ': '+str(val_metrics_sum[i]))
                 for typ in val_comb_metrics:
@@ -604,6 +644,10 @@ if __name__ == '__main__':
                         help='send messages to server, name')
     parser.add_argument('-v', '--verbosity', default=2, type=int,
                         help='How much stuff to print [0,1,2] (default: 2)')
+    parser.add_argument('-R', '--rewrite', default=False, action='store_const', const=True,
+                        help='fold BatchNorm into convs, remove dropout (and use channels_last on GPU) before evaluating')
+    parser.add_argument('-q', '--cpu_inference', default=None, type=str, choices=CPU_MODES,
+                        help='convert the model for CPU inference: int8 (dynamic quantization of graph Linears) or bf16 (autocast)')
     parser.add_argument('-e', '--eval', default=None, type=str,
             help='what to evaluate (print) list: "pred"=hwr prediction, "recon"=reconstruction using predicted mask, "recon_gt_mask"=reconstruction using GT mask, "mask"=generated mask for reconstruction "gen"=image generated from interpolated styles, "gen_mask"=mask generated for generated image')
     #parser.add_argument('-E', '--special_eval', default=None, type=str,
@@ -641,9 +685,9 @@ if __name__ == '__main__':
     try:
         if args.gpu is not None:
             with torch.cuda.device(args.gpu):
-                main(args.checkpoint, args.savedir, args.number, index, gpu=args.gpu, shuffle=args.shuffle, setBatch=args.batchsize, config=args.config, thresh=args.thresh, addToConfig=addtoconfig,test=args.test,toEval=toEval,verbosity=args.verbosity,do_train=args.do_train,use_train_model=args.use_train_model)
+                main(args.checkpoint, args.savedir, args.number, index, gpu=args.gpu, shuffle=args.shuffle, setBatch=args.batchsize, config=args.config, thresh=args.thresh, addToConfig=addtoconfig,test=args.test,toEval=toEval,verbosity=args.verbosity,do_train=args.do_train,use_train_model=args.use_train_model,cpu_inference=args.cpu_inference,rewrite=args.rewrite)
         else:
-            main(args.checkpoint, args.savedir, args.number, index, gpu=args.gpu, shuffle=args.shuffle, setBatch=args.batchsize, config=args.config, thresh=args.thresh, addToConfig=addtoconfig,test=args.test,toEval=toEval,verbosity=args.verbosity,do_train=args.do_train,use_train_model=args.use_train_model)
+            main(args.checkpoint, args.savedir, args.number, index, gpu=args.gpu, shuffle=args.shuffle, setBatch=args.batchsize, config=args.config, thresh=args.thresh, addToConfig=addtoconfig,test=args.test,toEval=toEval,verbosity=args.verbosity,do_train=args.do_train,use_train_model=args.use_train_model,cpu_inference=args.cpu_inference,rewrite=args.rewrite)
     except Exception as er:
         if len(args.notify)>0:
             update_status(name,er)
@@ -14,6 +14,7 @@ from model.optimize import optimizeRelationships, optimizeRelationshipsSoft
 import json
 from utils.forms_annotations import fixAnnotations, getBBInfo
 from evaluators.draw_graph import draw_graph
+from model.attention import MultiHeadedAttention
 
 
 
@@ -54,6 +55,9 @@ def FUNSDGraphPair_eval(config,instance, trainer, metrics, outDir=None, startInd
                 gn.trackAtt=True
         else:
             trainer.model.pairer.trackAtt=True
+        for m in trainer.model.modules():
+            if isinstance(m,MultiHeadedAttention):
+                m.need_weights=True #fused attention doesn't give the weights
     if 'repetitions' in config:
         trainer.model.pairer.repetitions=config['repetitions']
     pretty = config['pretty'] if 'pretty' in config else False
@@ -189,7 +193,7 @@ def FUNSDGraphPair_eval(config,instance, trainer, metrics, outDir=None, startInd
                  }
     else:
         retData={}
-    keep_prefixes=['final_bb_all','final_group','final_rel','prop_rel','DocStruct','F-M','prec@','recall@','bb_Fm','bb_recall','bb_prec','ED_']
+    keep_prefixes=['final_bb_all','final_group','final_rel','prop_rel','DocStruct','F-M','prec@','recall@','bb_Fm','bb_recall','bb_prec','ED_','graph_iterations']
     for key,value in log.items():
         if trainer.mergeAndGroup:
             for prefix in keep_prefixes:
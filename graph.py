@@ -4,16 +4,17 @@ import signal
 import json
 import logging
 import argparse
-import torch
 from collections import defaultdict
 import numpy as np
+from logger.logger import read_log
 
 logging.basicConfig(level=logging.INFO, format='')
 
 
-def graph(log,plot=True,substring=None):
+#entries: iterable of log entries (dicts with 'iteration')
+def graph(entries,plot=True,substring=None):
     graphs=defaultdict(lambda:{'iters':[], 'values':[]})
-    for index, entry in log.entries.items():
+    for entry in entries:
         iteration = entry['iteration']
         for metric, value in entry.items():
             if metric!='iteration':
@@ -68,37 +69,47 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='PyTorch Template')
     parser.add_argument('-c', '--checkpoint', default='../..//Downloads/export.pth', type=str,
-                        help='checkpoint file path (default: None)')
+                        help='checkpoint file path, or a log.jsonl (default: None)')
     parser.add_argument('-p', '--plot', default=1, type=int,
                         help='plot (default: True)')
     parser.add_argument('-o', '--only', default=None, type=str,
                         help='only stats with all these substrings (default: None)')
     parser.add_argument('-e', '--extract', default=None, type=str,
-                        help='instead of ploting, save a new file with only the log (default: None)')
+                        help='instead of ploting, save a new JSONL file with only the log (default: None)')
+    parser.add_argument('-d', '--downsample', default=1, type=int,
+                        help='only use every Nth value of each metric (default: 1)')
     parser.add_argument('-C', '--printconfig', default=False, type=bool,
                         help='print config (defaut False')
 
     args = parser.parse_args()
 
     assert args.checkpoint is not None
-    saved = torch.load(args.checkpoint,map_location=lambda storage, loc: storage)
-    log = saved['logger']
-    iteration = saved['iteration']
-    print('loaded iteration {}'.format(iteration))
-
-    if args.printconfig:
-        print(saved['config'])
-        exit()
-
-    saved=None
+    if args.checkpoint.endswith('.jsonl'):
+        entries = read_log(args.checkpoint,args.downsample)
+    else:
+        import torch
+        saved = torch.load(args.checkpoint,map_location=lambda storage, loc: storage)
+        iteration = saved['iteration']
+        print('loaded iteration {}'.format(iteration))
+
+        if args.printconfig:
+            print(saved['config'])
+            exit()
+
+        if 'logger' in saved:
+            #older checkpoint with the log in it
+            entries = [saved['logger'].entries[index] for index in sorted(saved['logger'].entries)]
+            entries = entries[::args.downsample]
+        else:
+            #the whole log (it may be past the checkpoint's iteration)
+            entries = read_log(os.path.join(os.path.dirname(args.checkpoint),'log.jsonl'),args.downsample)
+        saved=None
 
     if args.extract is None:
-        graph(log,args.plot,args.only)
+        graph(entries,args.plot,args.only)
     else:
-        new_save = {
-                'iteration': iteration,
-                'logger': log
-                }
         new_file = args.extract #args.checkpoint+'.ex'
-        torch.save(new_save,new_file)
+        with open(new_file,'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry)+'\n')
         print('saved '+new_file)
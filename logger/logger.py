@@ -1,18 +1,91 @@
 import json
 
 
+def _to_json(value):
+    #numpy/torch scalars and arrays
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
 class Logger:
     """
     Training process logger
 
     Note:
         Used by BaseTrainer to save training history.
+        Once open() is called (by BaseTrainer.train), entries are appended to a JSONL file (one entry
+        per line) instead of being kept in memory, and a checkpoint only needs to store the file offset.
     """
-    def __init__(self):
+    def __init__(self, path=None):
+        self.entries = {}
+        self.path = None
+        if path is not None:
+            self.open(path)
+
+    def open(self, path, offset=0):
+        """
+        Append entries to path, after the first offset bytes (anything after that is from
+        iterations that will be re-run, and is cut off). Only the training process should open the log
+        """
+        with open(path, 'ab') as f:
+            if f.tell() < offset:
+                print('WARNING: log {} is shorter than the checkpoint expects ({} < {} bytes)'.format(path, f.tell(), offset))
+                offset = f.tell()
+            f.truncate(offset)
+        self.path = path
+        self.offset = offset
+        #entries logged before the file was set
+        pending = [self.entries[index] for index in sorted(self.entries)]
         self.entries = {}
+        for entry in pending:
+            self.add_entry(entry)
 
     def add_entry(self, entry):
-        self.entries[len(self.entries) + 1] = entry
+        if self.path is None:
+            self.entries[len(self.entries) + 1] = entry
+            return
+        line = (json.dumps(entry, default=_to_json) + '\n').encode('utf-8')
+        with open(self.path, 'ab') as f:
+            f.write(line)
+        self.offset += len(line)
 
     def __str__(self):
         return json.dumps(self.entries, sort_keys=True, indent=4)
+
+
+def read_log(path, every=1):
+    """
+    Streams the entries of a JSONL log. With every>1 only every Nth value of each metric is kept
+    (the first and last values of each metric are always kept).
+    """
+    counts = {}
+    last = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break #partly written last line
+            if every <= 1:
+                yield entry
+                continue
+            iteration = entry['iteration']
+            kept = {}
+            for metric, value in entry.items():
+                if metric == 'iteration':
+                    continue
+                count = counts.get(metric, 0)
+                counts[metric] = count + 1
+                if count % every == 0:
+                    kept[metric] = value
+                    last.pop(metric, None)
+                else:
+                    last[metric] = (iteration, value)
+            if len(kept) > 0:
+                kept['iteration'] = iteration
+                yield kept
+    for metric, (iteration, value) in last.items():
+        yield {'iteration': iteration, metric: value}
@@ -0,0 +1,60 @@
+import argparse
+import torch
+from model import *
+from model.cpu_inference import convert_for_cpu, CPU_MODES
+from model.inference_rewriter import rewrite_for_inference
+from data_loader import getDataLoader
+
+#Converts a training checkpoint into a CPU inference model (int8 dynamic quantization or bf16 autocast)
+#The saved file can be used with eval.py (-c) or run.py (-c). Check accuracy and throughput against the original with eval.py
+
+def main(checkpoint_path,out_path,mode,rewrite=False,data_dir=None):
+    checkpoint = torch.load(checkpoint_path, map_location=lambda storage, location: storage)
+    config = checkpoint['config']
+    for key in config.keys():
+        if 'pretrained' in key:
+            config[key]=None
+    model = eval(config['arch'])(config['model'])
+    if 'swa_state_dict' in checkpoint and checkpoint['iteration']>config['trainer']['swa_start']:
+        state_dict = {key[7:]:value for key,value in checkpoint['swa_state_dict'].items() if key.startswith('module.')}
+        print('Using SWA weights')
+    else:
+        state_dict = checkpoint['state_dict']
+    model.load_state_dict(state_dict)
+
+    model.eval()
+    if rewrite:
+        #a real page (the first test page) to compare the detector's output on
+        if data_dir is not None:
+            config['data_loader']['data_dir']=data_dir
+            config['validation']['data_dir']=data_dir
+        test_loader,_ = getDataLoader(config,'test')
+        example = test_loader.dataset[0]['img']
+        rewrite_for_inference(model,example=example)
+    convert_for_cpu(model,mode)
+
+    torch.save({
+        'arch': config['arch'],
+        'iteration': checkpoint['iteration'] if 'iteration' in checkpoint else None,
+        'config': config,
+        'cpu_inference': mode,
+        'inference_rewritten': rewrite,
+        'state_dict': model.state_dict()
+        }, out_path)
+    print('saved {} CPU inference model to {}'.format(mode,out_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Make a CPU inference model from a checkpoint')
+    parser.add_argument('-c', '--checkpoint', type=str, required=True,
+                        help='path to checkpoint')
+    parser.add_argument('-o', '--out', type=str, required=True,
+                        help='path to save converted model')
+    parser.add_argument('-m', '--mode', default='int8', type=str, choices=CPU_MODES,
+                        help='int8 (dynamic quantization of graph Linears) or bf16 (autocast) (default: int8)')
+    parser.add_argument('-R', '--rewrite', default=False, action='store_const', const=True,
+                        help='also fold BatchNorm into convs and remove dropout')
+    parser.add_argument('-d', '--data_dir', default=None, type=str,
+                        help='with -R, where the dataset is, if not where the config says (a test page is used to verify the rewrite)')
+    args = parser.parse_args()
+    main(args.checkpoint,args.out,args.mode,args.rewrite,args.data_dir)
@@ -44,8 +44,30 @@ def attention(query, key, value, mask=None, key_padding_mask=None, dropout=None,
     if dropout is not None:
         p_attn = dropout(p_attn)
     return torch.matmul(p_attn, value), p_attn
-def learned_attention(query, key, value, mask=None, dropout=None,network=None):
-    "Compute Attention using provided network"
+
+#value masked scores are set to, -1e9 overflows float16 under autocast
+def mask_fill_value():
+    return -1e4 if torch.is_autocast_enabled() else -1e9
+
+HAS_SDPA = hasattr(F,'scaled_dot_product_attention') #torch>=2.0
+def fused_attention(query, key, value, mask=None, dropout_p=0.0,fixed=False,att_bias=None):
+    "Same as attention(), but uses the fused kernel and doesn't return the attention weights"
+    attn_mask = att_bias.to(query.dtype) if att_bias is not None else None #a float mask has to match the query (e.g. float16 under autocast)
+    if mask is not None:
+        #additive mask with the same fill values as attention(), so fully masked rows behave the same
+        add_mask = torch.zeros(mask.size(),dtype=query.dtype,device=query.device).masked_fill_(mask == 0, mask_fill_value())
+        if attn_mask is not None:
+            attn_mask = attn_mask+add_mask
+        else:
+            attn_mask = add_mask
+    x = F.scaled_dot_product_attention(query,key,value,attn_mask=attn_mask,dropout_p=dropout_p)
+    if mask is not None and fixed:
+        #nodes with no neighbors get a zero vector (same as zeroing their attention row)
+        has_neighbor = (mask!=0).any(dim=-1,keepdim=True)
+        x = x*has_neighbor.to(x.dtype)
+    return x
+def learned_attention(query, key, value, mask=None, dropout=None,network=None,softmax=False):
+    "Compute Attention using provided network. With a mask, the masked scores are used as the weights directly unless softmax is set"
 
     #naive "everywhere" implmenetation
     assert(len(query.size())==4)
@@ -58,15 +80,62 @@ def learned_attention(query, key, value, mask=None, dropout=None,network=None):
     scores = network(comb) #same function for each head
     scores = scores.view(batch_size,heads,query.size(2),key.size(2))
     if mask is not None:
-        scores = scores.masked_fill(mask == 0, -1e9)
+        scores = scores.masked_fill(mask == 0, mask_fill_value())
 
-    p_attn = F.softmax(scores, dim = -1)
-    if mask is not None:
-        p_attn = scores.masked_fill(mask == 0, 0) #this is needed in casa node has no neigbors
-        #will create a zero vector in those cases, instead of an average of all nodes
+    if mask is not None and not softmax:
+        p_attn = scores.masked_fill(mask == 0, 0) #original behavior, existing 'learned' checkpoints were trained with it
+    else:
+        p_attn = F.softmax(scores, dim = -1)
+        if mask is not None:
+            p_attn = p_attn.masked_fill(mask == 0, 0) #this is needed in casa node has no neigbors
+            #will create a zero vector in those cases, instead of an average of all nodes
     if dropout is not None:
         p_attn = dropout(p_attn)
     return torch.matmul(p_attn, value), p_attn
+def chunked_learned_attention(query, key, value, mask=None, dropout=None,network=None,chunk=512,softmax=False):
+    "Same as learned_attention(), but scores the keys in tiles (with an online softmax when normalizing) so only [Q,chunk,2F] is ever built. Doesn't return the attention weights"
+    assert(len(query.size())==4)
+    Q = query.size(2)
+    K = key.size(2)
+    run_max = query.new_full(query.size()[:3]+(1,),float('-inf'))
+    run_sum = query.new_zeros(query.size()[:3]+(1,))
+    acc = query.new_zeros(query.size()[:3]+(value.size(-1),))
+    if mask is not None and not softmax:
+        #scores are the weights, just sum each tile's contribution
+        for k0 in range(0,K,chunk):
+            k1 = min(K,k0+chunk)
+            query_ex = query[:,:,:,None,:].expand(-1,-1,Q,k1-k0,-1)
+            key_ex = key[:,:,None,k0:k1,:].expand(-1,-1,Q,k1-k0,-1)
+            scores = network(torch.cat((query_ex,key_ex),dim=4))[...,0]
+            p = scores.masked_fill(mask[...,k0:k1] == 0, 0)
+            if dropout is not None:
+                p = dropout(p)
+            acc = acc + torch.matmul(p,value[:,:,k0:k1])
+        return acc
+    if mask is not None:
+        has_neighbor = torch.zeros(query.size()[:3]+(1,),dtype=torch.bool,device=query.device)
+    for k0 in range(0,K,chunk):
+        k1 = min(K,k0+chunk)
+        key_t = key[:,:,k0:k1]
+        query_ex = query[:,:,:,None,:].expand(-1,-1,Q,k1-k0,-1)
+        key_ex = key_t[:,:,None,:,:].expand(-1,-1,Q,k1-k0,-1)
+        scores = network(torch.cat((query_ex,key_ex),dim=4))[...,0] #same function for each head
+        if mask is not None:
+            mask_t = mask[...,k0:k1] != 0
+            scores = scores.masked_fill(~mask_t, mask_fill_value())
+            has_neighbor = has_neighbor | mask_t.any(dim=-1,keepdim=True)
+        new_max = torch.max(run_max,scores.max(dim=-1,keepdim=True)[0])
+        rescale = torch.exp(run_max-new_max)
+        p = torch.exp(scores-new_max)
+        run_sum = run_sum*rescale + p.sum(dim=-1,keepdim=True)
+        if dropout is not None:
+            p = dropout(p) #elementwise, so same as dropping the normalized weights
+        acc = acc*rescale + torch.matmul(p,value[:,:,k0:k1])
+        run_max = new_max
+    x = acc/run_sum
+    if mask is not None:
+        x = x*has_neighbor.to(x.dtype) #zero vector for nodes with no neighbors
+    return x
 
 class MultiHeadedAttention(nn.Module):
     def __init__(self, h, d_model, dropout=0.1, mod=None):
@@ -80,6 +149,7 @@ class MultiHeadedAttention(nn.Module):
         self.attn = None
         self.dropout = nn.Dropout(p=dropout)
         self.mod=mod if mod else '' #learned: use network for attention instead of dot product, half: use only half of query/keys for dot product
+                                    #softmax: (with learned) normalize the masked learned scores with a softmax instead of using them as weights directly
         if 'learned' in self.mod:
             self.learned=True
             self.attNet = nn.Sequential(
@@ -92,9 +162,12 @@ class MultiHeadedAttention(nn.Module):
                     )
         else:
             self.learned=False
+        self.learned_softmax = 'softmax' in self.mod
         self.half = 'half' in self.mod
         self.none = 'none' in self.mod
         self.fixed= 'fixed' in self.mod
+        self.need_weights=False #set to True to keep self.attn (forces the unfused path)
+        self.learned_chunk=512 #number of keys scored at a time by chunked_learned_attention
         
         
     def forward(self, query, key, value, mask=None):
@@ -115,12 +188,26 @@ class MultiHeadedAttention(nn.Module):
              for l, x in zip(self.linears, (query, key, value))]
         
         # 2) Apply attention on all the projected vectors in batch. 
-        if self.half:
+        use_fused = HAS_SDPA and not self.need_weights and not self.learned
+        if use_fused:
+            dropout_p = self.dropout.p if self.training else 0.0
+            if self.half:
+                x = fused_attention(query[...,:self.d_k//2], key[...,:self.d_k//2], value, mask=mask,
+                                     dropout_p=dropout_p,fixed=self.fixed)
+            else:
+                x = fused_attention(query, key, value, mask=mask,
+                                     dropout_p=dropout_p,fixed=self.fixed)
+            self.attn = None
+        elif self.half:
             x, self.attn = attention(query[...,:self.d_k//2], key[...,:self.d_k//2], value, mask=mask, 
                                      dropout=self.dropout,fixed=self.fixed)
+        elif self.learned and not self.need_weights:
+            x = chunked_learned_attention(query, key, value, mask=mask,
+                                     dropout=self.dropout,network=self.attNet,chunk=self.learned_chunk,softmax=self.learned_softmax)
+            self.attn = None
         elif self.learned:
             x, self.attn = learned_attention(query, key, value, mask=mask, 
-                                     dropout=self.dropout,network=self.attNet)
+                                     dropout=self.dropout,network=self.attNet,softmax=self.learned_softmax)
         else:
             x, self.attn = attention(query, key, value, mask=mask, 
                                      dropout=self.dropout,fixed=self.fixed)
@@ -0,0 +1,43 @@
+import torch
+from torch import nn
+try:
+    from torch.ao.quantization import quantize_dynamic
+except ImportError:
+    from torch.quantization import quantize_dynamic #older torch
+
+#Conversions of a trained FUDGE model for CPU-only inference
+#  'int8': dynamic INT8 quantization of the Linear layers in the graph part (rel_prop_nn, edge_mlp, node_mlp, transition layers)
+#  'bf16': run forward under CPU bfloat16 autocast (the detector and featurizer convs benefit most)
+#The two aren't combined as the dynamic quantized Linears expect fp32 inputs
+
+CPU_MODES = ['int8','bf16']
+
+def _int8_targets(model):
+    targets=[]
+    if getattr(model,'rel_prop_nn',None) is not None:
+        targets.append(model.rel_prop_nn)
+    if getattr(model,'node_transition_layers',None) is not None:
+        targets.append(model.node_transition_layers)
+        targets.append(model.edge_transition_layers)
+    for graphnet in model.graphnets:
+        for module in graphnet.modules():
+            if isinstance(getattr(module,'edge_mlp',None),nn.Module):
+                targets.append(module.edge_mlp)
+            if isinstance(getattr(module,'node_mlp',None),nn.Module):
+                targets.append(module.node_mlp)
+    return targets
+
+#Converts (in place) and returns the model. Call on a built model, either before loading a state_dict saved from a converted model, or after loading a normal one
+def convert_for_cpu(model,mode):
+    assert mode in CPU_MODES, 'unknown cpu_inference mode {}, options are {}'.format(mode,CPU_MODES)
+    model.cpu()
+    model.eval()
+    if mode=='int8':
+        for module in _int8_targets(model):
+            quantize_dynamic(module,{nn.Linear},dtype=torch.qint8,inplace=True)
+    elif mode=='bf16':
+        if not hasattr(torch,'autocast'):
+            raise NotImplementedError('bf16 CPU inference needs torch.autocast (torch>=1.10)')
+        model.cpu_autocast=torch.bfloat16
+    model.cpu_inference=mode
+    return model
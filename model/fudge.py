@@ -12,9 +12,11 @@ from model.net_builder import make_layers, getGroupSize
 from utils.yolo_tools import non_max_sup_iou, non_max_sup_dist, non_max_sup_overseg, allIOU, allIO_clipU
 import math, os
 import random
+import timeit
 import json
 from collections import defaultdict
 import utils.img_f as img_f
+from utils.profiler import StageProfiler
 
 
 MAX_CANDIDATES=700 #these are only used for line-of-sight selection
@@ -41,6 +43,7 @@ Its hyper-parameters are specified by the config dictionary. I'll list it's impo
     * "pretrained_backbone_checkpoint": Instead of loading from a pretrained detector, you can load just the backbone of a trained FUDGE/Davis et al. model. You need to specify "detector_config" however.
     * "detect_conf_thresh": This is the threshold it will use to select the initial nodes. The threshold is randomly perturbed during training. 0.5 is the value I use.
     * "start_frozen": Tells the model to freeze the detector weights at first
+    * "detector_tile_size"/"detector_tile_overlap": At inference, run the detector on overlapping tiles (in pixels, multiples of the detector's stride) for pages bigger than the tile size. The predictions and features are stitched into page level maps, so the graph sees the whole page.
 
     * "relationship_proposal": The method of proposing relationships. FUDGE uses "feature_nn", Davis et al used "line-of-sight"
     * "percent_rel_to_keep": this is the percent of the total possible relationships to keep during the proposal step
@@ -112,6 +115,10 @@ class FUDGE(BaseModel):
         self.detector_predNumNeighbors=False
         assert not self.detector.predNumNeighbors
 
+        #Run the detector on overlapping tiles at inference (for big, high resolution pages)
+        if 'detector_tile_size' in config and config['detector_tile_size'] is not None:
+            self.detector.setTiling(config['detector_tile_size'],config['detector_tile_overlap'] if 'detector_tile_overlap' in config else 256)
+
         #select which layers of the detector to use as features for the graph
         #This is a bit convoluted becuase the detector's architecture has some layers to it
         useBeginningOfLast = config['use_beg_det_feats'] if 'use_beg_det_feats' in config else False
@@ -166,6 +173,8 @@ class FUDGE(BaseModel):
         else:
             self.detect_conf_thresh = 0.5
         self.useHardConfThresh = config['use_hard_conf_thresh'] if 'use_hard_conf_thresh' in config else True
+        #at inference, have the detector only decode cells above the (hard) threshold
+        self.sparse_detect_decode = config['sparse_detect_decode'] if 'sparse_detect_decode' in config else True
 
 
         if type(self.detector.scale[0]) is int:
@@ -242,6 +251,17 @@ class FUDGE(BaseModel):
         #Telling it to re-append the visual features at each GCN
         self.reintroduce_features = config['reintroduce_features'] if 'reintroduce_features' in config else  (config['reintroduce_visual_features'] if 'reintroduce_visual_features' in config else False) #"fixed map"
 
+        #Inference-time early exit: if an edit step changes less than this fraction of the graph (nodes+edges), stop iterating. None disables, 0 means only when nothing changed
+        self.early_exit_change = config['early_exit_change'] if 'early_exit_change' in config else None
+        #'final': jump to the last GCN, 'skip': don't run any more GCNs
+        self.early_exit_mode = config['early_exit_mode'] if 'early_exit_mode' in config else 'final'
+        assert self.early_exit_mode in ['final','skip']
+
+        self.lean_inference=False #set by infer(), only the current GCN iteration's outputs are kept
+        self.lean_timing=None
+        self.profiler=StageProfiler() #disabled unless the trainer sets one (profile in the trainer config)
+        self.cpu_autocast=None #set by model.cpu_inference.convert_for_cpu for bf16
+
 
         #Add x,y location as a spatial feature
         self.usePositionFeature = config['use_position_feats'] if 'use_position_feats' in config else False
@@ -622,26 +642,48 @@ class FUDGE(BaseModel):
 
         assert(image.size(0)==1) #implementation designed for batch size of 1. Should work to do data parallelism, since each copy of the model will get a batch size of 1
 
+        #(with a tiled detector the image may be on the CPU when the model isn't, so check the model)
+        if self.cpu_autocast is not None and not next(self.parameters()).is_cuda and not torch.is_autocast_cpu_enabled():
+            with torch.autocast('cpu',dtype=self.cpu_autocast):
+                return self.forward(image,gtBBs,gtNNs,useGTBBs,otherThresh,otherThreshIntur,hard_detect_limit,debug,old_nn,gtTrans,gtGroups)
+
         self.merges_performed=0 #just tracking to see if it's working
+        self.graph_iterations_run=0 #number of GCNs actually run (can be less than len(self.graphnets) with early exit)
 
         if not self.detector.forGraphPairing: #This is needed to be checked becuase of weird things when doing SWA
             self.detector.setForGraphPairing(*self.set_detect_params)
 
+        if not self.training and self.useHardConfThresh and self.sparse_detect_decode:
+            self.detector.sparse_decode_thresh = self.detect_conf_thresh #everything below is dropped by NMS anyways
+        else:
+            self.detector.sparse_decode_thresh = None
+
         #run the detector on the backbone
         #it has hooks saving the features we need
+        self.profiler.start('detector')
         bbPredictions, offsetPredictions, _,_,_,_ = self.detector(image)
         _=None
 
         if self.detector.saved_features is None: #weird SWA stuff fix
             self.detector.setForGraphPairing(*self.set_detect_params)
             bbPredictions, offsetPredictions, _,_,_,_ = self.detector(image)
+        self.profiler.stop('detector')
+        if self.lean_timing is not None:
+            self.lean_timing['detector']=self._lean_time()
+        image = image.to(bbPredictions.device) #a tiled detector leaves the page on the CPU
+
+        bbPredictions = bbPredictions.float() #(if autocast) do NMS in full precision
 
         #get the saved features to extract our visual features
         saved_features=self.detector.saved_features
+        if saved_features.dtype!=torch.float32:
+            saved_features=saved_features.float() #RoIAlign wants matching dtypes
         self.detector.saved_features=None
 
         if self.use2ndFeatures:
             saved_features2=self.detector.saved_features2
+            if saved_features2.dtype!=torch.float32:
+                saved_features2=saved_features2.float()
         else:
             saved_features2=None
         
@@ -664,7 +706,13 @@ class FUDGE(BaseModel):
 
 
         #apply non maximal suppression to the detector results
+        self.profiler.start('nms')
         bbPredictions = non_max_sup_iou(bbPredictions.cpu(),self.used_threshConf,0.4,hard_detect_limit)
+        self.profiler.stop('nms')
+        if self.lean_inference:
+            offsetPredictions=None #not needed for inference
+        if self.lean_timing is not None:
+            self.lean_timing['nms']=self._lean_time()
 
         #I'm assuming batch size of one
         assert(len(bbPredictions)==1)
@@ -704,6 +752,10 @@ class FUDGE(BaseModel):
                     saved_features2,
                     bbTrans,
                     embeddings)
+            if self.lean_timing is not None:
+                self.lean_timing['graph']=self._lean_time()
+            self.profiler.count('merges',self.merges_performed)
+            self.profiler.count('graph_iterations',self.graph_iterations_run)
 
             return allOutputBoxes, offsetPredictions, allEdgeOuts, allEdgeIndexes, allNodeOuts, allGroups, rel_prop_scores,merge_prop_scores, final
 
@@ -712,6 +764,39 @@ class FUDGE(BaseModel):
             return [bbPredictions], offsetPredictions, None, None, None, None, None, None, (useBBs.cpu().detach(),None,None,transcriptions)
 
 
+    #Inference only. Runs forward under inference_mode, only keeping the current GCN iteration's outputs, and returns only final
+    #If timing, also returns a dict of seconds spent in each stage (and the total) for this page
+    def infer(self,image,hard_detect_limit=5000,timing=False):
+        assert not self.training
+        self.lean_inference=True
+        if timing:
+            self.lean_timing={}
+            self._lean_time()
+            start=self._lean_tic
+        no_grad = torch.inference_mode() if hasattr(torch,'inference_mode') else torch.no_grad() #inference_mode is torch>=1.9
+        try:
+            with no_grad:
+                final = self(image,hard_detect_limit=hard_detect_limit)[-1]
+        finally:
+            self.lean_inference=False
+            page_timing=self.lean_timing
+            self.lean_timing=None
+        if timing:
+            self._lean_time()
+            page_timing['total']=self._lean_tic-start
+            return final, page_timing
+        return final
+
+    #seconds since the last call
+    def _lean_time(self):
+        device = next(self.parameters()).device
+        if device.type=='cuda':
+            torch.cuda.synchronize(device) #only wait on the model's GPU
+        toc = timeit.default_timer()
+        elapsed = toc-self._lean_tic if hasattr(self,'_lean_tic') else 0
+        self._lean_tic = toc
+        return elapsed
+
     #appends the visual features to the graph features, and then passes them through the transition layer to make the new graph features. First recomputes visual features for updated nodes and edges
     def appendVisualFeatures(self,
             giter,                      #iteration # of GCN
@@ -1219,11 +1304,15 @@ class FUDGE(BaseModel):
             image=None,     #was used for some features extraction not used now
             ):
         
+        self.profiler.start('proposal')
         if self.relationshipProposal == 'line_of_sight':
             candidates = self.selectLineOfSightEdges(bbs,imageHeight,imageWidth)
             rel_prop_scores = None
         elif self.relationshipProposal == 'feature_nn': #FUDGE does this
             candidates, rel_prop_scores = self.selectFeatureNNEdges(bbs,imageHeight,imageWidth,image,features.device,text_emb=text_emb)
+        self.profiler.stop('proposal')
+        self.profiler.count('nodes',len(bbs))
+        self.profiler.count('edges',len(candidates))
 
         
         
@@ -1239,6 +1328,7 @@ class FUDGE(BaseModel):
 
         keep_edges=None
 
+        self.profiler.start('featurize')
         if self.useShapeFeats!='only':
             #precompute mask of all BBs for whole image
             allMasks=self.makeAllMasks(imageHeight,imageWidth,bbs)
@@ -1261,6 +1351,7 @@ class FUDGE(BaseModel):
             bb_features = self.node_transition_layers[0](node_vis_features) #this is an extra linear layer to prep the features for the graph (which expects non-activated values)
         else:
             bb_features = node_vis_features
+        self.profiler.stop('featurize')
 
         relIndexes=candidates
         numBB = len(bbs)
@@ -1439,6 +1530,7 @@ class FUDGE(BaseModel):
             batch_size = self.roi_batch_size
 
         innerbatches = [(s,min(s+batch_size,len(edges))) for s in range(0,len(edges),batch_size)]
+        self.profiler.count('roi_batches',len(innerbatches))
 
         for ib,(b_start,b_end) in enumerate(innerbatches): #we can batch extracting computing the feature vector from rois to save memory
             
@@ -2263,7 +2355,10 @@ class FUDGE(BaseModel):
             last_edge_visual_feats = graph[2]
 
         #Run first GCN
+        self.profiler.start('graphnet0')
         nodeOuts, edgeOuts, nodeFeats, edgeFeats, uniFeats = self.graphnets[0](graph)
+        self.profiler.stop('graphnet0')
+        self.graph_iterations_run=1
 
         edgeIndexes = edgeIndexes[:len(edgeIndexes)//2] #remove reverse edges
 
@@ -2271,6 +2366,8 @@ class FUDGE(BaseModel):
         useBBs = self.updateBBs(useBBs,groups,nodeOuts)
 
         #save output for this GCN
+        if self.lean_inference:
+            rel_prop_scores=None #only for supervision
         allOutputBoxes.append(useBBs.cpu()) 
         allNodeOuts.append(nodeOuts)
         allEdgeOuts.append(edgeOuts)
@@ -2281,7 +2378,9 @@ class FUDGE(BaseModel):
         for gIter,graphnet in enumerate(self.graphnets[1:]):
             
             good_edges=None
+            pre_edit = (useBBs,groups,edgeIndexes,bbTrans,keep_edges)
             #perform the merges, groupings, and prunings
+            self.profiler.start('mergeAndGroup')
             useBBs,graph,groups,edgeIndexes,bbTrans,embeddings,same_node_map,keep_edges=self.mergeAndGroup(
                     self.mergeThresh[gIter],
                     self.keepEdgeThresh[gIter],
@@ -2298,12 +2397,32 @@ class FUDGE(BaseModel):
                     good_edges=good_edges,
                     keep_edges=keep_edges,
                     gt_groups=gtGroups if gIter==0 else ([[g] for g in range(len(groups))] if gtGroups is not None else None))
-
+            self.profiler.stop('mergeAndGroup')
+
+            giter_features = gIter+1
+            early_exit = False
+            if not self.training and self.early_exit_change is not None and len(edgeIndexes)>0:
+                #edits only remove nodes (merge/group) and edges (prune), so the count differences measure the change
+                prev_num_nodes = len(pre_edit[1])
+                prev_num_edges = len(pre_edit[2])
+                changed = (prev_num_nodes-len(groups)) + abs(prev_num_edges-len(edgeIndexes))
+                if changed<=self.early_exit_change*(prev_num_nodes+prev_num_edges):
+                    early_exit = True
+                    if self.early_exit_mode=='skip':
+                        #undo the edit so the final edit step matches the last GCN's predictions
+                        useBBs,groups,edgeIndexes,bbTrans,keep_edges = pre_edit
+                        break
+                    else:
+                        #jump straight to the final GCN
+                        graphnet = self.graphnets[-1]
+                        giter_features = len(self.graphnets)-1
+            pre_edit=None
 
             if self.reintroduce_features:
                 #recompute and reintroduce features
+                self.profiler.start('featurize')
                 graph,last_node_visual_feats,last_edge_visual_feats = self.appendVisualFeatures(
-                        gIter+1,
+                        giter_features,
                         useBBs,
                         graph,
                         groups,
@@ -2318,11 +2437,20 @@ class FUDGE(BaseModel):
                         last_edge_visual_feats,
                         allEdgeIndexes[-1],
                         good_edges=good_edges)
+                self.profiler.stop('featurize')
             if len(edgeIndexes)==0:
                 break #we have no graph left, so we can just end here
 
+            if self.lean_inference:
+                #free the previous iteration before running the next
+                nodeOuts=edgeOuts=nodeFeats=edgeFeats=uniFeats=None
+                del allOutputBoxes[:], allNodeOuts[:], allEdgeOuts[:], allGroups[:], allEdgeIndexes[:]
+
             #Run the next GCN
+            self.profiler.start('graphnet{}'.format(giter_features))
             nodeOuts, edgeOuts, nodeFeats, edgeFeats, uniFeats = graphnet(graph)
+            self.profiler.stop('graphnet{}'.format(giter_features))
+            self.graph_iterations_run+=1
 
             useBBs = self.updateBBs(useBBs,groups,nodeOuts)
 
@@ -2332,9 +2460,12 @@ class FUDGE(BaseModel):
             allEdgeOuts.append(edgeOuts)
             allGroups.append(groups)
             allEdgeIndexes.append(edgeIndexes)
+            if early_exit:
+                break
         #end GCN loop
 
         ##Final state of the graph, via a final edit step
+        self.profiler.start('mergeAndGroup')
         useBBs,graph,groups,edgeIndexes,bbTrans,_,same_node_map,keep_edges=self.mergeAndGroup(
                 self.mergeThresh[-1],
                 self.keepEdgeThresh[-1],
@@ -2351,6 +2482,7 @@ class FUDGE(BaseModel):
                 gt_groups=[[g] for g in range(len(groups))] if gtGroups is not None else None,
                 final=True #This tells it to use the relationship predictions to prune
                 )
+        self.profiler.stop('mergeAndGroup')
         final=(useBBs.cpu().detach(),groups,edgeIndexes,bbTrans)
 
         #return lots of things for all the supervision required
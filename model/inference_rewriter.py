@@ -0,0 +1,125 @@
+import torch
+from torch import nn
+from torch.nn.utils import remove_weight_norm
+
+#Rewrites a model built with net_builder (detector, featurizers) for faster inference:
+#  * Conv2d followed by BatchNorm2d (in an nn.Sequential, as convReLU makes them) has the BatchNorm folded into the conv
+#  * Dropout layers are removed
+#  * optionally the detector is switched to channels_last
+#Removed layers are replaced with nn.Identity so the indexes into the Sequentials (used to place feature hooks) don't change.
+#The model is changed in place and can only be used for inference afterwards.
+#To load a state_dict saved from a rewritten model, rewrite the freshly built model first.
+
+def fold_bn_into_conv(conv,bn):
+    if hasattr(conv,'weight_g'):
+        remove_weight_norm(conv)
+    w = conv.weight
+    if conv.bias is not None:
+        b = conv.bias
+    else:
+        b = torch.zeros(w.size(0),dtype=w.dtype,device=w.device)
+    std = torch.sqrt(bn.running_var+bn.eps)
+    gamma = bn.weight if bn.affine else torch.ones_like(std)
+    beta = bn.bias if bn.affine else torch.zeros_like(std)
+    scale = gamma/std
+    new_w = w*scale.view(-1,*([1]*(w.dim()-1)))
+    new_b = (b-bn.running_mean)*scale+beta
+    conv.weight = nn.Parameter(new_w.detach())
+    conv.bias = nn.Parameter(new_b.detach())
+    return conv
+
+def _can_fold(conv,bn):
+    return (type(conv) is nn.Conv2d and type(bn) is nn.BatchNorm2d and
+            bn.track_running_stats and bn.running_mean is not None and
+            bn.num_features==conv.out_channels)
+
+def _rewrite_sequential(seq):
+    changed=False
+    names = list(seq._modules.keys())
+    for i,name in enumerate(names):
+        module = seq._modules[name]
+        if isinstance(module,nn.modules.dropout._DropoutNd):
+            seq._modules[name] = nn.Identity()
+            changed=True
+        elif i>0 and type(module) is nn.BatchNorm2d and _can_fold(seq._modules[names[i-1]],module):
+            fold_bn_into_conv(seq._modules[names[i-1]],module)
+            seq._modules[name] = nn.Identity()
+            changed=True
+    return changed
+
+def _sequentials(model):
+    return [m for m in model.modules() if isinstance(m,nn.Sequential)]
+
+PROBE_SIZES = [16,64,256]
+
+#A fixed random input for each Sequential that starts with a conv (the ones we can test in isolation),
+#the smallest of PROBE_SIZES that it runs on (its strides and pools may need more than 16x16). None if it runs on none
+def _probe_inputs(blocks,device):
+    gen = torch.Generator().manual_seed(0)
+    inputs=[]
+    for block in blocks:
+        probe=None
+        for size in PROBE_SIZES:
+            inp = torch.rand(1,block[0].in_channels,size,size,generator=gen).to(device)
+            try:
+                block(inp)
+            except RuntimeError:
+                continue
+            probe=inp
+            break
+        inputs.append(probe)
+    return inputs
+
+def _block_outputs(blocks,inputs):
+    return [block(inp) if inp is not None else None for block,inp in zip(blocks,inputs)]
+
+def rewrite_for_inference(model,channels_last=False,verify=True,atol=1e-3,example=None):
+    model.eval()
+    seqs = _sequentials(model)
+    device = next(model.parameters()).device
+
+    if verify:
+        blocks=[seq for seq in seqs if len(seq)>0 and type(seq[0]) is nn.Conv2d]
+        with torch.no_grad():
+            inputs = _probe_inputs(blocks,device)
+            ref_blocks = _block_outputs(blocks,inputs)
+            if example is not None:
+                ref_example = _detector_outputs(model,example)
+        num_verified = sum(inp is not None for inp in inputs)
+        assert num_verified>0 or example is not None, 'none of the {} conv blocks could be run alone and no example was given, the rewrite can\'t be verified'.format(len(blocks))
+
+    num_changed = sum(_rewrite_sequential(seq) for seq in seqs)
+
+    if channels_last:
+        detector = model.detector if hasattr(model,'detector') else model
+        detector.to(memory_format=torch.channels_last)
+        detector.channels_last=True
+
+    if verify:
+        max_diff=0
+        with torch.no_grad():
+            #a block that ran before the rewrite has to run after it
+            new_blocks = _block_outputs(blocks,inputs)
+            for ref,new in zip(ref_blocks,new_blocks):
+                if ref is not None:
+                    max_diff = max(max_diff,(ref-new).abs().max().item())
+            if example is not None:
+                for ref,new in zip(ref_example,_detector_outputs(model,example)):
+                    max_diff = max(max_diff,(ref-new).abs().max().item())
+        print('Rewrote {} Sequentials for inference, verified {} of {} conv blocks{}, max difference {}'.format(
+            num_changed,num_verified,len(blocks),' and an example page' if example is not None else '',max_diff))
+        if num_verified<len(blocks):
+            print('WARNING: {} conv blocks could not be run alone and were not verified{}'.format(
+                len(blocks)-num_verified,' (except through the example page, if they are in the detector)' if example is not None else ''))
+        assert max_diff<=atol, 'rewritten model differs by {} (> {})'.format(max_diff,atol)
+    return model
+
+#The raw detector output and the features saved for the graph
+def _detector_outputs(model,image):
+    detector = model.detector if hasattr(model,'detector') else model
+    y = detector._hack_down(detector.prepare_input(image))
+    outs=[y.float().contiguous()]
+    if getattr(detector,'forGraphPairing',False) and detector.saved_features is not None:
+        outs.append(detector.saved_features.float().contiguous())
+        detector.saved_features=None
+    return outs
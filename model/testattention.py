@@ -0,0 +1,114 @@
+import torch
+from model.attention import MultiHeadedAttention, HAS_SDPA, attention, fused_attention
+
+#Checks that the fast attention paths (fused, chunked learned) give the same output as the original ones
+#(MultiHeadedAttention with need_weights=True always takes the original path).
+#   python -m model.testattention
+
+NUM_NODES = 9
+D_MODEL = 32
+HEADS = 4
+
+def graph_mask(gen, empty_rows=[]):
+    mask = (torch.rand(NUM_NODES,NUM_NODES,generator=gen)>0.5).float()
+    mask += torch.eye(NUM_NODES)
+    mask = (mask>0).float()
+    for row in empty_rows:
+        mask[row] = 0 #a node with no neighbors
+    return mask
+
+def compare(att, x, mask, atol=1e-5):
+    att.eval()
+    att.need_weights = True
+    with torch.no_grad():
+        ref = att(x,x,x,mask)
+    att.need_weights = False
+    with torch.no_grad():
+        new = att(x,x,x,mask)
+    diff = (ref.float()-new.float()).abs().max().item()
+    assert diff<=atol, 'differs by {}'.format(diff)
+    return diff
+
+def check_fused(gen):
+    if not HAS_SDPA:
+        print('fused attention: torch has no scaled_dot_product_attention, nothing to compare')
+        return
+    x = torch.randn(1,NUM_NODES,D_MODEL,generator=gen)
+    cases = [
+            ('',        None),
+            ('',        graph_mask(gen)),
+            ('',        graph_mask(gen,[4])),
+            ('fixed',   None),
+            ('fixed',   graph_mask(gen)),
+            ('fixed',   graph_mask(gen,[2,5])),
+            ('half',    graph_mask(gen)),
+            ('half fixed', graph_mask(gen,[0])),
+            ('none',    graph_mask(gen)),
+            ('none',    graph_mask(gen,[3])),
+            ]
+    for mod,mask in cases:
+        torch.manual_seed(0)
+        att = MultiHeadedAttention(HEADS,D_MODEL,mod=mod)
+        diff = compare(att,x,mask)
+        print('fused attention, mod="{}", {}: max difference {:.2e}'.format(mod,'no mask' if mask is None else 'masked',diff))
+
+#fused_attention against attention() with a bias on the scores, also with a lower precision query than the bias
+def check_fused_bias(gen):
+    if not HAS_SDPA:
+        return
+    d_k = D_MODEL//HEADS
+    q,k,v = [torch.randn(1,HEADS,NUM_NODES,d_k,generator=gen) for i in range(3)]
+    att_bias = torch.randn(1,HEADS,NUM_NODES,NUM_NODES,generator=gen)
+    for fixed in [False,True]:
+        for mask in [None, graph_mask(gen), graph_mask(gen,[2])]:
+            mask_ = mask[None,None] if mask is not None else None
+            ref,_ = attention(q,k,v,mask_,fixed=fixed,att_bias=att_bias)
+            for dtype,atol in [(torch.float32,1e-5),(torch.bfloat16,5e-2)]:
+                new = fused_attention(q.to(dtype),k.to(dtype),v.to(dtype),mask_,fixed=fixed,att_bias=att_bias)
+                assert new.dtype==dtype
+                diff = (ref-new.float()).abs().max().item()
+                assert diff<=atol, 'differs by {}'.format(diff)
+                print('fused attention with att_bias, fixed={}, {}, {}: max difference {:.2e}'.format(fixed,'no mask' if mask is None else 'masked',dtype,diff))
+
+#the fused path under autocast (the projections come out in lower precision)
+def check_autocast(gen):
+    if not HAS_SDPA:
+        return
+    if torch.cuda.is_available():
+        device = 'cuda'
+        autocast = lambda: torch.autocast('cuda',dtype=torch.float16)
+    elif hasattr(torch,'autocast'):
+        device = 'cpu'
+        autocast = lambda: torch.autocast('cpu',dtype=torch.bfloat16)
+    else:
+        print('autocast: not available, nothing to check')
+        return
+    x = torch.randn(1,NUM_NODES,D_MODEL,generator=gen).to(device)
+    for mod in ['','fixed','none']:
+        mask = graph_mask(gen,[1]).to(device)
+        torch.manual_seed(0)
+        att = MultiHeadedAttention(HEADS,D_MODEL,mod=mod).to(device)
+        with autocast():
+            diff = compare(att,x,mask,atol=5e-2)
+        print('fused attention under {} autocast, mod="{}": max difference {:.2e}'.format(device,mod,diff))
+
+#chunked_learned_attention (need_weights=False) against learned_attention, with fewer keys per chunk than keys
+def check_chunked_learned(gen):
+    x = torch.randn(1,NUM_NODES,D_MODEL,generator=gen)
+    cases = [None, graph_mask(gen), graph_mask(gen,[1,6])]
+    for mod in ['learned','learned softmax']:
+        for mask in cases:
+            for chunk in [1,4,NUM_NODES]:
+                torch.manual_seed(0)
+                att = MultiHeadedAttention(HEADS,D_MODEL,mod=mod)
+                att.learned_chunk = chunk
+                diff = compare(att,x,mask)
+                print('chunked attention, mod="{}", chunk {}, {}: max difference {:.2e}'.format(mod,chunk,'no mask' if mask is None else 'masked',diff))
+
+if __name__ == "__main__":
+    gen = torch.Generator().manual_seed(0)
+    check_fused(gen)
+    check_fused_bias(gen)
+    check_autocast(gen)
+    check_chunked_learned(gen)
+    print('all match')
@@ -0,0 +1,54 @@
+import torch
+import json
+import os
+import tempfile
+from model.yolo_box_detector import YoloBoxDetector
+
+#Checks that the tiled detector (YoloBoxDetector.forward_down_tiled) gives the same prediction and feature maps
+#as running the whole page, on pages whose sizes aren't multiples of the stride.
+#   python -m model.testtiling
+
+STRIDE = 8
+TILE_SIZE = 128
+OVERLAP = 64 #the small network's receptive field is well inside half of this
+PAGE_SIZES = [(301,437),(128,200),(129,129),(90,70),(400,263)]
+
+def make_detector(anchors_path):
+    config = {
+            'number_of_box_types': 2,
+            'anchors_file': anchors_path,
+            'norm_type': 'batch_norm', #(per channel in eval, so it doesn't depend on the tile)
+            'down_layers_cfg': [1,8,'M',8,'M',8,'M',8],
+            'color': False,
+            }
+    detector = YoloBoxDetector(config)
+    detector.setForGraphPairing(False,-1,-2)
+    detector.eval()
+    return detector
+
+def check_tiling(detector,gen):
+    for H,W in PAGE_SIZES:
+        img = torch.randn(1,1,H,W,generator=gen)
+        with torch.no_grad():
+            detector.tile_size = None
+            y = detector._hack_down(img)
+            feats = detector.saved_features
+            detector.setTiling(TILE_SIZE,OVERLAP)
+            y_tiled = detector.forward_down_tiled(img)
+            feats_tiled = detector.saved_features
+        assert y.shape==y_tiled.shape, '{}x{}: tiled output is {}, untiled {}'.format(H,W,list(y_tiled.shape),list(y.shape))
+        assert feats.shape==feats_tiled.shape, '{}x{}: tiled features are {}, untiled {}'.format(H,W,list(feats_tiled.shape),list(feats.shape))
+        diff = max((y-y_tiled).abs().max().item(),(feats-feats_tiled).abs().max().item())
+        assert diff<1e-5, '{}x{}: tiled output differs by {}'.format(H,W,diff)
+        print('{}x{} page, output {}: max difference {:.2e}'.format(H,W,list(y.shape[2:]),diff))
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        anchors_path = os.path.join(tmp_dir,'anchors.json')
+        with open(anchors_path,'w') as f:
+            json.dump([{'rot':0,'height':10,'width':20},{'rot':0,'height':20,'width':60}],f)
+        torch.manual_seed(0)
+        detector = make_detector(anchors_path)
+    assert detector.scale[0]==STRIDE
+    check_tiling(detector,torch.Generator().manual_seed(0))
+    print('all match')
@@ -0,0 +1,322 @@
+import torch
+import numpy as np
+import math
+import timeit
+from utils.util import inv_tanh
+from model.yolo_loss import build_targets, bbox_iou, get_closest_anchor_iou, build_targets_dist, bbox_dist, YoloDistLoss, LineLoss
+
+#Checks the vectorized target building in model/yolo_loss.py (build_targets, build_targets_dist and
+#LineLoss.build_targets_lines) against the per-target loops they replaced (copied below as they were),
+#on random targets with shared cells, repeated targets and tied anchors.
+#Every returned count, mask and target tensor has to be identical. Prints the time of both.
+#   python -m model.testyolo_loss
+
+NUM_TARGETS = [100,300,1000]
+
+def build_targets_loop(
+    pred_boxes, pred_conf, pred_cls, target, target_sizes, anchors, num_anchors, num_classes, grid_sizeH, grid_sizeW, ignore_thres, scale, calcIOUAndDist=False, target_num_neighbors=None
+):
+    nB = pred_boxes.size(0)
+    nA = num_anchors
+    nC = num_classes
+    nH = grid_sizeH
+    nW = grid_sizeW
+    mask = torch.zeros(nB, nA, nH, nW)
+    conf_mask = torch.ones(nB, nA, nH, nW)
+    tx = torch.zeros(nB, nA, nH, nW)
+    ty = torch.zeros(nB, nA, nH, nW)
+    tw = torch.zeros(nB, nA, nH, nW)
+    th = torch.zeros(nB, nA, nH, nW)
+    tconf = torch.ByteTensor(nB, nA, nH, nW).fill_(0)
+    tcls = torch.ByteTensor(nB, nA, nH, nW, nC).fill_(0)
+    if target_num_neighbors is not None:
+        tneighbors = torch.FloatTensor(nB, nA, nH, nW).fill_(0)
+    else:
+        tneighbors=None
+    distances=None
+    ious=None
+
+    nGT = 0
+    nCorrect = 0
+    nCorrect_noclass = 0
+    for b in range(nB):
+        for t in range(target_sizes[b]):
+            # Convert to position relative to box
+            gx = target[b, t, 0] / scale[0]
+            gy = target[b, t, 1] / scale[1]
+            gw = target[b, t, 4] / scale[0]
+            gh = target[b, t, 3] / scale[1]
+
+            if gw==0 or gh==0:
+                continue
+            nGT += 1
+            # Get grid box indices
+            gi = max(min(int(gx),conf_mask.size(3)-1),0)
+            gj = max(min(int(gy),conf_mask.size(2)-1),0)
+            #Get best matching anchor
+            best_n, anch_ious = get_closest_anchor_iou(anchors,gh,gw)
+            # Where the overlap is larger than threshold set mask to zero (ignore)
+            conf_mask[b, anch_ious > ignore_thres, gj, gi] = 0
+            # Get ground truth box
+            gt_box = torch.FloatTensor(np.array([gx, gy, gw, gh])).unsqueeze(0)
+            # Get the best prediction
+            pred_box = pred_boxes[b, best_n, gj, gi].unsqueeze(0)
+            # Masks
+            mask[b, best_n, gj, gi] = 1
+            conf_mask[b, best_n, gj, gi] = 1
+            # Coordigates
+            tx[b, best_n, gj, gi] = inv_tanh(gx - (gi+0.5))
+            ty[b, best_n, gj, gi] = inv_tanh(gy - (gj+0.5))
+            # Width and height
+            tw[b, best_n, gj, gi] = math.log(gw / anchors[best_n][0] + 1e-16)
+            th[b, best_n, gj, gi] = math.log(gh / anchors[best_n][1] + 1e-16)
+            # One-hot encoding of label
+            tcls[b, best_n, gj, gi] = target[b, t,-nC:]
+            if target_num_neighbors is not None:
+                tneighbors[b, best_n, gj, gi] = target_num_neighbors[b, t]
+            tconf[b, best_n, gj, gi] = 1
+
+            # Calculate iou between ground truth and best matching prediction
+            iou = bbox_iou(gt_box, pred_box, x1y1x2y2=False)
+            pred_label = torch.argmax(pred_cls[b, best_n, gj, gi])
+            score = pred_conf[b, best_n, gj, gi]
+            if iou > 0.5 and score > 0:
+                nCorrect_noclass +=1
+                if torch.argmax(target[b,t,13:])==pred_label:
+                    nCorrect += 1
+
+    return nGT, nCorrect, nCorrect_noclass, mask, conf_mask, tx, ty, tw, th, tconf, tcls, tneighbors, distances, ious
+
+def build_targets_dist_loop(
+    pred_points, pred_hws, pred_conf, pred_cls, target, target_sizes, anchors, anchor_points, anchor_hws, num_anchors, num_classes, grid_sizeH, grid_sizeW, ignore_thres, scale
+):
+    nB = pred_points.size(0)
+    nA = num_anchors
+    nC = num_classes
+    nH = grid_sizeH
+    nW = grid_sizeW
+    mask = torch.zeros(nB, nA, nH, nW)
+    conf_mask = torch.ones(nB, nA, nH, nW)
+    tx = torch.zeros(nB, nA, nH, nW)
+    ty = torch.zeros(nB, nA, nH, nW)
+    tw = torch.zeros(nB, nA, nH, nW)
+    th = torch.zeros(nB, nA, nH, nW)
+    tr = torch.zeros(nB, nA, nH, nW)
+    tconf = torch.ByteTensor(nB, nA, nH, nW).fill_(0)
+    tcls = torch.ByteTensor(nB, nA, nH, nW, nC).fill_(0)
+
+    nGT = 0
+    nCorrect = 0
+    for b in range(nB):
+        for t in range(target_sizes[b]):
+            # Convert to position relative to box
+            gx = target[b, t, 0] / scale[0]
+            gy = target[b, t, 1] / scale[0]
+            gw = target[b, t, 4] / scale[0]
+            gh = target[b, t, 3] / scale[0]
+            gr = target[b, t, 2]
+            if gw==0 or gh==0:
+                continue
+            nGT += 1
+            # Get grid box indices
+            gi = max(min(int(gx),conf_mask.size(3)-1),0)
+            gj = max(min(int(gy),conf_mask.size(2)-1),0)
+            # Get shape of gt box
+            gt_points = target[b,t,5:13] / scale[0]
+            gt_points[[0,2,4,6]]-=gx #center the points about the origin instead of BB location
+            gt_points[[1,3,5,7]]-=gy
+            # Calculate iou between gt and anchor shapes
+            anch_dists = bbox_dist(gt_points, (gh+gw)/2.0, anchor_points, anchor_hws)
+            # Where the overlap is larger than threshold set mask to zero (ignore)
+            conf_mask[b, anch_dists < ignore_thres, gj, gi] = 0
+            # Find the best matching anchor box
+            best_n = np.argmin(anch_dists)
+            # Get ground truth box
+            gt_points = target[b,t,5:13] / scale[0]
+            # Get the best prediction
+            pred_point = pred_points[b, best_n, gj, gi]
+            pred_hw = pred_hws[b, best_n, gj, gi]
+            # Masks
+            mask[b, best_n, gj, gi] = 1
+            conf_mask[b, best_n, gj, gi] = 1
+            # Coordinates
+            tx[b, best_n, gj, gi] = inv_tanh(gx - (gi+0.5))
+            ty[b, best_n, gj, gi] = inv_tanh(gy - (gj+0.5))
+            # Rotation
+            rot_diff = gr-anchors[best_n][2]
+            if rot_diff>math.pi:
+                rot_diff-=2*math.pi
+            elif rot_diff<-math.pi:
+                rot_diff+=2*math.pi
+            tr[b, best_n, gj, gi] = inv_tanh(rot_diff/(math.pi/2))
+            # Width and height
+            tw[b, best_n, gj, gi] = math.log(gw / anchors[best_n][0] + 1e-16)
+            th[b, best_n, gj, gi] = math.log(gh / anchors[best_n][1] + 1e-16)
+            # One-hot encoding of label
+            tcls[b, best_n, gj, gi] = target[b, t,13:]
+            tconf[b, best_n, gj, gi] = 1
+
+            # Calculate iou between ground truth and best matching prediction
+            dist = bbox_dist(gt_points, (gh+gw)/2.0, pred_point, pred_hw)
+            pred_label = torch.argmax(pred_cls[b, best_n, gj, gi])
+            score = pred_conf[b, best_n, gj, gi]
+            if dist < 0.85 and pred_label == torch.argmax(target[b,t,13:]) and score > 0.0:
+                nCorrect += 1
+    return nGT, nCorrect, mask, conf_mask, tx, ty, tw, th, tr, tconf, tcls
+
+#LineLoss.build_targets_lines as it was, except that it used an undefined scale (now self.scale)
+def build_targets_lines_loop(
+    scale, num_classes, pred, pred_conf, pred_cls, target, target_sizes, grid_sizeH, grid_sizeW
+):
+    nB = pred.size(0)
+    nC = num_classes
+    nH = grid_sizeH
+    nW = grid_sizeW
+    mask = torch.zeros(nB, nH, nW)
+    conf_mask = torch.ones(nB, nH, nW)
+    tx1 = torch.zeros(nB, nH, nW)
+    ty1 = torch.zeros(nB, nH, nW)
+    tx2 = torch.zeros(nB, nH, nW)
+    ty2 = torch.zeros(nB, nH, nW)
+    tconf = torch.ByteTensor(nB, nH, nW).fill_(0)
+    tcls = torch.ByteTensor(nB, nH, nW, nC).fill_(0)
+
+    nGT = 0
+    for b in range(nB):
+        for t in range(target_sizes[b]):
+            # Convert to position relative to box
+            gx1 = target[b, t, 0] / scale[0]
+            gy1 = target[b, t, 1] / scale[1]
+            gx2 = target[b, t, 2] / scale[0]
+            gy2 = target[b, t, 3] / scale[1]
+            gx = (gx1+gx2)/2.0
+            gy = (gy1+gy2)/2.0
+            nGT += 1
+            # Get grid box indices
+            gi = max(min(int(gx),conf_mask.size(2)-1),0)
+            gj = max(min(int(gy),conf_mask.size(1)-1),0)
+            # Masks
+            mask[b, gj, gi] = 1
+            conf_mask[b, gj, gi] = 1
+            # Coordinates
+            tx1[b, gj, gi] = gx1 - (gi+0.5)
+            ty1[b, gj, gi] = gy1 - (gj+0.5)
+            tx2[b, gj, gi] = gx2 - (gi+0.5)
+            ty2[b, gj, gi] = gy2 - (gj+0.5)
+            # One-hot encoding of label
+            tcls[b, gj, gi] = target[b, t,5:]
+            tconf[b, gj, gi] = 1
+    return nGT, mask, conf_mask, tx1, ty1, tx2, ty2, tconf, tcls
+
+#Random targets, [batch, targets, channels]. They are put in a small grid so many share cells, some are
+#repeated exactly, some have zero size (skipped) and some are off the grid (clamped)
+def random_targets(num_targets, nB, nH, nW, scale, num_channels, nC, gen):
+    T = num_targets
+    target = torch.zeros(nB,T,num_channels)
+    target[:,:,0] = (torch.rand(nB,T,generator=gen)*(nW+1)-0.5)*scale[0]
+    target[:,:,1] = (torch.rand(nB,T,generator=gen)*(nH+1)-0.5)*scale[1]
+    target[:,:,2] = (torch.rand(nB,T,generator=gen)-0.5)*math.pi
+    target[:,:,3] = (torch.rand(nB,T,generator=gen)*3+0.2)*scale[1]
+    target[:,:,4] = (torch.rand(nB,T,generator=gen)*6+0.2)*scale[0]
+    target[:,:,5:-nC] = torch.rand(nB,T,num_channels-5-nC,generator=gen)*nW*scale[0]
+    classes = torch.randint(nC,(nB,T),generator=gen)
+    target[:,:,-nC:] = torch.nn.functional.one_hot(classes,nC).float()
+    #exact repeats
+    repeat_from = torch.randint(T,(nB,T//10),generator=gen)
+    repeat_to = torch.randint(T,(nB,T//10),generator=gen)
+    for b in range(nB):
+        target[b,repeat_to[b]] = target[b,repeat_from[b]]
+    #zero sizes
+    target[:,::17,4] = 0
+    target[:,::23,3] = 0
+    target_sizes = [T]+[T-T//7]*(nB-1)
+    return target, target_sizes
+
+def assert_same(ref, new, name):
+    assert len(ref)==len(new)
+    for i,(r,n) in enumerate(zip(ref,new)):
+        if torch.is_tensor(r) or torch.is_tensor(n):
+            assert torch.is_tensor(r) and torch.is_tensor(n), '{} output {}: one is not a tensor'.format(name,i)
+            assert r.dtype==n.dtype and r.shape==n.shape, '{} output {}: {} {} != {} {}'.format(name,i,r.dtype,r.shape,n.dtype,n.shape)
+            assert torch.equal(r,n), '{} output {}: {} elements differ'.format(name,i,(r!=n).sum().item())
+        else:
+            assert r==n, '{} output {}: {} != {}'.format(name,i,r,n)
+
+def timed(func, *args, **kwargs):
+    tic = timeit.default_timer()
+    out = func(*args, **kwargs)
+    return out, timeit.default_timer()-tic
+
+def check_build_targets(num_targets, gen):
+    nB, nH, nW, nC = 2, 12, 16, 4
+    scale = (8,8)
+    #the repeated anchor makes ties, which have to go to the first one
+    anchors = torch.FloatTensor([[1,1],[2,0.5],[0.5,2],[2,0.5],[4,1],[6,2]])
+    nA = len(anchors)
+    target, target_sizes = random_targets(num_targets, nB, nH, nW, scale, 13+nC, nC, gen)
+    num_neighbors = torch.randint(5,(nB,num_targets),generator=gen).float()
+    pred_boxes = torch.rand(nB,nA,nH,nW,4,generator=gen)
+    pred_boxes[...,0] = pred_boxes[...,0]+torch.arange(nW).float()
+    pred_boxes[...,1] = pred_boxes[...,1]+torch.arange(nH).float()[:,None]
+    pred_boxes[...,2:] = pred_boxes[...,2:]*5
+    pred_conf = torch.randn(nB,nA,nH,nW,generator=gen)
+    pred_cls = torch.randn(nB,nA,nH,nW,nC,generator=gen)
+    args = dict(pred_boxes=pred_boxes, pred_conf=pred_conf, pred_cls=pred_cls, target=target, target_sizes=target_sizes,
+            anchors=anchors, num_anchors=nA, num_classes=nC, grid_sizeH=nH, grid_sizeW=nW, ignore_thres=0.5, scale=scale,
+            target_num_neighbors=num_neighbors)
+    ref, time_ref = timed(build_targets_loop,**args)
+    new, time_new = timed(build_targets,**args)
+    assert_same(ref,new,'build_targets ({} targets)'.format(num_targets))
+    print('build_targets       {:5d} targets: loop {:.4f} sec, vectorized {:.4f} sec ({:.1f}x)'.format(num_targets,time_ref,time_new,time_ref/time_new))
+
+def check_build_targets_dist(num_targets, gen):
+    nB, nH, nW, nC = 2, 12, 16, 4
+    scale = (8,8)
+    #the repeated anchor makes ties, which have to go to the first one
+    anchor_dicts = [{'width':w*scale[0],'height':h*scale[1],'rot':r} for w,h,r in
+            [(1,1,0),(2,0.5,0),(0.5,2,0),(2,0.5,0),(4,1,0.3),(6,2,-0.3),(3,1,math.pi/2)]]
+    loss = YoloDistLoss(nC, True, scale, anchor_dicts)
+    nA = len(anchor_dicts)
+    target, target_sizes = random_targets(num_targets, nB, nH, nW, scale, 13+nC, nC, gen)
+    #the points of each box around its center
+    target[:,:,5:13] = (torch.rand(nB,num_targets,8,generator=gen)-0.5)*4*scale[0]
+    target[:,:,[5,7,9,11]] += target[:,:,0:1]
+    target[:,:,[6,8,10,12]] += target[:,:,1:2]
+    pred_points = torch.rand(nB,nA,nH,nW,8,generator=gen)*4
+    pred_points[...,[0,2,4,6]] += torch.arange(nW).float()[:,None]
+    pred_points[...,[1,3,5,7]] += torch.arange(nH).float()[:,None,None]
+    pred_hws = torch.rand(nB,nA,nH,nW,generator=gen)*3+0.5
+    pred_conf = torch.randn(nB,nA,nH,nW,generator=gen)
+    pred_cls = torch.randn(nB,nA,nH,nW,nC,generator=gen)
+    args = dict(pred_points=pred_points, pred_hws=pred_hws, pred_conf=pred_conf, pred_cls=pred_cls, target=target, target_sizes=target_sizes,
+            anchors=loss.scaled_anchors, anchor_points=loss.scaled_anchor_points, anchor_hws=loss.scaled_anchor_hws, num_anchors=nA,
+            num_classes=nC, grid_sizeH=nH, grid_sizeW=nW, ignore_thres=loss.ignore_thresh, scale=scale)
+    ref, time_ref = timed(build_targets_dist_loop,**args)
+    new, time_new = timed(build_targets_dist,**args)
+    assert_same(ref,new,'build_targets_dist ({} targets)'.format(num_targets))
+    print('build_targets_dist  {:5d} targets: loop {:.4f} sec, vectorized {:.4f} sec ({:.1f}x)'.format(num_targets,time_ref,time_new,time_ref/time_new))
+
+def check_build_targets_lines(num_targets, gen):
+    nB, nH, nW, nC = 2, 12, 16, 3
+    scale = (8,8)
+    loss = LineLoss(nC, scale, 10)
+    #x1,y1,x2,y2, (unused), classes
+    target, target_sizes = random_targets(num_targets, nB, nH, nW, scale, 5+nC, nC, gen)
+    target[:,:,2] = target[:,:,0]+(torch.rand(nB,num_targets,generator=gen)-0.5)*4*scale[0]
+    target[:,:,3] = target[:,:,1]+(torch.rand(nB,num_targets,generator=gen)-0.5)*4*scale[1]
+    pred = torch.rand(nB,nH,nW,4,generator=gen)
+    pred_conf = torch.randn(nB,nH,nW,generator=gen)
+    pred_cls = torch.randn(nB,nH,nW,nC,generator=gen)
+    args = dict(pred=pred, pred_conf=pred_conf, pred_cls=pred_cls, target=target, target_sizes=target_sizes, grid_sizeH=nH, grid_sizeW=nW)
+    ref, time_ref = timed(build_targets_lines_loop,scale,nC,**args)
+    new, time_new = timed(loss.build_targets_lines,**args)
+    assert_same(ref,new,'build_targets_lines ({} targets)'.format(num_targets))
+    print('build_targets_lines {:5d} targets: loop {:.4f} sec, vectorized {:.4f} sec ({:.1f}x)'.format(num_targets,time_ref,time_new,time_ref/time_new))
+
+if __name__ == "__main__":
+    gen = torch.Generator().manual_seed(0)
+    for num_targets in NUM_TARGETS:
+        check_build_targets(num_targets, gen)
+        check_build_targets_dist(num_targets, gen)
+        check_build_targets_lines(num_targets, gen)
+    print('all match')
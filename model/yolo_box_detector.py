@@ -94,9 +94,32 @@ class YoloBoxDetector(nn.Module): #BaseModel
         if self.discard_first_class_pred:
             self.numBBTypes-=1
 
+        self.channels_last=False #set by model.inference_rewriter
+
+        #At inference, if set, only cells with a confidence above this are decoded (see sparse_decode)
+        self.sparse_decode_thresh=None
+
+        #Tiled inference for big images (see forward_down_tiled)
+        self.tile_size=None
+        if 'tile_size' in config and config['tile_size'] is not None:
+            self.setTiling(config['tile_size'],config['tile_overlap'] if 'tile_overlap' in config else 256)
+
+    #Run the backbone on overlapping tiles (at inference) for images bigger than tile_size. The image can be on the CPU
+    #tile_size and overlap are in pixels and need to be multiples of the network's stride
+    def setTiling(self,tile_size,overlap=256):
+        assert self.scale[0]==self.scale[1] and self.scale[0]==int(self.scale[0]), 'tiling needs the same integer stride in x and y'
+        stride = int(self.scale[0])
+        assert tile_size%stride==0 and overlap%stride==0, 'tile_size and overlap need to be multiples of {}'.format(stride)
+        assert overlap<tile_size
+        self.tile_size=tile_size
+        self.tile_overlap=overlap
+
     def forward(self, img):
         #import pdb; pdb.set_trace()
-        y = self._hack_down(img)
+        if self.tile_size is not None and not self.training:
+            y = self.forward_down_tiled(img) #(a single tile if the image is small enough)
+        else:
+            y = self._hack_down(self.prepare_input(img))
         if self.discard_first_class_pred:
             to_cat = []
             for a in range(self.numAnchors):
@@ -117,60 +140,63 @@ class YoloBoxDetector(nn.Module): #BaseModel
         priors_0 = torch.arange(0,y.size(2)).type_as(img.data)[None,:,None]
         priors_0 = (priors_0 + 0.5) * self.scale[1] #self.base_0
         priors_0 = priors_0.expand(y.size(0), priors_0.size(1), y.size(3))
-        priors_0 = priors_0[:,None,:,:].to(img.device)
+        priors_0 = priors_0[:,None,:,:].to(y.device)
 
         #priors_1 = Variable(torch.arange(0,y.size(3)).type_as(img.data), requires_grad=False)[None,None,:]
         priors_1 = torch.arange(0,y.size(3)).type_as(img.data)[None,None,:]
         priors_1 = (priors_1 + 0.5) * self.scale[0] #elf.base_1
         priors_1 = priors_1.expand(y.size(0), y.size(2), priors_1.size(2))
-        priors_1 = priors_1[:,None,:,:].to(img.device)
-
-        anchor = self.anchors
-        pred_boxes=[]
-        pred_offsets=[] #we seperate anchor predictions here. And compute actual bounding boxes
-        for i in range(self.numAnchors):
-
-            offset = i*(self.numBBParams+self.numBBTypes)
-            if self.rotation:
-                rot_dif = (math.pi/2)*torch.tanh(y[:,3+offset:4+offset,:,:])
-            else:
-                rot_dif = torch.zeros_like(y[:,3+offset:4+offset,:,:])
-
-            stackedPred = [
-                torch.sigmoid(y[:,0+offset:1+offset,:,:]),                #0. confidence
-                torch.tanh(y[:,1+offset:2+offset,:,:])*self.scale[0] + priors_1,        #1. x-center
-                torch.tanh(y[:,2+offset:3+offset,:,:])*self.scale[1] + priors_0,        #2. y-center
-                rot_dif + anchor[i]['rot'],      #3. rotation (radians)
-                torch.exp(y[:,4+offset:5+offset,:,:]) * anchor[i]['height'], #4. height (half), I don't think this needs scaled
-                torch.exp(y[:,5+offset:6+offset,:,:]) * anchor[i]['width'],  #5. width (half)   as we scale the anchors in training
-            ]
+        priors_1 = priors_1[:,None,:,:].to(y.device)
 
-
-            if self.predNumNeighbors:
-                stackedPred.append(1+y[:,6+offset:7+offset,:,:]) #+1 so predicted -1 is 0 neighbors
-                extra=1
-            else:
-                extra=0
-            for j in range(self.numBBTypes):
-                stackedPred.append(torch.sigmoid(y[:,6+j+extra+offset:7+j+extra+offset,:,:]))         #x. class prediction
-                #stackedOffsets.append(y[:,6+j+offset:7+j+offset,:,:])         #x. class prediction
-            pred_boxes.append(torch.cat(stackedPred, dim=1))
-            #pred_offsets.append(torch.cat(stackedOffsets, dim=1))
-            pred_offsets.append(y[:,offset:offset+self.numBBParams+self.numBBTypes,:,:])
-
-        if len(pred_boxes)>0:
-            bbPredictions = torch.stack(pred_boxes, dim=1)
-            offsetPredictions = torch.stack(pred_offsets, dim=1)
+        if self.sparse_decode_thresh is not None and not self.training and self.numAnchors>0:
+            bbPredictions, offsetPredictions = self.sparse_decode(y,self.sparse_decode_thresh)
+        else:
+            anchor = self.anchors
+            pred_boxes=[]
+            pred_offsets=[] #we seperate anchor predictions here. And compute actual bounding boxes
+            for i in range(self.numAnchors):
+
+                offset = i*(self.numBBParams+self.numBBTypes)
+                if self.rotation:
+                    rot_dif = (math.pi/2)*torch.tanh(y[:,3+offset:4+offset,:,:])
+                else:
+                    rot_dif = torch.zeros_like(y[:,3+offset:4+offset,:,:])
+
+                stackedPred = [
+                    torch.sigmoid(y[:,0+offset:1+offset,:,:]),                #0. confidence
+                    torch.tanh(y[:,1+offset:2+offset,:,:])*self.scale[0] + priors_1,        #1. x-center
+                    torch.tanh(y[:,2+offset:3+offset,:,:])*self.scale[1] + priors_0,        #2. y-center
+                    rot_dif + anchor[i]['rot'],      #3. rotation (radians)
+                    torch.exp(y[:,4+offset:5+offset,:,:]) * anchor[i]['height'], #4. height (half), I don't think this needs scaled
+                    torch.exp(y[:,5+offset:6+offset,:,:]) * anchor[i]['width'],  #5. width (half)   as we scale the anchors in training
+                ]
+
+
+                if self.predNumNeighbors:
+                    stackedPred.append(1+y[:,6+offset:7+offset,:,:]) #+1 so predicted -1 is 0 neighbors
+                    extra=1
+                else:
+                    extra=0
+                for j in range(self.numBBTypes):
+                    stackedPred.append(torch.sigmoid(y[:,6+j+extra+offset:7+j+extra+offset,:,:]))         #x. class prediction
+                    #stackedOffsets.append(y[:,6+j+offset:7+j+offset,:,:])         #x. class prediction
+                pred_boxes.append(torch.cat(stackedPred, dim=1))
+                #pred_offsets.append(torch.cat(stackedOffsets, dim=1))
+                pred_offsets.append(y[:,offset:offset+self.numBBParams+self.numBBTypes,:,:])
+
+            if len(pred_boxes)>0:
+                bbPredictions = torch.stack(pred_boxes, dim=1)
+                offsetPredictions = torch.stack(pred_offsets, dim=1)
             
-            bbPredictions = bbPredictions.transpose(2,4).contiguous()#from [batch, anchors, channel, rows, cols] to [batch, anchros, cols, rows, channels]
-            bbPredictions = bbPredictions.view(bbPredictions.size(0),bbPredictions.size(1),-1,bbPredictions.size(4))#flatten to [batch, anchors, instances, channel]
-            #avg_conf_per_anchor = bbPredictions[:,:,:,0].mean(dim=0).mean(dim=1)
-            bbPredictions = bbPredictions.view(bbPredictions.size(0),-1,bbPredictions.size(3)) #[batch, instances+anchors, channel]
+                bbPredictions = bbPredictions.transpose(2,4).contiguous()#from [batch, anchors, channel, rows, cols] to [batch, anchros, cols, rows, channels]
+                bbPredictions = bbPredictions.view(bbPredictions.size(0),bbPredictions.size(1),-1,bbPredictions.size(4))#flatten to [batch, anchors, instances, channel]
+                #avg_conf_per_anchor = bbPredictions[:,:,:,0].mean(dim=0).mean(dim=1)
+                bbPredictions = bbPredictions.view(bbPredictions.size(0),-1,bbPredictions.size(3)) #[batch, instances+anchors, channel]
 
-            offsetPredictions = offsetPredictions.permute(0,1,3,4,2).contiguous()
-        else:
-            bbPredictions=None
-            offsetPredictions=None
+                offsetPredictions = offsetPredictions.permute(0,1,3,4,2).contiguous()
+            else:
+                bbPredictions=None
+                offsetPredictions=None
 
         linePreds=[]
         offsetLinePreds=[]
@@ -223,6 +249,140 @@ class YoloBoxDetector(nn.Module): #BaseModel
 
         return bbPredictions, offsetPredictions, linePreds, offsetLinePreds, pointPreds, pixelPreds #, avg_conf_per_anchor
 
+    def prepare_input(self,img):
+        if self.channels_last:
+            return img.contiguous(memory_format=torch.channels_last)
+        return img
+
+    #Inference decode that only decodes anchors with a confidence above thresh.
+    #Returns the same rows (and order) the dense decode would have after dropping those below thresh, [batch, candidates, channels]
+    #Batches are padded with zero confidence rows to the largest candidate count
+    def sparse_decode(self,y,thresh):
+        batch_size = y.size(0)
+        H = y.size(2)
+        W = y.size(3)
+        numP = self.numBBParams+self.numBBTypes
+        raw = y[:,:numP*self.numAnchors].view(batch_size,self.numAnchors,numP,H,W)
+        offsetPredictions = raw.permute(0,1,3,4,2).contiguous()
+
+        #dense order is [anchors, cols, rows]
+        conf = torch.sigmoid(raw[:,:,0].transpose(2,3)).reshape(batch_size,-1)
+        keep = conf>thresh
+        counts = keep.sum(dim=1)
+        max_count = int(counts.max().item()) if batch_size>0 else 0
+        bbPredictions = y.new_zeros(batch_size,max_count,numP)
+        if max_count==0:
+            return bbPredictions, offsetPredictions
+
+        anchor_rot = torch.tensor([a['rot'] for a in self.anchors],dtype=y.dtype,device=y.device)
+        anchor_h = torch.tensor([a['height'] for a in self.anchors],dtype=y.dtype,device=y.device)
+        anchor_w = torch.tensor([a['width'] for a in self.anchors],dtype=y.dtype,device=y.device)
+        for b in range(batch_size):
+            idx = keep[b].nonzero(as_tuple=False)[:,0]
+            a = idx//(W*H)
+            col = (idx%(W*H))//H
+            row = idx%H
+            cand = raw[b,a,:,row,col] #[candidates, params]
+
+            if self.rotation:
+                rot_dif = (math.pi/2)*torch.tanh(cand[:,3])
+            else:
+                rot_dif = torch.zeros_like(cand[:,3])
+            priors_x = (col.to(y.dtype)+0.5)*self.scale[0]
+            priors_y = (row.to(y.dtype)+0.5)*self.scale[1]
+            stackedPred = [
+                conf[b,idx],
+                torch.tanh(cand[:,1])*self.scale[0] + priors_x,
+                torch.tanh(cand[:,2])*self.scale[1] + priors_y,
+                rot_dif + anchor_rot[a],
+                torch.exp(cand[:,4]) * anchor_h[a],
+                torch.exp(cand[:,5]) * anchor_w[a],
+            ]
+            if self.predNumNeighbors:
+                stackedPred.append(1+cand[:,6])
+                extra=1
+            else:
+                extra=0
+            bbPredictions[b,:idx.size(0),:6+extra] = torch.stack(stackedPred,dim=1)
+            bbPredictions[b,:idx.size(0),6+extra:] = torch.sigmoid(cand[:,6+extra:6+extra+self.numBBTypes])
+        return bbPredictions, offsetPredictions
+
+    #Runs _hack_down on overlapping tiles and stitches the outputs (and saved features) into page level maps.
+    #Each tile only contributes the cells in the middle of its overlaps, so the decoded predictions are page level
+    #and the usual NMS afterwards removes duplicates across tile boundaries.
+    #Tiles are moved to the model's device one at a time, so the page image can stay on the CPU.
+    #The last tile in each direction runs to the page's edge, so the maps come out the size the untiled network gives.
+    def forward_down_tiled(self,img):
+        stride = int(self.scale[0])
+        device = next(self.parameters()).device
+        H = img.size(2)
+        W = img.size(3)
+        starts_y, size_y = self._tile_starts(H,stride)
+        starts_x, size_x = self._tile_starts(W,stride)
+        own_y = self._tile_owned(starts_y,size_y,H,stride)
+        own_x = self._tile_owned(starts_x,size_x,W,stride)
+
+        y=None
+        feats=None
+        feats2=None
+        use_feats2 = hasattr(self,'save2_scale')
+        ends_y = [ty+size_y for ty in starts_y[:-1]]+[H]
+        ends_x = [tx+size_x for tx in starts_x[:-1]]+[W]
+        #bottom right tile first, its output gives the page level map sizes
+        for ty,ey,oy in reversed(list(zip(starts_y,ends_y,own_y))):
+            for tx,ex,ox in reversed(list(zip(starts_x,ends_x,own_x))):
+                tile = self.prepare_input(img[:,:,ty:ey,tx:ex].to(device))
+                y_t = self._hack_down(tile)
+                y = self._place_tile(y,y_t,stride,ty,tx,oy,ox)
+                if self.forGraphPairing:
+                    feats = self._place_tile(feats,self.saved_features,self.save_scale,ty,tx,oy,ox)
+                    if use_feats2:
+                        feats2 = self._place_tile(feats2,self.saved_features2,self.save2_scale,ty,tx,oy,ox)
+                tile=y_t=None
+        if self.forGraphPairing:
+            self.saved_features=feats
+            if use_feats2:
+                self.saved_features2=feats2
+        return y
+
+    #start positions of the tiles along one dimension, the last tile is aligned to the end (rounded to the stride)
+    def _tile_starts(self,length,stride):
+        if length<=self.tile_size:
+            return [0], length
+        step = self.tile_size-self.tile_overlap
+        starts=[]
+        start=0
+        while start+self.tile_size<length:
+            starts.append(start)
+            start+=step
+        last = ((length-self.tile_size)//stride)*stride
+        if last>starts[-1]:
+            starts.append(last)
+        return starts, self.tile_size
+
+    #the range (pixels) each tile is responsible for. Boundaries are the middle of the overlaps
+    def _tile_owned(self,starts,size,length,stride):
+        bounds=[0]
+        for a,b in zip(starts[:-1],starts[1:]):
+            bounds.append((((b+a+size)//2)//stride)*stride)
+        bounds.append(length)
+        return [(bounds[i],bounds[i+1]) for i in range(len(starts))]
+
+    #copy the owned part of a tile's output (at the given scale) into the page level map, allocating it if needed
+    #(from the bottom right tile, which ends at the page's edge)
+    def _place_tile(self,page,tile_out,scale,ty,tx,own_y,own_x):
+        if page is None:
+            page = tile_out.new_zeros(tile_out.size(0),tile_out.size(1),ty//scale+tile_out.size(2),tx//scale+tile_out.size(3))
+        r0 = (own_y[0]-ty)//scale
+        c0 = (own_x[0]-tx)//scale
+        #the last tile owns up to the edge, which may be a partial cell
+        rows = min(-(-own_y[1]//scale),page.size(2)) - own_y[0]//scale
+        cols = min(-(-own_x[1]//scale),page.size(3)) - own_x[0]//scale
+        rows = min(rows,tile_out.size(2)-r0)
+        cols = min(cols,tile_out.size(3)-c0)
+        page[:,:,own_y[0]//scale:own_y[0]//scale+rows,own_x[0]//scale:own_x[0]//scale+cols] = tile_out[:,:,r0:r0+rows,c0:c0+cols]
+        return page
+
     def summary(self):
         """
         Model summary
@@ -295,6 +295,52 @@ def multi_get_closest_anchor_iou(anchors,gh,gws):
 
     return best_n, anch_ious
 
+#The (b,t) index of every target, in the order the per-target loops used to visit them
+def _flat_target_indexes(target, target_sizes, nB):
+    if target is None:
+        empty = torch.LongTensor(0)
+        return empty, empty
+    sizes = torch.as_tensor(target_sizes).view(-1).cpu().long()[:nB]
+    valid = torch.arange(target.size(1))[None,:] < sizes[:,None]
+    b_idx, t_idx = valid.nonzero(as_tuple=True)
+    return b_idx, t_idx
+
+#Grid cell of each target, the same as max(min(int(g),size-1),0)
+def _grid_cells(gx, gy, nH, nW):
+    gi = gx.long().clamp(0,nW-1)
+    gj = gy.long().clamp(0,nH-1)
+    return gi, gj
+
+#Given the flat index written by each target (in target order), returns which targets' writes survive:
+#the last write to each index, as when the targets were assigned one at a time
+def _last_writes(keys):
+    if len(keys)==0:
+        return keys
+    order = torch.arange(len(keys))
+    perm = (keys*len(keys)+order).argsort()
+    sorted_keys = keys[perm]
+    last = torch.ones(len(keys),dtype=torch.bool)
+    last[:-1] = sorted_keys[1:]!=sorted_keys[:-1]
+    return perm[last]
+
+#First index of the max in each row (np.argmax's tie breaking)
+def _first_argmax(values):
+    idx = torch.arange(values.size(1))[None,:].expand_as(values)
+    is_max = values==values.max(dim=1,keepdim=True)[0]
+    return torch.where(is_max,idx,torch.full_like(idx,values.size(1))).min(dim=1)[0]
+
+#inv_tanh (utils.util) applied to a tensor. The log is taken in double as math.log did
+def _inv_tanh(y):
+    ratio = ((1+y)/(1-y)).double()
+    out = 0.5*ratio.log()
+    out = torch.where(y<=-1,torch.full_like(out,-2),out)
+    out = torch.where(y>=1,torch.full_like(out,2),out)
+    return out.float()
+
+#math.log(v) of a float tensor, stored back as float
+def _log(v):
+    return v.double().log().float()
+
 def build_targets(
     pred_boxes, pred_conf, pred_cls, target, target_sizes, anchors, num_anchors, num_classes, grid_sizeH, grid_sizeW, ignore_thres, scale, calcIOUAndDist=False, target_num_neighbors=None
 ):
@@ -322,74 +368,71 @@ def build_targets(
         distances=None
         ious=None
 
-    nGT = 0
-    nCorrect = 0
-    nCorrect_noclass = 0
-    #import pdb; pdb.set_trace()
-    for b in range(nB):
-        if calcIOUAndDist and target_sizes[b]>0:
-            raise Exception('caclIOUAndDist does not have normalized target (scaled)')
-            flat_pred = pred_boxes[b].view(-1,pred_boxes.size(-1))
-            #flat_target = target[b,:target_sizes[b]].view(-1,target.size(-1))
-            iousB = allIOU(flat_pred,target[b,:target_sizes[b]], boxes1XYWH=[0,1,2,3])
-            iousB = iousB.view(nA, nH, nW,-1)
-            ious[b] = iousB.max(dim=-1)[0]
-            distancesB = allDist(flat_pred,target[b,:target_sizes[b]])
-            distances[b] = distancesB.min(dim=-1)[0].view(nA, nH, nW)
-            #import pdb;pdb.set_trace()
-        
-        for t in range(target_sizes[b]): #range(target.shape[1]):
-            #if target[b, t].sum() == 0:
-            #    continue
-            # Convert to position relative to box
-            gx = target[b, t, 0] / scale[0]
-            gy = target[b, t, 1] / scale[1]
-            gw = target[b, t, 4] / scale[0]
-            gh = target[b, t, 3] / scale[1]
-        
-            if gw==0 or gh==0:
-                continue
-            nGT += 1
-            # Get grid box indices
-            gi = max(min(int(gx),conf_mask.size(3)-1),0)
-            gj = max(min(int(gy),conf_mask.size(2)-1),0)
-            #Get best matching anchor
-            best_n, anch_ious = get_closest_anchor_iou(anchors,gh,gw)
-            # Where the overlap is larger than threshold set mask to zero (ignore)
-            conf_mask[b, anch_ious > ignore_thres, gj, gi] = 0
-            # Get ground truth box
-            gt_box = torch.FloatTensor(np.array([gx, gy, gw, gh])).unsqueeze(0)
-            # Get the best prediction
-            pred_box = pred_boxes[b, best_n, gj, gi].unsqueeze(0)
-            # Masks
-            mask[b, best_n, gj, gi] = 1
-            conf_mask[b, best_n, gj, gi] = 1 #why not just set this to 0?
-            # Coordigates
-            tx[b, best_n, gj, gi] = inv_tanh(gx - (gi+0.5))
-            ty[b, best_n, gj, gi] = inv_tanh(gy - (gj+0.5))
-            # Width and height
-            tw[b, best_n, gj, gi] = math.log(gw / anchors[best_n][0] + 1e-16)
-            th[b, best_n, gj, gi] = math.log(gh / anchors[best_n][1] + 1e-16)
-            # One-hot encoding of label
-            #target_label = int(target[b, t, 0])
-            tcls[b, best_n, gj, gi] = target[b, t,-nC:]
-            if target_num_neighbors is not None:
-                tneighbors[b, best_n, gj, gi] = target_num_neighbors[b, t]
-            tconf[b, best_n, gj, gi] = 1
-
-            # Calculate iou between ground truth and best matching prediction
-            if calcIOUAndDist:
-                #iou = ious[best_n*(nH*nW) + gj*(nW) + gi,t]
-                iou = iousB[best_n, gj, gi, t]
-            else:
-                iou = bbox_iou(gt_box, pred_box, x1y1x2y2=False)
-            pred_label = torch.argmax(pred_cls[b, best_n, gj, gi])
-            score = pred_conf[b, best_n, gj, gi]
-            #import pdb; pdb.set_trace()
-            if iou > 0.5 and score > 0:
-                nCorrect_noclass +=1
-                if torch.argmax(target[b,t,13:])==pred_label:
-                    nCorrect += 1
+    b_idx, t_idx = _flat_target_indexes(target, target_sizes, nB)
+    if calcIOUAndDist and len(b_idx)>0:
+        raise Exception('caclIOUAndDist does not have normalized target (scaled)')
+
+    #All targets are assigned at once. Where two targets land on the same cell the later one wins, as with the old per-target loop
+    if len(b_idx)>0:
+        tgt = target[b_idx,t_idx]
+        # Convert to position relative to box
+        gx = tgt[:,0] / scale[0]
+        gy = tgt[:,1] / scale[1]
+        gw = tgt[:,4] / scale[0]
+        gh = tgt[:,3] / scale[1]
+        keep = (gw!=0) & (gh!=0)
+        b_idx, t_idx, tgt = b_idx[keep], t_idx[keep], tgt[keep]
+        gx, gy, gw, gh = gx[keep], gy[keep], gw[keep], gh[keep]
+    nGT = len(b_idx)
+    if nGT==0:
+        return nGT, 0, 0, mask, conf_mask, tx, ty, tw, th, tconf, tcls, tneighbors, distances, ious
+
+    # Get grid box indices
+    gi, gj = _grid_cells(gx, gy, nH, nW)
+    #Get best matching anchor
+    gt_shapes = torch.zeros(nGT,4)
+    gt_shapes[:,2] = gw
+    gt_shapes[:,3] = gh
+    anchor_shapes = torch.FloatTensor(np.concatenate((np.zeros((len(anchors), 2)), np.array(anchors)), 1))
+    anch_ious = multi_bbox_iou(gt_shapes, anchor_shapes) #these are at half their size, but IOU is the same
+    best_n = _first_argmax(anch_ious)
+
+    # Where the overlap is larger than threshold set mask to zero (ignore), but the best anchor is set to 1
+    anchor_idx = torch.arange(nA)[None,:].expand(nGT,-1)
+    is_best = anchor_idx==best_n[:,None]
+    touched = is_best | (anch_ious > ignore_thres)
+    cell_keys = ((b_idx[:,None]*nA+anchor_idx)*nH+gj[:,None])*nW+gi[:,None]
+    cell_keys = cell_keys[touched]
+    cell_values = is_best[touched].float()
+    last = _last_writes(cell_keys)
+    conf_mask.view(-1)[cell_keys[last]] = cell_values[last]
+
+    # Masks and targets at each target's best anchor
+    keys = ((b_idx*nA+best_n)*nH+gj)*nW+gi
+    last = _last_writes(keys)
+    keys_last = keys[last]
+    mask.view(-1)[keys_last] = 1
+    # Coordinates
+    tx.view(-1)[keys_last] = _inv_tanh(gx - (gi.float()+0.5))[last]
+    ty.view(-1)[keys_last] = _inv_tanh(gy - (gj.float()+0.5))[last]
+    # Width and height
+    tw.view(-1)[keys_last] = _log(gw / anchors[best_n,0] + 1e-16)[last]
+    th.view(-1)[keys_last] = _log(gh / anchors[best_n,1] + 1e-16)[last]
+    # One-hot encoding of label
+    tcls.view(-1,nC)[keys_last] = tgt[last,-nC:].byte()
+    if target_num_neighbors is not None:
+        tneighbors.view(-1)[keys_last] = target_num_neighbors[b_idx[last],t_idx[last]].cpu().float()
+    tconf.view(-1)[keys_last] = 1
+
+    # Calculate iou between ground truth and best matching prediction
+    gt_box = torch.stack([gx, gy, gw, gh],dim=1)
+    pred_box = pred_boxes[b_idx, best_n, gj, gi]
+    iou = bbox_iou(gt_box, pred_box, x1y1x2y2=False)
+    pred_label = torch.argmax(pred_cls[b_idx, best_n, gj, gi],dim=1)
+    score = pred_conf[b_idx, best_n, gj, gi]
+    correct_noclass = (iou > 0.5) & (score > 0)
+    nCorrect_noclass = int(correct_noclass.sum())
+    nCorrect = int((correct_noclass & (torch.argmax(tgt[:,13:],dim=1)==pred_label)).sum())
 
     return nGT, nCorrect, nCorrect_noclass, mask, conf_mask, tx, ty, tw, th, tconf, tcls, tneighbors, distances, ious
 
@@ -606,71 +649,71 @@ def build_targets_dist(
     tconf = torch.ByteTensor(nB, nA, nH, nW).fill_(0)
     tcls = torch.ByteTensor(nB, nA, nH, nW, nC).fill_(0)
 
-    nGT = 0
-    nCorrect = 0
-    for b in range(nB):
-        for t in range(target_sizes[b]): #range(target.shape[1]):
-            #if target[b, t].sum() == 0:
-            #    continue
-
-            # Convert to position relative to box
-            gx = target[b, t, 0] / scale[0]
-            gy = target[b, t, 1] / scale[0]
-            gw = target[b, t, 4] / scale[0]
-            gh = target[b, t, 3] / scale[0]
-            gr = target[b, t, 2]
-            if gw==0 or gh==0:
-                continue
-            nGT += 1
-            # Get grid box indices
-            gi = max(min(int(gx),conf_mask.size(3)-1),0)
-            gj = max(min(int(gy),conf_mask.size(2)-1),0)
-            # Get shape of gt box
-            gt_points = target[b,t,5:13] / scale[0]
-            gt_points[[0,2,4,6]]-=gx #center the points about the origin instead of BB location
-            gt_points[[1,3,5,7]]-=gy
-            # Get shape of anchor box
-            #anchor_shapes = torch.FloatTensor(np.concatenate((np.zeros((len(anchors), 2)), np.array(anchors)), 1))
-            # Calculate iou between gt and anchor shapes
-            anch_dists = bbox_dist(gt_points, (gh+gw)/2.0, anchor_points, anchor_hws)
-            # Where the overlap is larger than threshold set mask to zero (ignore)
-            conf_mask[b, anch_dists < ignore_thres, gj, gi] = 0
-            # Find the best matching anchor box
-            best_n = np.argmin(anch_dists)
-            # Get ground truth box
-            gt_points = target[b,t,5:13] / scale[0]
-            #gt_points[[0,2,4,6]]+=gx
-            #gt_points[[1,3,5,7]]+=gy
-            # Get the best prediction
-            pred_point = pred_points[b, best_n, gj, gi]#.unsqueeze(0)
-            pred_hw = pred_hws[b, best_n, gj, gi]#.unsqueeze(0)
-            # Masks
-            mask[b, best_n, gj, gi] = 1
-            conf_mask[b, best_n, gj, gi] = 1
-            # Coordinates
-            tx[b, best_n, gj, gi] = inv_tanh(gx - (gi+0.5))
-            ty[b, best_n, gj, gi] = inv_tanh(gy - (gj+0.5))
-            # Rotation
-            rot_diff = gr-anchors[best_n][2]
-            if rot_diff>math.pi:
-                rot_diff-=2*math.pi
-            elif rot_diff<-math.pi:
-                rot_diff+=2*math.pi
-            tr[b, best_n, gj, gi] = inv_tanh(rot_diff/(math.pi/2))
-            # Width and height
-            tw[b, best_n, gj, gi] = math.log(gw / anchors[best_n][0] + 1e-16)
-            th[b, best_n, gj, gi] = math.log(gh / anchors[best_n][1] + 1e-16)
-            # One-hot encoding of label
-            #target_label = int(target[b, t, 0])
-            tcls[b, best_n, gj, gi] = target[b, t,13:]
-            tconf[b, best_n, gj, gi] = 1
-
-            # Calculate iou between ground truth and best matching prediction
-            dist = bbox_dist(gt_points, (gh+gw)/2.0, pred_point, pred_hw)
-            pred_label = torch.argmax(pred_cls[b, best_n, gj, gi])
-            score = pred_conf[b, best_n, gj, gi]
-            if dist < 0.85 and pred_label == torch.argmax(target[b,t,13:]) and score > 0.0:
-                nCorrect += 1
+    #All targets are assigned at once, the later target winning a shared cell (see build_targets)
+    b_idx, t_idx = _flat_target_indexes(target, target_sizes, nB)
+    if len(b_idx)>0:
+        tgt = target[b_idx,t_idx]
+        # Convert to position relative to box
+        gx = tgt[:,0] / scale[0]
+        gy = tgt[:,1] / scale[0]
+        gw = tgt[:,4] / scale[0]
+        gh = tgt[:,3] / scale[0]
+        gr = tgt[:,2]
+        keep = (gw!=0) & (gh!=0)
+        b_idx, tgt = b_idx[keep], tgt[keep]
+        gx, gy, gw, gh, gr = gx[keep], gy[keep], gw[keep], gh[keep], gr[keep]
+    nGT = len(b_idx)
+    if nGT==0:
+        return nGT, 0, mask, conf_mask, tx, ty, tw, th, tr, tconf, tcls
+
+    # Get grid box indices
+    gi, gj = _grid_cells(gx, gy, nH, nW)
+    # Get shape of gt box
+    gt_points = tgt[:,5:13] / scale[0]
+    gt_hws = (gh+gw)/2.0
+    centered_points = gt_points.clone()
+    centered_points[:,[0,2,4,6]]-=gx[:,None] #center the points about the origin instead of BB location
+    centered_points[:,[1,3,5,7]]-=gy[:,None]
+    # Calculate distance between gt and anchor shapes
+    anch_dists = bbox_dist(centered_points, gt_hws, anchor_points, anchor_hws)
+    # Find the best matching anchor box
+    best_n = _first_argmax(-anch_dists)
+
+    # Where the distance is smaller than threshold set mask to zero (ignore), but the best anchor is set to 1
+    anchor_idx = torch.arange(nA)[None,:].expand(nGT,-1)
+    is_best = anchor_idx==best_n[:,None]
+    touched = is_best | (anch_dists < ignore_thres)
+    cell_keys = ((b_idx[:,None]*nA+anchor_idx)*nH+gj[:,None])*nW+gi[:,None]
+    cell_keys = cell_keys[touched]
+    cell_values = is_best[touched].float()
+    last = _last_writes(cell_keys)
+    conf_mask.view(-1)[cell_keys[last]] = cell_values[last]
+
+    # Masks and targets at each target's best anchor
+    keys = ((b_idx*nA+best_n)*nH+gj)*nW+gi
+    last = _last_writes(keys)
+    keys_last = keys[last]
+    mask.view(-1)[keys_last] = 1
+    # Coordinates
+    tx.view(-1)[keys_last] = _inv_tanh(gx - (gi.float()+0.5))[last]
+    ty.view(-1)[keys_last] = _inv_tanh(gy - (gj.float()+0.5))[last]
+    # Rotation
+    rot_diff = gr-anchors[best_n,2]
+    rot_diff = torch.where(rot_diff>math.pi, rot_diff-2*math.pi, rot_diff)
+    rot_diff = torch.where(rot_diff<-math.pi, rot_diff+2*math.pi, rot_diff)
+    tr.view(-1)[keys_last] = _inv_tanh(rot_diff/(math.pi/2))[last]
+    # Width and height
+    tw.view(-1)[keys_last] = _log(gw / anchors[best_n,0] + 1e-16)[last]
+    th.view(-1)[keys_last] = _log(gh / anchors[best_n,1] + 1e-16)[last]
+    # One-hot encoding of label
+    tcls.view(-1,nC)[keys_last] = tgt[last,13:].byte()
+    tconf.view(-1)[keys_last] = 1
+
+    # Calculate distance between ground truth and best matching prediction
+    dist = paired_bbox_dist(gt_points, gt_hws, pred_points[b_idx, best_n, gj, gi], pred_hws[b_idx, best_n, gj, gi])
+    pred_label = torch.argmax(pred_cls[b_idx, best_n, gj, gi],dim=1)
+    score = pred_conf[b_idx, best_n, gj, gi]
+    nCorrect = int(((dist < 0.85) & (pred_label == torch.argmax(tgt[:,13:],dim=1)) & (score > 0.0)).sum())
     #nGT, nCorrect, mask, conf_mask, tx, ty, tw, th, tr, tconf, tcls
     return nGT, nCorrect, mask, conf_mask, tx, ty, tw, th, tr, tconf, tcls
 
@@ -727,6 +770,16 @@ def bbox_dist(box1, box1H, box2, box2H):
 
 
 
+def paired_bbox_dist(box1, box1H, box2, box2H):
+    """
+    Returns the point distance of each box1 to the box2 in the same row
+    (bbox_dist of two single boxes, for many pairs at once)
+    """
+    diff = box1-box2
+    normalizer = (box1H+box2H)/2.0
+    return ((torch.norm(diff[:,0:2],2,1)+torch.norm(diff[:,2:4],2,1)+torch.norm(diff[:,4:6],2,1)+torch.norm(diff[:,6:8],2,1))/normalizer)**2
+
+
 class LineLoss (nn.Module):
     def __init__(self, num_classes, scale,  anchor_h,bad_conf_weight=1.25):
         super(LineLoss, self).__init__()
@@ -860,44 +913,38 @@ class LineLoss (nn.Module):
         tconf = torch.ByteTensor(nB, nH, nW).fill_(0)
         tcls = torch.ByteTensor(nB, nH, nW, nC).fill_(0)
 
-        nGT = 0
-        for b in range(nB):
-            for t in range(target_sizes[b]): #range(target.shape[1]):
-                #if target[b, t].sum() == 0:
-                #    continue
-
-                # Convert to position relative to box
-                gx1 = target[b, t, 0] / scale[0]
-                gy1 = target[b, t, 1] / scale[1]
-                gx2 = target[b, t, 2] / scale[0]
-                gy2 = target[b, t, 3] / scale[1]
-                gx = (gx1+gx2)/2.0
-                gy = (gy1+gy2)/2.0
-                #if gh==0:
-                #    continue
-                nGT += 1
-                # Get grid box indices
-                gi = max(min(int(gx),conf_mask.size(2)-1),0)
-                gj = max(min(int(gy),conf_mask.size(1)-1),0)
-                # Masks
-                mask[b, gj, gi] = 1
-                conf_mask[b, gj, gi] = 1
-                # Coordinates
-                tx1[b, gj, gi] = gx1 - (gi+0.5) #inv_tanh(gx1 - (gi+0.5))
-                ty1[b, gj, gi] = gy1 - (gj+0.5) #inv_tanh(gy1 - (gj+0.5))
-                tx2[b, gj, gi] = gx2 - (gi+0.5) #inv_tanh(gx2 - (gi+0.5))
-                ty2[b, gj, gi] = gy2 - (gj+0.5) #inv_tanh(gy2 - (gj+0.5))
-                # One-hot encoding of label
-                #target_label = int(target[b, t, 0])
-                tcls[b, gj, gi] = target[b, t,5:]
-                tconf[b, gj, gi] = 1
-
-                # Calculate iou between ground truth and best matching prediction
-                #dist = bbox_dist(gt_points, (gh+gw)/2.0, pred_point, pred_hw)
-                #dist = 
-                #pred_label = torch.argmax(pred_cls[b, gj, gi])
-                #score = pred_conf[b, gj, gi]
-                #if dist < 0.85 and pred_label == torch.argmax(target[b,t,13:]) and score > 0.0:
-                #    nCorrect += 1
+        #All targets are assigned at once, the later target winning a shared cell (see build_targets)
+        b_idx, t_idx = _flat_target_indexes(target, target_sizes, nB)
+        nGT = len(b_idx)
+        if nGT==0:
+            return nGT, mask, conf_mask, tx1, ty1, tx2, ty2, tconf, tcls
+        tgt = target[b_idx,t_idx]
+
+        # Convert to position relative to box
+        gx1 = tgt[:,0] / self.scale[0]
+        gy1 = tgt[:,1] / self.scale[1]
+        gx2 = tgt[:,2] / self.scale[0]
+        gy2 = tgt[:,3] / self.scale[1]
+        gx = (gx1+gx2)/2.0
+        gy = (gy1+gy2)/2.0
+        # Get grid box indices
+        gi, gj = _grid_cells(gx, gy, nH, nW)
+        keys = (b_idx*nH+gj)*nW+gi
+        last = _last_writes(keys)
+        keys_last = keys[last]
+        gi = gi[last].float()
+        gj = gj[last].float()
+        # Masks (conf_mask is already 1)
+        mask.view(-1)[keys_last] = 1
+        # Coordinates
+        tx1.view(-1)[keys_last] = gx1[last] - (gi+0.5) #inv_tanh(gx1 - (gi+0.5))
+        ty1.view(-1)[keys_last] = gy1[last] - (gj+0.5) #inv_tanh(gy1 - (gj+0.5))
+        tx2.view(-1)[keys_last] = gx2[last] - (gi+0.5) #inv_tanh(gx2 - (gi+0.5))
+        ty2.view(-1)[keys_last] = gy2[last] - (gj+0.5) #inv_tanh(gy2 - (gj+0.5))
+        # One-hot encoding of label
+        tcls.view(-1,nC)[keys_last] = tgt[last,5:].byte()
+        tconf.view(-1)[keys_last] = 1
+
         #nGT, nCorrect, mask, conf_mask, tx, ty, tw, th, tr, tconf, tcls
         return nGT, mask, conf_mask, tx1, ty1, tx2, ty2, tconf, tcls
+
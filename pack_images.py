@@ -0,0 +1,39 @@
+import argparse
+import json
+from datasets import forms_graph_pair
+from datasets import funsd_graph_pair
+from datasets.image_store import pack_images
+
+#Decodes every page image of a graph pair dataset into one memory-mapped store
+#Set "image_store" in the data_loader config to the output path to train/evaluate from it
+
+DATASETS = {
+        'FormsGraphPair': forms_graph_pair.FormsGraphPair,
+        'FUNSDGraphPair': funsd_graph_pair.FUNSDGraphPair,
+        }
+
+def main(config_path,out_path,splits):
+    with open(config_path) as f:
+        config = json.load(f)
+    data_config = config['data_loader']
+    data_config['image_store']=None
+    data_config['annotation_cache']=None
+    setObj = DATASETS[data_config['data_set_name']]
+    paths=[]
+    for split in splits:
+        dataset = setObj(dirPath=data_config['data_dir'], split=split, config=data_config)
+        paths += [image['imagePath'] for image in dataset.images]
+    color = data_config['color'] if 'color' in data_config else True
+    pack_images(paths,out_path,color)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack decoded dataset images into a memory-mapped store')
+    parser.add_argument('-c', '--config', type=str, required=True,
+                        help='training config (data_loader is used)')
+    parser.add_argument('-o', '--out', type=str, required=True,
+                        help='path of store file (index is saved to path.json)')
+    parser.add_argument('-s', '--splits', type=str, nargs='+', default=['train','valid','test'],
+                        help='splits to pack (default: train valid test)')
+    args = parser.parse_args()
+    main(args.config,args.out,args.splits)
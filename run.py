@@ -8,6 +8,8 @@ import numpy as np
 #from tqdm import tqdm
 from skimage import color, io
 from model import *
+from model.cpu_inference import convert_for_cpu
+from model.inference_rewriter import rewrite_for_inference
 from evaluators.draw_graph import draw_graph
 
 DETECTOR_TRAINED_MODEL = "saved/FUNSDLines_detect_augR_staggerLighter/checkpoint-iteration250000.pth"
@@ -97,21 +99,24 @@ def detect_boxes_and_pairs(run_img,output_image=None,model_checkpoint=TRAINED_MO
     checkpoint = torch.load(model_checkpoint, map_location=lambda storage, location: storage)
     print(f"Using {checkpoint['config']['arch']}")
     model = eval(checkpoint['config']['arch'])(checkpoint['config']['model'])
+    if 'inference_rewritten' in checkpoint and checkpoint['inference_rewritten']:
+        rewrite_for_inference(model,verify=False)
+    if 'cpu_inference' in checkpoint:
+        convert_for_cpu(model,checkpoint['cpu_inference']) #made by make_cpu_model.py
     model.load_state_dict(checkpoint['state_dict'])
     model.eval()
 
 
     # run the image through the model
     print(f"Run image through model: {imagePath}")
-    with torch.no_grad():
-        result = model(run_img)
+    final, timing = model.infer(run_img,timing=True) #only the final graph is needed
+    print('Timing (sec): '+', '.join('{}: {:.3f}'.format(k,v) for k,v in timing.items()))
 
-    allOutputBoxes, outputOffsets, allEdgePred, allEdgeIndexes, allNodePred, allPredGroups, rel_prop_pred,merge_prop_scores, final = result
     finalOutputBoxes, finalPredGroups, finalEdgeIndexes, finalBBTrans = final
     draw_graph(finalOutputBoxes,None,None,finalEdgeIndexes,finalPredGroups,run_img,None,None,None,None,output_image)
     print(f"Saved output: {output_image}")
 
-    return result
+    return final
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run on a single image')
@@ -64,7 +64,7 @@ def main(rank,config, resume,world_size=None):
         else:
             dist.init_process_group("gloo", rank=rank, world_size=world_size)
 
-    #np.random.seed(1234) I don't have a way of restarting the DataLoader at the same place, so this makes it totaly random
+    #The training data is resumed at the same place with the same random numbers from the checkpoint (data_loader/resumable_sampler.py)
     train_logger = Logger()
 
     split = config['split'] if 'split' in config else 'train'
@@ -268,6 +268,7 @@ class BoxDetectTrainer(BaseTrainer):
                         else:
                             val_metrics[val_name]=value
         
+        val_metrics, val_count = self._merge_valid_shards(val_metrics, val_count)
         for val_name in val_metrics:
             if val_count[val_name]>0:
                 val_metrics[val_name] /= val_count[val_name]
@@ -8,6 +8,8 @@ from evaluators.draw_graph import draw_graph
 import matplotlib.pyplot as plt
 from utils.yolo_tools import non_max_sup_iou, AP_iou, non_max_sup_dist, AP_dist, getTargIndexForPreds_iou, newGetTargIndexForPreds_iou, getTargIndexForPreds_dist, computeAP, non_max_sup_overseg
 from utils.group_pairing import getGTGroup, pure, purity
+from utils.gpu_augmentation import apply_gpu_augmentation
+from utils.profiler import StageProfiler
 from datasets.testforms_graph_pair import display
 import random, os, math
 
@@ -68,6 +70,7 @@ class GraphPairTrainer(BaseTrainer):
 
         self.batch_size = data_loader.batch_size
         self.data_loader = data_loader
+        self._restore_data_state()
         self.data_loader_iter = iter(data_loader)
         self.valid_data_loader = valid_data_loader
 
@@ -133,6 +136,10 @@ class GraphPairTrainer(BaseTrainer):
 
         #fake a batch size by accumulating the gradient
         self.accum_grad_steps = config['trainer']['accum_grad_steps'] if 'accum_grad_steps' in config['trainer'] else 1
+        if self.oom_adaptive and self.accum_grad_steps>1:
+            #a retry (or skip) can't separate the failed attempt's partial gradient from the accumulated one
+            self.logger.warning('oom_adaptive is turned off when accumulating gradients')
+            self.oom_adaptive = False
 
         #Name change, originally called it 'rel', but 'edge' makes more sense
         if 'edge' in self.lossWeights:
@@ -153,6 +160,24 @@ class GraphPairTrainer(BaseTrainer):
 
         self.model_ref.used_threshConf=0.5
 
+        #per-stage timings and graph sizes (see utils/profiler.py), logged as prof_* every log_step
+        profile = config['trainer']['profile'] if 'profile' in config['trainer'] else False
+        profile_cuda_events = config['trainer']['profile_cuda_events'] if 'profile_cuda_events' in config['trainer'] else False
+        #peak memory of each stage, the worst pages are written to memory_report.json
+        profile_memory = config['trainer']['profile_memory'] if 'profile_memory' in config['trainer'] else False
+        self.profiler = StageProfiler(profile,profile_cuda_events,profile_memory,self.with_cuda)
+        self.memory_report_path = os.path.join(self.checkpoint_dir,'memory_report.json')
+
+        #for retrying a sample that ran out of memory (BaseTrainer._oom_retry)
+        self.last_instance = None
+        self.oom_instance = None
+        self.oom_saved_limits = None
+
+        self.nan_flag = None #set if a loss or gradient was NaN since the last log step
+        self.model_ref.profiler = self.profiler
+
+        self._restore_rng_state() #last, so setting up doesn't move the random number generators
+
     #handy funtion to put the data on the GPU
     def _to_tensor(self, instance):
         image = instance['img']
@@ -161,7 +186,12 @@ class GraphPairTrainer(BaseTrainer):
         num_neighbors = instance['num_neighbors']
 
         if self.with_cuda:
-            image = image.to(self.gpu)
+            detector = getattr(self.model_ref,'detector',None)
+            if self.model.training or getattr(detector,'tile_size',None) is None:
+                image = image.to(self.gpu) #tiled detection moves each tile to the GPU itself
+        if 'gpu_aug' in instance and instance['gpu_aug'] is not None:
+            image = apply_gpu_augmentation(image,[instance['gpu_aug']]) #crop the page
+        if self.with_cuda:
             if bbs is not None:
                 bbs = bbs.to(self.gpu)
             if num_neighbors is not None:
@@ -169,6 +199,17 @@ class GraphPairTrainer(BaseTrainer):
             #adjacenyMatrix = adjacenyMatrix.to(self.gpu)
         return image, bbs, adjaceny, num_neighbors
 
+    #forward only, for BaseTrainer.update_swa_batch_norm
+    def _bn_forward(self, instance):
+        if not self.model_ref.detector_predNumNeighbors:
+            instance['num_neighbors']=None
+        useGT = self.useGT(self.iteration)
+        if self.amp:
+            with torch.cuda.amp.autocast():
+                self.newRun(instance,useGT,forward_only=True)
+        else:
+            self.newRun(instance,useGT,forward_only=True)
+
     #whether to use the GT BBs for this iteration
     def useGT(self,iteration,force=False):
         if force:
@@ -205,18 +246,25 @@ class GraphPairTrainer(BaseTrainer):
 
             The metrics in log must have the key 'metrics'.
         """
+        tic = timeit.default_timer()
         if self.unfreeze_detector is not None and iteration>=self.unfreeze_detector:
             self.model_ref.unfreeze()
         self.model.train()
 
         
         batch_idx = (iteration-1) % len(self.data_loader)
-        try:
-            thisInstance = self.data_loader_iter.next()
-        except StopIteration:
-            #I do everything by iterations, not epoch. So it resets the dataloader whenever it runs out
-            self.data_loader_iter = iter(self.data_loader)
-            thisInstance = self.data_loader_iter.next()
+        if self.oom_instance is not None:
+            thisInstance = self.oom_instance #retrying after running out of memory
+        else:
+            try:
+                thisInstance = self.data_loader_iter.next()
+            except StopIteration:
+                #I do everything by iterations, not epoch. So it resets the dataloader whenever it runs out
+                self.data_loader_iter = iter(self.data_loader)
+                self.samples_consumed = 0
+                thisInstance = self.data_loader_iter.next()
+            self.samples_consumed += self.batch_size
+        self.last_instance = thisInstance
 
         if not self.model_ref.detector_predNumNeighbors:
             thisInstance['num_neighbors']=None #we don't use num neighbors for FUDGE
@@ -251,51 +299,133 @@ class GraphPairTrainer(BaseTrainer):
         for name in losses.keys():
             losses[name] *= self.lossWeights[name[:-4]]
             loss += losses[name]
-            losses[name] = losses[name].item()
+            losses[name] = losses[name].detach() #read on log steps by BaseTrainer.train, so no sync here
             
+        #time of the forward pass and loss (the backward waits on the other ranks with DDP)
+        self.last_work_time = timeit.default_timer()-tic
+        if hasattr(self.data_loader.sampler,'record'):
+            self.data_loader.sampler.record(thisInstance['imgName'],self.last_work_time)
+
         #backward step
+        step_nan = None
         if len(losses)>0:
-            assert not torch.isnan(loss)
+            step_nan = torch.isnan(loss.detach())
             if self.accum_grad_steps>1:
                 loss /= self.accum_grad_steps
+            self.profiler.start('backward')
             if self.amp:
                 self.scaler.scale(loss).backward()
             else:
                 loss.backward()
-
-        meangrad=0
-        count=0
-        for m in self.model.parameters():
-            if m.grad is None:
-                continue
-            count+=1
-            meangrad+=m.grad.data.mean().cpu().item()
-            assert not torch.isnan(m.grad.data).any()
-        if count!=0:
-            meangrad/=count
+            self.profiler.stop('backward')
+
+        #NaN gradient check every step, mean gradient only on log steps (both kept on the device)
+        grads = [m.grad.detach() for m in self.model.parameters() if m.grad is not None]
+        meangrad=None
+        if len(grads)>0:
+            if iteration%self.log_step==0:
+                #mean of each parameter's mean gradient
+                meangrad = torch.stack([g.mean().float() for g in grads]).mean()
+            if hasattr(torch,'_foreach_norm'):
+                #a NaN in any gradient makes its norm NaN
+                grad_nan = torch.isnan(torch.stack(torch._foreach_norm(grads))).any()
+            else:
+                grad_nan = torch.stack([torch.isnan(g).any() for g in grads]).any()
+            step_nan = grad_nan if step_nan is None else (step_nan | grad_nan)
+        elif iteration%self.log_step==0:
+            meangrad=0
+        if step_nan is not None:
+            self._flag_nan(step_nan)
 
         #gradient clipping (only happens if not accumulating)
         if self.accum_grad_steps<2 or iteration%self.accum_grad_steps==0:
+            if not self.amp and step_nan is not None:
+                #the flag is only read on log steps, so instead of stopping here zero the gradient
+                #(without a sync) to keep the NaN out of the weights until then (the amp scaler skips these steps itself)
+                for g in grads:
+                    g.masked_fill_(step_nan,0)
             torch.nn.utils.clip_grad_value_(self.model.parameters(),1)
             if self.amp:
                 self.scaler.step(self.optimizer)
                 self.scaler.update()
             else:
                 self.optimizer.step()
+        grads=None
         
         if len(losses)>0:
-            loss = loss.item()
+            loss = loss.detach()
+
+        #the NaN checks are only read (synced) on log steps
+        if iteration%self.log_step==0 and self.nan_flag is not None:
+            assert not self.nan_flag.item(), 'NaN loss or gradient in the last {} iterations'.format(self.log_step)
+            self.nan_flag = None
 
         log = {
-            'mean grad': meangrad,
+            **({'mean grad': meangrad} if meangrad is not None else {}),
             'loss': loss,
             **losses,
             
-            **run_log
+            **run_log,
+
+            **self.profiler.step(thisInstance['imgName'])
         }
+        if self.profiler.memory is not None and iteration%self.log_step==0:
+            self.profiler.memory.write_report(self.memory_report_path)
         
         return log
 
+    def _flag_nan(self, is_nan):
+        self.nan_flag = is_nan if self.nan_flag is None else (self.nan_flag | is_nan)
+
+    #Retry the last sample with the model's memory limits divided by 2**level
+    def _reduce_memory(self, level):
+        if self.last_instance is None:
+            return False
+        if self.oom_saved_limits is None:
+            self.oom_saved_limits = {
+                    'train_hard_detect_limit': self.train_hard_detect_limit,
+                    'roi_batch_size': getattr(self.model_ref,'roi_batch_size',None),
+                    'max_rel_to_keep': getattr(self.model_ref,'max_rel_to_keep',None),
+                    'max_merge_rel_to_keep': getattr(self.model_ref,'max_merge_rel_to_keep',None),
+                    }
+        self.oom_instance = self.last_instance
+        self.profiler.step(self.oom_instance['imgName']) #don't add the failed attempt to the retry's stats
+
+        divisor = 2**level
+        self.train_hard_detect_limit = max(1,self.oom_saved_limits['train_hard_detect_limit']//divisor)
+        for name in ['roi_batch_size','max_rel_to_keep','max_merge_rel_to_keep']:
+            if self.oom_saved_limits[name] is not None:
+                setattr(self.model_ref,name,max(1,self.oom_saved_limits[name]//divisor))
+        self.logger.warning('Out of memory on {}, retrying with hard_detect_limit={}, roi_batch_size={}, max_rel_to_keep={}'.format(
+            self.oom_instance['imgName'],
+            self.train_hard_detect_limit,
+            getattr(self.model_ref,'roi_batch_size',None),
+            getattr(self.model_ref,'max_rel_to_keep',None)))
+        return True
+
+    def _restore_memory(self):
+        if self.oom_saved_limits is not None:
+            self.train_hard_detect_limit = self.oom_saved_limits['train_hard_detect_limit']
+            for name in ['roi_batch_size','max_rel_to_keep','max_merge_rel_to_keep']:
+                if self.oom_saved_limits[name] is not None:
+                    setattr(self.model_ref,name,self.oom_saved_limits[name])
+            self.oom_saved_limits = None
+        self.oom_instance = None
+
+    def _oom_info(self):
+        if self.last_instance is None:
+            return {}
+        gpu_aug = self.last_instance['gpu_aug'] if 'gpu_aug' in self.last_instance else None
+        if gpu_aug is not None:
+            image_size = list(gpu_aug['shape']) #the crop that ran, img is still the whole page
+        else:
+            image_size = list(self.last_instance['img'].shape[-2:])
+        return {
+                'page': self.last_instance['imgName'],
+                'image_size': image_size,
+                'num_bbs': self.last_instance['bb_gt'].size(1) if self.last_instance['bb_gt'] is not None else 0
+                }
+
     #how log will be printed
     def _minor_log(self, log):
         ls=''
@@ -339,6 +469,7 @@ class GraphPairTrainer(BaseTrainer):
 
                 #run model and compute losses
                 losses,log_run, out = self.newRun(instance,useGT,get=['bb_stats','nn_acc'])
+                log_run.update(self.profiler.step(instance['imgName']))
 
                 for name,value in log_run.items():
                     if value is not None:
@@ -360,6 +491,7 @@ class GraphPairTrainer(BaseTrainer):
 
 
 
+        val_metrics, val_count = self._merge_valid_shards(val_metrics, val_count)
         for val_name in val_metrics:
             if val_count[val_name]>0:
                 val_metrics[val_name] =  val_metrics[val_name]/val_count[val_name]
@@ -909,9 +1041,11 @@ class GraphPairTrainer(BaseTrainer):
         if forward_only:
             return
         
-        
+        self.profiler.start('loss')
         losses=defaultdict(lambda:0)
         log={}
+        if not self.model.training and hasattr(self.model_ref,'graph_iterations_run'):
+            log['graph_iterations']=self.model_ref.graph_iterations_run #can be less than the number of GCNs with early exit
 
         allEdgePredTypes=[]
         allMissedRels=[]
@@ -928,6 +1062,8 @@ class GraphPairTrainer(BaseTrainer):
 
                 #This sets up all the edges for loss caclulation
                 # we also reuse bbAlignment later
+                self.profiler.stop('loss')
+                self.profiler.start('align')
                 predEdgeShouldBeTrue,predEdgeShouldBeFalse, bbAlignment, proposedInfoI, logIter, edgePredTypes, missedRels = self.simplerAlignEdgePred(
                         targetBoxes,
                         targetIndexToGroup,
@@ -943,6 +1079,8 @@ class GraphPairTrainer(BaseTrainer):
                         self.thresh_group[graphIteration],
                         self.thresh_error[graphIteration]
                         )
+                self.profiler.stop('align')
+                self.profiler.start('loss')
                 
 
                 allEdgePredTypes.append(edgePredTypes)
@@ -1317,6 +1455,7 @@ class GraphPairTrainer(BaseTrainer):
                     got[name]=log['DocStruct redid hit@1']
             elif name != 'bb_stats' and name != 'nn_acc':
                 raise NotImplementedError('Cannot get [{}], unknown'.format(name))
+        self.profiler.stop('loss')
         return losses, log, got
 
 
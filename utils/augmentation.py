@@ -26,7 +26,7 @@ def tensmeyer_brightness(img, foreground=0, background=0):
 
     return img.astype(np.uint8)
 
-def apply_tensmeyer_brightness(img, sigma=20, **kwargs):
+def sample_tensmeyer_brightness(sigma=20, **kwargs):
     random_state = np.random.RandomState(kwargs.get("random_seed", None))
     if kwargs.get("better",False):
         foreground = (random_state.beta(1.2,2)-0.1)*256/0.9
@@ -34,6 +34,10 @@ def apply_tensmeyer_brightness(img, sigma=20, **kwargs):
     else:
         foreground = random_state.normal(0,sigma)
         background = random_state.normal(0,sigma)
+    return foreground, background
+
+def apply_tensmeyer_brightness(img, sigma=20, **kwargs):
+    foreground, background = sample_tensmeyer_brightness(sigma, **kwargs)
     #print('fore {}, back {}'.format(foreground,background))
 
     img = tensmeyer_brightness(img, foreground, background)
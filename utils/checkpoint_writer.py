@@ -0,0 +1,75 @@
+import torch
+import os
+import copy
+import shutil
+import threading
+import timeit
+
+#Writes checkpoints from a background thread.
+#The training thread only takes a snapshot (tensors are copied to the CPU, everything else deep-copied), then
+#the thread torch.saves it to a temp file and renames it into place, so a checkpoint file is never half written.
+#Extra names for the same checkpoint (checkpoint-latest.pth) are hardlinks, not a second torch.save.
+
+def snapshot(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu',copy=True)
+    elif isinstance(obj,dict):
+        new_obj = type(obj)((k,snapshot(v)) for k,v in obj.items())
+        if hasattr(obj,'_metadata'): #state_dict version info
+            new_obj._metadata = copy.deepcopy(obj._metadata)
+        return new_obj
+    elif isinstance(obj,(list,tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    else:
+        return copy.deepcopy(obj)
+
+def _replace_with_link(src,dst):
+    tmp = dst+'.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src,tmp)
+    except OSError: #filesystem without hardlinks
+        shutil.copyfile(src,tmp)
+    os.replace(tmp,dst)
+
+class CheckpointWriter:
+    def __init__(self,run_async=True):
+        self.run_async=run_async
+        self.thread=None
+        self.error=None
+
+    #Queues the state to be written to filename, then linked as each of links. Returns the seconds the caller was held up
+    def save(self,state,filename,links=[],rename_to=None,snapshot_state=True):
+        tic=timeit.default_timer()
+        self.wait()
+        if snapshot_state:
+            state = snapshot(state)
+        if self.run_async:
+            self.thread = threading.Thread(target=self._write,args=(state,filename,links,rename_to),daemon=False)
+            self.thread.start()
+        else:
+            self._write(state,filename,links,rename_to)
+        return timeit.default_timer()-tic
+
+    def _write(self,state,filename,links,rename_to):
+        try:
+            tmp = filename+'.tmp'
+            torch.save(state,tmp)
+            os.replace(tmp,filename)
+            for link in links:
+                _replace_with_link(filename,link)
+            if rename_to is not None:
+                os.replace(filename,rename_to)
+        except Exception as e:
+            self.error=e
+
+    #Blocks until the last checkpoint is written
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread=None
+        if self.error is not None:
+            error = self.error
+            self.error=None
+            raise error
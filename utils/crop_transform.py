@@ -342,6 +342,66 @@ class CropTransform(object):
             "point_gt": new_point_gts,
             "pixel_gt": pixel_gt
         }
+#Stands in for the rotated (warpAffine with M) and zero padded page in generate_random_crop.
+#Only the window that is cropped (by slicing) gets computed: the rotation, padding and crop offset
+#are combined into one affine sample of the source image.
+#With defer, no pixels are computed; the window's warp is recorded in .window for utils.gpu_augmentation.
+class WarpedPaddedPage(object):
+    def __init__(self,img,M,pad_params,defer=False):
+        if len(img.shape)==2:
+            img = img[:,:,None]
+        self.img=img
+        if M is not None and np.allclose(M,[[1,0,0],[0,1,0]]):
+            M=None #no rotation, just copy
+        self.M=M
+        self.defer=defer
+        self.window=None
+        self.pad_top = pad_params[0][0]
+        self.pad_left = pad_params[1][0]
+        self.shape = (img.shape[0]+pad_params[0][0]+pad_params[0][1],
+                      img.shape[1]+pad_params[1][0]+pad_params[1][1],
+                      img.shape[2])
+
+    def __getitem__(self,window):
+        rows,cols = window
+        r0,r1,_ = rows.indices(self.shape[0])
+        c0,c1,_ = cols.indices(self.shape[1])
+        #window in the rotated page's coordinates
+        y0 = r0-self.pad_top
+        x0 = c0-self.pad_left
+        H,W = self.img.shape[:2]
+        if self.defer:
+            M = np.array([[1.0,0,0],[0,1,0]]) if self.M is None else self.M
+            offset = np.array([ [1,0,x0],
+                                [0,1,y0],
+                                [0,0,1] ])
+            self.window = {
+                    'matrix': np.concatenate((M,np.array([[0.0,0.0,1.0]])),axis=0).dot(offset),
+                    'shape': (r1-r0,c1-c0),
+                    'inside': (-y0,H-y0,-x0,W-x0),
+                    }
+            return self.img[0:0,0:0]
+        if self.M is None:
+            out = np.zeros((r1-r0,c1-c0,self.img.shape[2]),dtype=self.img.dtype)
+            sy0,sy1 = max(y0,0),min(y0+r1-r0,H)
+            sx0,sx1 = max(x0,0),min(x0+c1-c0,W)
+            if sy0<sy1 and sx0<sx1:
+                out[sy0-y0:sy1-y0,sx0-x0:sx1-x0] = self.img[sy0:sy1,sx0:sx1]
+            return out
+        offset = np.array([ [1,0,x0],
+                            [0,1,y0],
+                            [0,0,1] ])
+        M = np.concatenate((self.M,np.array([[0.0,0.0,1.0]])),axis=0).dot(offset)
+        out = img_f.warpAffine(self.img,M[:2],(r1-r0,c1-c0))
+        if len(out.shape)==2:
+            out = out[:,:,None]
+        #the padding (outside of the rotated page)
+        out[:max(0,-y0)]=0
+        out[max(0,H-y0):]=0
+        out[:,:max(0,-x0)]=0
+        out[:,max(0,W-x0):]=0
+        return out
+
 class CropBoxTransform(object):
     def __init__(self, crop_params,rotate):
         self.crop_size = crop_params['crop_size']
@@ -370,6 +430,8 @@ class CropBoxTransform(object):
             self.degree_std_dev = 0 
         self.flip_horz = crop_params['flip_horz'] if 'flip_horz' in crop_params else False
         self.flip_vert = crop_params['flip_vert'] if 'flip_vert' in crop_params else False
+        #leave the image warp to the trainer (utils.gpu_augmentation), returning the whole page and 'warp'
+        self.defer_warp = False
 
 
     def __call__(self, sample,cropPoint=None):
@@ -401,6 +463,7 @@ class CropBoxTransform(object):
         pixel_gt = sample['pixel_gt'] if 'pixel_gt' in sample else None
         query_bb = sample['query_bb'] if 'query_bb' in sample else None
 
+        warp_M=None
         #rotation
         if self.rotate or self.flip_horz or self.flip_vert:
             if self.rot_freq>np.random.uniform():
@@ -445,9 +508,12 @@ class CropBoxTransform(object):
             M=M[:2] #opencv didn't want 3x3
             rM = uncenter.dot(rM)[:2]
             #rotate image
-            org_img = img_f.warpAffine(org_img,M,(org_img.shape[0],org_img.shape[1]))
-            if len(org_img.shape)==2:
-                org_img = org_img[:,:,None]
+            if pixel_gt is None:
+                warp_M = M #only the crop window is warped, later
+            else:
+                org_img = img_f.warpAffine(org_img,M,(org_img.shape[0],org_img.shape[1]))
+                if len(org_img.shape)==2:
+                    org_img = org_img[:,:,None]
             if pixel_gt is not None:
                 pixel_gt = img_f.warpAffine(pixel_gt,M,(pixel_gt.shape[1],pixel_gt.shape[0]))
                 if len(pixel_gt.shape)==2:
@@ -500,7 +566,10 @@ class CropBoxTransform(object):
         #pad out to allow random samples to take space off of the page
         ##tic=timeit.default_timer()
         #org_img = np.pad(org_img, self.pad_params, 'mean')
-        if org_img.shape[2]==3:
+        if pixel_gt is None:
+            #the rotation and padding are done when the crop is taken, on just the crop window
+            org_img = WarpedPaddedPage(org_img,warp_M,pad_params,self.defer_warp)
+        elif org_img.shape[2]==3:
             org_img = np.pad(org_img, pad_params, 'constant', constant_values=0) #zero, since that what Conv2d pads with
         else:
             org_img = np.pad(org_img, pad_params, 'constant', constant_values=0)
@@ -554,7 +623,13 @@ class CropBoxTransform(object):
                     gt[:,:,3] = gt[:,:,3] + pad_params[0][0]
 
 
+        page = org_img
         crop_params, org_img, pixel_gt, line_gt_match, point_gt_match, new_bb_gt, new_bb_auxs, cropPoint = generate_random_crop(org_img, pixel_gt, line_gts, point_gts, self.random_crop_params, bb_gt=bb_gt, bb_auxs=bb_auxs, query_bb=query_bb, cropPoint=cropPoint)
+        if pixel_gt is None and self.defer_warp:
+            org_img = page.img
+            warp = page.window
+        else:
+            warp = None
         #print(crop_params)
         #print(gt_match)
         
@@ -601,5 +676,6 @@ class CropBoxTransform(object):
             aux_str: new_bb_auxs,
             "line_gt": new_line_gts,
             "point_gt": new_point_gts,
-            "pixel_gt": pixel_gt
+            "pixel_gt": pixel_gt,
+            "warp": warp
         }, cropPoint)
@@ -0,0 +1,82 @@
+import torch
+import torch.nn.functional as F
+
+#Tensor versions of the pixel work of the graph pair training augmentation, run by the trainer on the
+#training device. The dataset (with "gpu_augmentation" set) still chooses the rotation, crop and brightness
+#and updates the boxes on the CPU (CropBoxTransform), but returns the whole page and the parameters:
+#  'matrix': 3x3, maps a crop pixel (x,y,1) to the source page pixel (the rotation, padding and crop offset)
+#  'shape': (height,width) of the crop
+#  'inside': (top,bottom,left,right), the part of the crop on the rotated page (the rest is padding)
+#  'brightness': (foreground,background) for tensmeyer_brightness, or None
+#Images are in the dataset's normalized form (1-pixel/128).
+
+#skimage.color.rgb2gray weights
+GRAY_WEIGHTS=[0.2125, 0.7154, 0.0721]
+
+def _pixel_to_norm(size):
+    #align_corners=True: pixel 0 is -1 and pixel size-1 is 1
+    return 2.0/max(size-1,1)
+
+#Warps each page [B,C,H,W] to its crop window, with bilinear sampling and zero pixels outside the page (as img_f.warpAffine and the padding)
+def warp_crop(pixels,matrices,out_shape):
+    B,C,H,W = pixels.shape
+    h,w = out_shape
+    to_norm_in = torch.tensor([ [_pixel_to_norm(W),0,-1],
+                                [0,_pixel_to_norm(H),-1],
+                                [0,0,1] ],dtype=torch.float64)
+    from_norm_out = torch.tensor([  [1/_pixel_to_norm(w),0,1/_pixel_to_norm(w)],
+                                    [0,1/_pixel_to_norm(h),1/_pixel_to_norm(h)],
+                                    [0,0,1] ],dtype=torch.float64)
+    theta = to_norm_in[None].matmul(matrices.double()).matmul(from_norm_out[None])[:,:2]
+    grid = F.affine_grid(theta.to(pixels.device,pixels.dtype),(B,C,h,w),align_corners=True)
+    return F.grid_sample(pixels,grid,mode='bilinear',padding_mode='zeros',align_corners=True)
+
+#Threshold of a 1D tensor of values, as skimage.filters.threshold_otsu (256 bins)
+def otsu_threshold(values):
+    vmin = values.min()
+    vmax = values.max()
+    hist = torch.histc(values,bins=256,min=vmin.item(),max=vmax.item())
+    bin_width = (vmax-vmin)/256
+    centers = vmin+bin_width*(torch.arange(256,device=values.device,dtype=values.dtype)+0.5)
+    weight1 = hist.cumsum(0)
+    weight2 = hist.flip(0).cumsum(0).flip(0)
+    mean1 = (hist*centers).cumsum(0)/weight1
+    mean2 = ((hist*centers).flip(0).cumsum(0)/weight2.flip(0)).flip(0)
+    variance12 = weight1[:-1]*weight2[1:]*(mean1[:-1]-mean2[1:])**2
+    variance12[torch.isnan(variance12)]=-1 #empty bins
+    return centers[:-1][variance12.argmax()]
+
+#tensmeyer_brightness on pixel images [B,C,H,W] (0-255): foreground (above the Otsu threshold) and background are shifted
+def tensmeyer_brightness(pixels,foregrounds,backgrounds):
+    out=[]
+    for img,foreground,background in zip(pixels,foregrounds,backgrounds):
+        if img.size(0)==3:
+            gray = (img*torch.tensor(GRAY_WEIGHTS,device=img.device,dtype=img.dtype)[:,None,None]).sum(dim=0,keepdim=True)
+        else:
+            gray = img
+        if gray.max()>gray.min():
+            th = (gray>otsu_threshold(gray.view(-1))).to(img.dtype)
+        else:
+            th = img/2/255 #threshold_otsu fails on a single value image
+        img = img + (1.0-th)*foreground
+        img = img + th*background
+        out.append(img.clamp(0,255).floor()) #clipped and truncated to uint8
+    return torch.stack(out,dim=0)
+
+#image: [B,C,H,W] normalized pages, augs: the dataset's parameters for each. Returns the normalized crops
+def apply_gpu_augmentation(image,augs):
+    pixels = (1.0-image)*128.0
+    shape = augs[0]['shape']
+    matrices = torch.stack([torch.as_tensor(aug['matrix'],dtype=torch.float64) for aug in augs],dim=0)
+    pixels = warp_crop(pixels,matrices,shape)
+    for b,aug in enumerate(augs):
+        top,bottom,left,right = aug['inside']
+        pixels[b,:,:max(0,top)]=0
+        pixels[b,:,max(0,bottom):]=0
+        pixels[b,:,:,:max(0,left)]=0
+        pixels[b,:,:,max(0,right):]=0
+    if augs[0]['brightness'] is not None:
+        foregrounds = [aug['brightness'][0] for aug in augs]
+        backgrounds = [aug['brightness'][1] for aug in augs]
+        pixels = tensmeyer_brightness(pixels,foregrounds,backgrounds)
+    return 1.0 - pixels/128.0
@@ -0,0 +1,141 @@
+import json
+import heapq
+import math
+import os
+import resource
+import torch
+
+#Peak and current memory at the StageProfiler's stage boundaries.
+#CUDA: the allocator's peak is read and reset at every stage boundary and folded into each open stage's peak,
+#so each stage gets its own peak and an outer stage's peak also covers the stages nested in it.
+#CPU: the resident set size at the boundaries (the allocator can't give a per-stage peak), and the process' peak.
+#Each step (page) is kept with its graph sizes only if it's one of the worst (by peak), and the correlation of
+#the step peak with each graph size is kept as running sums, so the tracker's memory doesn't grow with the run.
+
+MB = 1024*1024
+
+def cpu_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError,ValueError,IndexError):
+        return cpu_peak() #not linux
+
+def cpu_peak():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname=='Darwin' else peak*1024 #bytes on mac, KB on linux
+
+class MemoryTracker:
+    def __init__(self,cuda=True,num_worst=20):
+        self.cuda = cuda and torch.cuda.is_available()
+        self.num_worst = num_worst
+        self.worst = [] #min-heap of (peak,count,record)
+        self.stage_max = {} #stage: worst peak seen
+        self.num_steps = 0
+        self.corr_sums = {} #count name: [n,sum x,sum y,sum xx,sum yy,sum xy]
+        self._new_step()
+
+    def _new_step(self):
+        self.stages = {} #stage: {'peak':,'current':,'cpu':}
+        self.step_peak = 0
+        self.open_peaks = [] #[name,peak] of the started stages, innermost last
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    #the peak since the last boundary counts for every open stage (and the step)
+    def _fold_peak(self):
+        peak = torch.cuda.max_memory_allocated()
+        self.step_peak = max(self.step_peak,peak)
+        for open_peak in self.open_peaks:
+            open_peak[1] = max(open_peak[1],peak)
+        torch.cuda.reset_peak_memory_stats()
+        return peak
+
+    def stage_start(self,name):
+        if self.cuda:
+            self._fold_peak()
+            self.open_peaks.append([name,0])
+
+    def stage_stop(self,name):
+        if self.cuda:
+            peak = self._fold_peak() #(if it wasn't started)
+            for i in range(len(self.open_peaks)-1,-1,-1):
+                if self.open_peaks[i][0]==name:
+                    peak = self.open_peaks.pop(i)[1]
+                    break
+            current = torch.cuda.memory_allocated()
+        else:
+            peak = current = cpu_rss()
+        self.step_peak = max(self.step_peak,peak)
+        if name in self.stages:
+            stage = self.stages[name]
+            stage['peak'] = max(stage['peak'],peak)
+            stage['current'] = current
+        else:
+            self.stages[name] = {'peak':peak, 'current':current}
+        self.stages[name]['cpu'] = cpu_rss()
+        self.stage_max[name] = max(self.stage_max.get(name,0),peak)
+
+    #Ends the step, counts are the graph sizes of it. Returns the step's peak and the CPU RSS (bytes)
+    def step(self,counts,page=None):
+        if self.cuda:
+            self.step_peak = max(self.step_peak,torch.cuda.max_memory_allocated())
+        peak = self.step_peak
+        rss = cpu_rss()
+        if len(self.stages)>0:
+            self.num_steps+=1
+            for name,value in counts.items():
+                if name not in self.corr_sums:
+                    self.corr_sums[name]=[0]*6
+                sums = self.corr_sums[name]
+                x = float(value)
+                y = peak/MB
+                sums[0]+=1
+                sums[1]+=x
+                sums[2]+=y
+                sums[3]+=x*x
+                sums[4]+=y*y
+                sums[5]+=x*y
+            if len(self.worst)<self.num_worst or peak>self.worst[0][0]:
+                record = {
+                        'page':page,
+                        'peak_mb':peak/MB,
+                        'cpu_rss_mb':rss/MB,
+                        'stages':{name:{k:v/MB for k,v in stage.items()} for name,stage in self.stages.items()},
+                        **counts
+                        }
+                entry = (peak,self.num_steps,record)
+                if len(self.worst)<self.num_worst:
+                    heapq.heappush(self.worst,entry)
+                else:
+                    heapq.heapreplace(self.worst,entry)
+        self._new_step()
+        return peak, rss
+
+    #Pearson correlation of the step peak with each graph size
+    def correlations(self):
+        corrs={}
+        for name,(n,sx,sy,sxx,syy,sxy) in self.corr_sums.items():
+            var_x = n*sxx-sx*sx
+            var_y = n*syy-sy*sy
+            if n>1 and var_x>0 and var_y>0:
+                corrs[name] = (n*sxy-sx*sy)/math.sqrt(var_x*var_y)
+            else:
+                corrs[name] = None
+        return corrs
+
+    def report(self):
+        return {
+                'device': 'cuda' if self.cuda else 'cpu',
+                'steps': self.num_steps,
+                'cpu_peak_mb': cpu_peak()/MB,
+                'stage_peak_mb': {name:value/MB for name,value in self.stage_max.items()},
+                'peak_correlation': self.correlations(),
+                'worst_pages': [record for peak,i,record in sorted(self.worst,key=lambda e:-e[0])]
+                }
+
+    def write_report(self,path):
+        tmp_path = path+'.tmp'
+        with open(tmp_path,'w') as f:
+            json.dump(self.report(),f,indent=2,default=str)
+        os.replace(tmp_path,path)
@@ -0,0 +1,116 @@
+import timeit
+import torch
+from collections import defaultdict
+from utils.memory_tracker import MemoryTracker, MB
+
+#Named stage timers and graph size counters for the FUDGE forward and the trainer step.
+#Disabled, every call returns right away. Enabled, stages are timed with the host clock (no syncs, so on
+#the GPU it is mostly the launch time of the stage) or, with cuda_events, with CUDA events which are only
+#read back once per step (the one sync). A stage started more than once in a step (e.g. mergeAndGroup) is summed.
+#step() ends an iteration/page and returns its values, summary() the means over the steps since the last summary().
+#With memory, a MemoryTracker also records the memory at each stage boundary (see utils/memory_tracker.py).
+
+class StageProfiler:
+    def __init__(self,enabled=False,cuda_events=False,memory=False,cuda=True):
+        cuda = cuda and torch.cuda.is_available() #whether the model is run on the GPU
+        self.enabled=enabled or memory
+        self.memory=MemoryTracker(cuda) if memory else None
+        self.cuda_events=cuda_events and cuda
+        self.open={} #name: start time or event
+        self.events=[] #(name,start event,end event) to resolve at step()
+        self.times=defaultdict(float)
+        self.counts=defaultdict(float)
+        self.total_times=defaultdict(float)
+        self.total_counts=defaultdict(float)
+        self.steps=0
+
+    def start(self,name):
+        if not self.enabled:
+            return
+        if self.memory is not None:
+            self.memory.stage_start(name)
+        if self.cuda_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            self.open[name]=event
+        else:
+            self.open[name]=timeit.default_timer()
+
+    def stop(self,name):
+        if not self.enabled or name not in self.open:
+            return
+        start = self.open.pop(name)
+        if self.memory is not None:
+            self.memory.stage_stop(name)
+        if self.cuda_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            self.events.append((name,start,event))
+        else:
+            self.times[name]+=timeit.default_timer()-start
+
+    def stage(self,name):
+        return _Stage(self,name)
+
+    #adds to a per-step counter (graph sizes)
+    def count(self,name,value):
+        if self.enabled:
+            self.counts[name]+=value
+
+    #Ends the step (page is only used to name it in the memory report). Returns {'prof_sec_<stage>':seconds, 'prof_<counter>':value} for it
+    def step(self,page=None):
+        if not self.enabled:
+            return {}
+        if len(self.events)>0:
+            self.events[-1][2].synchronize()
+            for name,start,end in self.events:
+                self.times[name]+=start.elapsed_time(end)/1000
+            self.events=[]
+        self.open={}
+        values={}
+        for name,value in self.times.items():
+            values['prof_sec_'+name]=value
+            self.total_times[name]+=value
+        for name,value in self.counts.items():
+            values['prof_'+name]=value
+            self.total_counts[name]+=value
+        if self.memory is not None:
+            peak,rss = self.memory.step(self.counts,page)
+            values['prof_mem_peak_mb']=peak/MB
+            values['prof_mem_cpu_rss_mb']=rss/MB
+        self.times=defaultdict(float)
+        self.counts=defaultdict(float)
+        self.steps+=1
+        return values
+
+    #Means per step since the last summary: ({stage:seconds},{counter:value},number of steps)
+    def summary(self):
+        steps = max(self.steps,1)
+        times = {name:value/steps for name,value in self.total_times.items()}
+        counts = {name:value/steps for name,value in self.total_counts.items()}
+        num_steps = self.steps
+        self.total_times=defaultdict(float)
+        self.total_counts=defaultdict(float)
+        self.steps=0
+        return times,counts,num_steps
+
+    def summary_str(self):
+        times,counts,num_steps = self.summary()
+        if num_steps==0:
+            return 'profile: no steps'
+        total = sum(times.values())
+        lines=['profile (mean of {} steps, {}):'.format(num_steps,'CUDA events' if self.cuda_events else 'host clock')]
+        for name,value in sorted(times.items(),key=lambda x:-x[1]):
+            lines.append('  {:20s} {:.4f} sec ({:.1f}%)'.format(name,value,100*value/total if total>0 else 0))
+        for name,value in counts.items():
+            lines.append('  {:20s} {:.1f}'.format(name,value))
+        return '\n'.join(lines)
+
+class _Stage:
+    def __init__(self,profiler,name):
+        self.profiler=profiler
+        self.name=name
+    def __enter__(self):
+        self.profiler.start(self.name)
+    def __exit__(self,*args):
+        self.profiler.stop(self.name)